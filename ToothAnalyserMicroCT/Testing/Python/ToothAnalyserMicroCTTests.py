@@ -34,9 +34,25 @@ class ToothAnalyserMicroCTTestMixin:
             "testCollectFilesReturnsEmptyForNonDirectory",
             "testLoadResultsToSceneRequiresBothMidSurfaces",
             "testCreateAndClearDirectory",
+            "testLoadPreviewVolumeUsesClosestLevel",
             "testExecuteAsBatchInvalidSourcePath",
             "testExecuteAsBatchInvalidTargetPath",
             "testExecuteAsBatchNoSupportedFiles",
+            "testExecuteAsBatchSkipsDuplicateScans",
+            "testExecuteAsBatchKeepsFingerprintCollisions",
+            "testWriteIsqRoundTrip",
+            "testStitchIsqRoundTrip",
+            "testThresholdFilterReusesHistogram",
+            "testHistogramThresholdsMatchFilters",
+            "testRunGraphRunsIndependentStepsConcurrently",
+            "testLeanModeReleasesIntermediates",
+            "testProfileStepsRecordsSteps",
+            "testSweepSharesPrefixSteps",
+            "testStepCacheHitAndMiss",
+            "testSourceKeyChangesWithFile",
+            "testEnamelHolesInRegion",
+            "testComponentsMatchCcMinSize",
+            "testDistanceMorphologyMatchesFilters",
         ]
 
         self.delayDisplay(f"Starting ToothAnalyserMicroCT tests ({len(testMethods)} cases)...", 200)
@@ -80,6 +96,7 @@ class ToothAnalyserMicroCTTestMixin:
             targetPath=self._UiFlag(visible=False),
             label_7=self._UiFlag(visible=False),
             fileType=self._UiFlag(visible=False),
+            writeProfile=self._UiFlag(visible=False),
         )
 
         param = SimpleNamespace(
@@ -93,6 +110,18 @@ class ToothAnalyserMicroCTTestMixin:
         widget.handleApplyButton = lambda: None
         return widget
 
+    def _writeSyntheticTooth(self, path):
+        """Write a small noisy tooth with a dentin core and an enamel cap."""
+        import numpy as np
+        import SimpleITK as sitk
+
+        rng = np.random.default_rng(0)
+        z, y, x = np.mgrid[:40, :45, :50]
+        r = np.sqrt((z - 18) ** 2 + (y - 21) ** 2 + (x - 24) ** 2)
+        array = np.where(r < 12, np.where((r < 8) | (z > 18), 900.0, 1500.0), 200.0)
+        array += rng.normal(0, 40, r.shape)
+        sitk.WriteImage(sitk.GetImageFromArray(array.astype(np.int16)), path)
+
     def testAlgorithmSelection(self):
         """Test algorithm discovery and name-based selection."""
         logic = self.ToothAnalyserMicroCTLogic()
@@ -175,6 +204,7 @@ class ToothAnalyserMicroCTTestMixin:
         self.assertTrue(widget.ui.targetPath.isVisible())
         self.assertTrue(widget.ui.label_7.isVisible())
         self.assertTrue(widget.ui.fileType.isVisible())
+        self.assertTrue(widget.ui.writeProfile.isVisible())
 
         widget._param.isBatch = False
         self.ToothAnalyserMicroCTWidget.handleBatchCollapsible(widget)
@@ -186,6 +216,7 @@ class ToothAnalyserMicroCTTestMixin:
         self.assertFalse(widget.ui.targetPath.isVisible())
         self.assertFalse(widget.ui.label_7.isVisible())
         self.assertFalse(widget.ui.fileType.isVisible())
+        self.assertFalse(widget.ui.writeProfile.isVisible())
 
     def testHandleSegmentation(self):
         """Test segmentation panel switching."""
@@ -243,7 +274,7 @@ class ToothAnalyserMicroCTTestMixin:
 
         anatomicalSeg = self.AnatomicalSegmentationLogic()
         with tempfile.TemporaryDirectory() as tmpdir:
-            supported = ["a.ISQ", "b.mhd", "c.nrrd", "d.nii", "e.NII"]
+            supported = ["a.ISQ", "b.mhd", "c.nrrd", "d.nii", "e.NII", "i.aim"]
             unsupported = ["f.txt", "g", "h.raw"]
             for name in supported + unsupported:
                 with open(os.path.join(tmpdir, name), "w", encoding="utf8"):
@@ -310,6 +341,20 @@ class ToothAnalyserMicroCTTestMixin:
             anatomicalSeg.clearDirectory(resultPath)
             self.assertEqual(os.listdir(resultPath), [])
 
+    def testLoadPreviewVolumeUsesClosestLevel(self):
+        """Test that preview loading picks the pyramid level closest to the voxel target."""
+        import tempfile
+        import SimpleITK as sitk
+
+        anatomicalSeg = self.AnatomicalSegmentationLogic()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            sourcePath = os.path.join(tmpdir, "Case_01.nrrd")
+            sitk.WriteImage(sitk.Image([32, 32, 32], sitk.sitkUInt8), sourcePath)
+
+            node = anatomicalSeg.loadPreviewVolume(sourcePath, 8 ** 3, os.path.join(tmpdir, "cache"))
+            self.assertEqual(node.GetImageData().GetDimensions(), (8, 8, 8))
+            self.assertEqual(node.GetName(), "Case_01_Preview")
+
     def testExecuteAsBatchInvalidSourcePath(self):
         """Test executeAsBatch error handling for invalid source path."""
         from types import SimpleNamespace
@@ -371,3 +416,446 @@ class ToothAnalyserMicroCTTestMixin:
             with patch.object(logic, "warning") as warning:
                 logic.executeAsBatch(param, progressBar)
                 warning.assert_called_once()
+
+    def testExecuteAsBatchSkipsDuplicateScans(self):
+        """Test executeAsBatch computes a scan only once if it is stored twice."""
+        from types import SimpleNamespace
+        from unittest.mock import patch
+        import shutil
+        import tempfile
+        import SimpleITK as sitk
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            sourceDir = os.path.join(tmpdir, "source")
+            targetDir = os.path.join(tmpdir, "target")
+            os.makedirs(sourceDir, exist_ok=True)
+            os.makedirs(targetDir, exist_ok=True)
+            sitk.WriteImage(sitk.Image([8, 8, 8], sitk.sitkUInt8), os.path.join(sourceDir, "a.nrrd"))
+            shutil.copy(os.path.join(sourceDir, "a.nrrd"), os.path.join(sourceDir, "b.nrrd"))
+            param = SimpleNamespace(
+                batch=SimpleNamespace(sourcePath=sourceDir, targetPath=targetDir, fileType=".nrrd"),
+                anatomical=SimpleNamespace(calcMidSurface=False, createMesh=False),
+                pre=SimpleNamespace(compress=False),
+            )
+            progressBar = self._UiFlag()
+            logic = self.AnatomicalSegmentationLogic()
+            with patch.object(logic, "runSegmentationPipeline", side_effect=RuntimeError("stop")) as pipeline, \
+                    patch.object(logic, "warning") as warning:
+                logic.executeAsBatch(param, progressBar)
+                pipeline.assert_called_once()
+                self.assertEqual(warning.call_count, 2)
+
+    def testExecuteAsBatchKeepsFingerprintCollisions(self):
+        """Test executeAsBatch computes different scans even if their sampled fingerprints match."""
+        from types import SimpleNamespace
+        from unittest.mock import patch
+        import tempfile
+        import SimpleITK as sitk
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            sourceDir = os.path.join(tmpdir, "source")
+            targetDir = os.path.join(tmpdir, "target")
+            os.makedirs(sourceDir, exist_ok=True)
+            os.makedirs(targetDir, exist_ok=True)
+            sitk.WriteImage(sitk.Image([8, 8, 8], sitk.sitkUInt8), os.path.join(sourceDir, "a.nrrd"))
+            sitk.WriteImage(sitk.Image([8, 8, 8], sitk.sitkUInt8) + 1, os.path.join(sourceDir, "b.nrrd"))
+            param = SimpleNamespace(
+                batch=SimpleNamespace(sourcePath=sourceDir, targetPath=targetDir, fileType=".nrrd"),
+                anatomical=SimpleNamespace(calcMidSurface=False, createMesh=False),
+                pre=SimpleNamespace(compress=False),
+            )
+            progressBar = self._UiFlag()
+            logic = self.AnatomicalSegmentationLogic()
+            with patch("ToothAnalyserMicroCTLib.tha.cache.fingerprint", return_value="same"), \
+                    patch.object(logic, "runSegmentationPipeline", side_effect=RuntimeError("stop")) as pipeline, \
+                    patch.object(logic, "warning"):
+                logic.executeAsBatch(param, progressBar)
+                self.assertEqual(pipeline.call_count, 2)
+
+    def testWriteIsqRoundTrip(self):
+        """Test that ISQ files written from temporary images and slabs read back unchanged."""
+        import tempfile
+        import numpy as np
+        import SimpleITK as sitk
+        from ToothAnalyserMicroCTLib.Algorithms.Scanco import isq_to_image, read_isq_header, write_isq
+
+        array = (np.arange(20 * 30 * 40) % 64).astype(np.int16).reshape(20, 30, 40)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            isqPath = os.path.join(tmpdir, "roundtrip.isq")
+            # no reference to the images is kept outside of write_isq
+            sources = [
+                lambda: sitk.GetImageFromArray(array),
+                lambda: (sitk.GetImageFromArray(array[z:z + 6]) for z in range(0, 20, 6)),
+            ]
+            for source in sources:
+                write_isq(isqPath, source(), spacing=(0.01, 0.01, 0.01), slab_size=7)
+                np.testing.assert_array_equal(sitk.GetArrayFromImage(isq_to_image(isqPath)), array)
+                self.assertEqual(read_isq_header(isqPath)["grey_range"], (0, 63))
+
+    def testStitchIsqRoundTrip(self):
+        """Test that overlapping ISQ blocks are stitched back into the scan they were cut from."""
+        import tempfile
+        import numpy as np
+        import SimpleITK as sitk
+        from ToothAnalyserMicroCTLib.Algorithms.Scanco import isq_to_image, write_isq
+        from ToothAnalyserMicroCTLib.tha.util import stitch_isq
+
+        rng = np.random.default_rng(0)
+        array = rng.integers(0, 1000, (28, 16, 16)).astype(np.int16)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            blocks = []
+            for i, (first, last) in enumerate([(0, 12), (10, 22), (18, 28)]):
+                blocks.append(os.path.join(tmpdir, f"block{i}.isq"))
+                write_isq(blocks[-1], sitk.GetImageFromArray(array[first:last]), spacing=(0.01, 0.01, 0.01))
+
+            for outName, read in (("scan.mha", sitk.ReadImage), ("scan.mhd", sitk.ReadImage), ("scan.isq", isq_to_image)):
+                outPath = os.path.join(tmpdir, outName)
+                for overlaps in ([2, 4], None):
+                    self.assertEqual(stitch_isq(blocks, outPath, overlaps, slab_size=5), [2, 4])
+                    np.testing.assert_array_equal(sitk.GetArrayFromImage(read(outPath)), array)
+
+            # one overlap per pair of blocks, each smaller than the upper block
+            for overlaps in ([2], [2, 4, 1], [2, 10], [-1, 4]):
+                with self.assertRaises(ValueError):
+                    stitch_isq(blocks, os.path.join(tmpdir, "scan.mha"), overlaps)
+
+    def testThresholdFilterReusesHistogram(self):
+        """Test that thresholds of one image and mask share a single histogram pass."""
+        from unittest.mock import patch
+        import numpy as np
+        import SimpleITK as sitk
+        from ToothAnalyserMicroCTLib.Algorithms.Anatomical import thresholdFilter
+        from ToothAnalyserMicroCTLib.tha import histogram
+
+        rng = np.random.default_rng(0)
+        values = np.concatenate([rng.normal(600, 100, 4000), rng.normal(1500, 200, 4000)])
+        img = sitk.GetImageFromArray(values.astype(np.int16).reshape(8, 20, 50))
+        mask = img > 300
+        with patch.object(histogram, "_value_counts_numba", wraps=histogram._value_counts_numba) as counts:
+            for method in ("Otsu", "Moments", "Yen", "Renyi"):
+                thresholdFilter(img, mask, method, debug=False)
+            self.assertEqual(counts.call_count, 1)
+
+    def testHistogramThresholdsMatchFilters(self):
+        """Test that thresholds from the shared histogram equal those of the SimpleITK filters."""
+        import numpy as np
+        import SimpleITK as sitk
+        from ToothAnalyserMicroCTLib.tha.histogram import threshold
+
+        filters = {
+            "Otsu": sitk.OtsuThresholdImageFilter,
+            "Moments": sitk.MomentsThresholdImageFilter,
+            "Yen": sitk.YenThresholdImageFilter,
+            "Renyi": sitk.RenyiEntropyThresholdImageFilter,
+        }
+        rng = np.random.default_rng(0)
+        values = np.concatenate([rng.normal(60, 20, 5000), rng.normal(160, 30, 4000)]).clip(0, 255)
+        mask = sitk.GetImageFromArray((rng.random((10, 20, 45)) < 0.7).astype(np.uint8))
+        for dtype in (np.uint8, np.int16, np.float32):
+            img = sitk.GetImageFromArray(values.astype(dtype).reshape(10, 20, 45))
+            for method, filterClass in filters.items():
+                for roi in (None, mask):
+                    value = threshold(img, method, roi)
+                    thresholdFilter = filterClass()
+                    thresholdFilter.SetInsideValue(0)
+                    thresholdFilter.SetOutsideValue(1)
+                    if roi is None:
+                        expected, result = thresholdFilter.Execute(img), img > value
+                    else:
+                        thresholdFilter.SetMaskValue(1)
+                        expected, result = thresholdFilter.Execute(img, roi), sitk.Mask(img > value, roi)
+                    self.assertEqual(value, thresholdFilter.GetThreshold(), (dtype, method, roi is not None))
+                    np.testing.assert_array_equal(sitk.GetArrayFromImage(result), sitk.GetArrayFromImage(expected))
+
+    def testRunGraphRunsIndependentStepsConcurrently(self):
+        """Test that runGraph overlaps independent nodes and reports progress in order."""
+        import threading
+        from ToothAnalyserMicroCTLib.Algorithms.utils import runGraph
+
+        started = threading.Event()
+
+        def first():
+            # only returns in time if the second node runs at the same time
+            return started.wait(timeout=10)
+
+        def second():
+            started.set()
+            return 2
+
+        graph = {
+            "c": (lambda a, b: (a, b), ("a", "b"), 3),
+            "a": (first, (), 1),
+            "b": (second, (), 1),
+            ("d", "e"): (lambda c, x: (c, x + 1), ("c", "x"), 2),
+        }
+        *progress, results = runGraph(graph, {"x": 0}, maxWorkers=2)
+        self.assertEqual(progress, [1, 2, 3])
+        self.assertEqual(results["c"], (True, 2))
+        self.assertEqual((results["d"], results["e"]), ((True, 2), 1))
+
+        with self.assertRaises(ValueError):
+            list(runGraph({"a": (lambda b: b, ("b",), None)}))
+        with self.assertRaises(ZeroDivisionError):
+            list(runGraph({"a": (lambda: 1 / 0, (), 1)}))
+
+    def testLeanModeReleasesIntermediates(self):
+        """Test that lean mode releases results nobody needs and keeps the requested labels."""
+        import gc
+        import tempfile
+        import weakref
+        import numpy as np
+        import SimpleITK as sitk
+        from ToothAnalyserMicroCTLib.Algorithms.Anatomical import calcSegmentationGen
+        from ToothAnalyserMicroCTLib.Algorithms.utils import runGraph
+
+        class Result:
+            pass
+
+        intermediate = []
+
+        def produce():
+            result = Result()
+            intermediate.append(weakref.ref(result))
+            return result
+
+        def isReleased(_):
+            gc.collect()
+            return intermediate[0]() is None
+
+        graph = {
+            "a": (produce, (), 1),
+            "b": (lambda a: 1, ("a",), 2),
+            "c": (isReleased, ("b",), 3),
+        }
+        *_, results = runGraph(graph, maxWorkers=1, keep={"c"})
+        self.assertEqual(sorted(results), ["c"])
+        self.assertTrue(results["c"])
+
+        labelsKey = "segmentation_otsu_otsu_labels"
+        with tempfile.TemporaryDirectory() as tmpdir:
+            sourcePath = os.path.join(tmpdir, "tooth.mha")
+            self._writeSyntheticTooth(sourcePath)
+            *progress, full = calcSegmentationGen(sourcePath, "Otsu")
+            *leanProgress, lean = calcSegmentationGen(sourcePath, "Otsu", outputs={labelsKey})
+        self.assertEqual(leanProgress, progress)
+        self.assertEqual(sorted(lean), ["name", "path", labelsKey])
+        labels = sitk.GetArrayFromImage(full[labelsKey])
+        self.assertEqual(set(np.unique(labels)), {0, 2, 3})
+        np.testing.assert_array_equal(sitk.GetArrayFromImage(lean[labelsKey]), labels)
+
+    def testProfileStepsRecordsSteps(self):
+        """Test that profileSteps collects a record for every measured step, also from other threads."""
+        import json
+        import tempfile
+        import threading
+        import SimpleITK as sitk
+        from ToothAnalyserMicroCTLib.Algorithms.utils import measure_time, profileSteps, writeProfile
+
+        @measure_time
+        def castStep(image, pixelType):
+            return sitk.Cast(image, pixelType)
+
+        img = sitk.Image(4, 5, 6, sitk.sitkInt16)
+        castStep(img, sitk.sitkUInt8)
+        with profileSteps() as outer:
+            castStep(img, sitk.sitkUInt8)
+            with profileSteps() as inner:
+                worker = threading.Thread(target=castStep, args=(img, sitk.sitkFloat32))
+                worker.start()
+                worker.join()
+        castStep(img, sitk.sitkUInt8)
+
+        self.assertEqual(len(outer), 2)
+        self.assertEqual(inner, outer[1:])
+        record = inner[0]
+        self.assertEqual(record["step"], "castStep")
+        self.assertEqual(record["inputs"], [{"size": [4, 5, 6], "pixelType": "16-bit signed integer"}])
+        self.assertEqual(record["outputs"], [{"size": [4, 5, 6], "pixelType": "32-bit float"}])
+        self.assertGreaterEqual(record["wallTime"], 0)
+        self.assertGreaterEqual(record["cpuTime"], 0)
+        self.assertEqual(record["itkThreads"], sitk.ProcessObject.GetGlobalDefaultNumberOfThreads())
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            profilePath = os.path.join(tmpdir, "profile.json")
+            writeProfile(outer, profilePath)
+            with open(profilePath, encoding="utf8") as f:
+                self.assertEqual(json.load(f), outer)
+
+    def testSweepSharesPrefixSteps(self):
+        """Test that a sweep reuses the unchanged steps and matches single segmentation runs."""
+        import tempfile
+        import numpy as np
+        import SimpleITK as sitk
+        from ToothAnalyserMicroCTLib.Algorithms.Anatomical import calcSegmentationGen
+        from ToothAnalyserMicroCTLib.tha.sweep import run_sweep, sweep_grid
+
+        with self.assertRaises(ValueError):
+            sweep_grid({"radius": [1]})
+        with self.assertRaises(ValueError):
+            sweep_grid({"filter1": ["Unknown"]})
+
+        labelsKey = "segmentation_otsu_otsu_labels"
+        with tempfile.TemporaryDirectory() as tmpdir:
+            sourcePath = os.path.join(tmpdir, "tooth.mha")
+            self._writeSyntheticTooth(sourcePath)
+            outPath = os.path.join(tmpdir, "sweep")
+            summary = run_sweep(sourcePath, outPath, {"dentinMinSize": [50, 5000]})
+            self.assertEqual(len(summary), 2)
+            self.assertTrue(os.path.isfile(os.path.join(outPath, "tooth_sweep.json")))
+            # only the steps after the changed parameter run again
+            self.assertEqual([record["step"] for record in summary[1]["steps"]], ["dentinLayers", "segmentationLabels"])
+
+            for entry in summary:
+                *_, tooth = calcSegmentationGen(
+                    sourcePath, "Otsu", outputs={labelsKey},
+                    parameters={"dentinMinSize": entry["parameters"]["dentinMinSize"]})
+                labels = sitk.ReadImage(os.path.join(outPath, entry["labels"]))
+                np.testing.assert_array_equal(sitk.GetArrayFromImage(labels), sitk.GetArrayFromImage(tooth[labelsKey]))
+            self.assertNotIn(2, sitk.GetArrayFromImage(labels))
+
+    def testStepCacheHitAndMiss(self):
+        """Test that cached steps are reused for equal inputs and recomputed otherwise."""
+        import tempfile
+        import numpy as np
+        import SimpleITK as sitk
+        from ToothAnalyserMicroCTLib.Algorithms.Anatomical import cachedStep
+
+        calls = []
+
+        def addOne(image):
+            calls.append(image)
+            return image + 1
+
+        array = np.arange(4 * 5 * 6, dtype=np.int16).reshape(4, 5, 6)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            first = cachedStep(tmpdir, {}, addOne, sitk.GetImageFromArray(array))
+            second = cachedStep(tmpdir, {}, addOne, sitk.GetImageFromArray(array))
+            self.assertEqual(len(calls), 1)
+            np.testing.assert_array_equal(sitk.GetArrayFromImage(second), sitk.GetArrayFromImage(first))
+
+            array[0, 0, 0] = -1
+            changed = cachedStep(tmpdir, {}, addOne, sitk.GetImageFromArray(array))
+            self.assertEqual(len(calls), 2)
+            self.assertEqual(sitk.GetArrayFromImage(changed)[0, 0, 0], 0)
+
+            # a damaged entry is computed again instead of failing the pipeline
+            for entry in os.scandir(tmpdir):
+                with open(os.path.join(entry.path, "0.mha"), "r+b") as f:
+                    f.truncate(16)
+            repaired = cachedStep(tmpdir, {}, addOne, sitk.GetImageFromArray(array))
+            self.assertEqual(len(calls), 3)
+            np.testing.assert_array_equal(sitk.GetArrayFromImage(repaired), sitk.GetArrayFromImage(changed))
+
+    def testSourceKeyChangesWithFile(self):
+        """Test that a file edited outside of the sampled fingerprint blocks gets a new step cache key."""
+        import tempfile
+        from ToothAnalyserMicroCTLib.Algorithms.Anatomical import sourceKey
+        from ToothAnalyserMicroCTLib.tha.cache import fingerprint
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            sourcePath = os.path.join(tmpdir, "scan.raw")
+            with open(sourcePath, "wb") as f:
+                f.write(bytes(8 * 1024 * 1024))
+            fileFingerprint, key = fingerprint(sourcePath), sourceKey(sourcePath)
+
+            # the second sampled block starts near 256 KiB and is 64 KiB long
+            with open(sourcePath, "r+b") as f:
+                f.seek(400 * 1024)
+                f.write(b"edited")
+            stat = os.stat(sourcePath)
+            os.utime(sourcePath, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+            self.assertEqual(fingerprint(sourcePath), fileFingerprint)
+            self.assertNotEqual(sourceKey(sourcePath), key)
+            self.assertNotEqual(sourceKey(sourcePath, compress=True), sourceKey(sourcePath))
+
+    def testEnamelHolesInRegion(self):
+        """Test that holes found in a region match the holes of the full image."""
+        import numpy as np
+        import SimpleITK as sitk
+        from ToothAnalyserMicroCTLib.Algorithms.Anatomical import ccMinSize, cropImage, enamelHolesInRegion
+
+        rng = np.random.default_rng(0)
+        fullSize = (20, 18, 16)
+        regions = [
+            ([3, 4, 2], [12, 10, 11]),
+            ([5, 0, 0], [15, 18, 16]),
+            # full extent on x and y, the outside is split into two slabs
+            ([0, 0, 4], [20, 18, 7]),
+            ([0, 0, 0], [20, 18, 16]),
+        ]
+        for index, size in regions:
+            for wall in (False, True):
+                negative = np.ones(fullSize[::-1], dtype=np.uint8)
+                inside = (rng.random(size[::-1]) > 0.55).astype(np.uint8)
+                if wall:
+                    # enamel across the region separates its upper and lower part
+                    inside[size[2] // 2] = 0
+                negative[tuple(slice(i, i + s) for i, s in zip(index[::-1], size[::-1]))] = inside
+                negative = sitk.GetImageFromArray(negative)
+
+                expected = cropImage(ccMinSize(negative, 1) > 1, (index, size))
+                holes = enamelHolesInRegion(cropImage(negative, (index, size)), (index, size), fullSize)
+                np.testing.assert_array_equal(sitk.GetArrayFromImage(holes), sitk.GetArrayFromImage(expected))
+
+    def testComponentsMatchCcMinSize(self):
+        """Test that the run based component selection equals the selection from ccMinSize."""
+        import numpy as np
+        import SimpleITK as sitk
+        from ToothAnalyserMicroCTLib.Algorithms.Anatomical import ccMinSize, cropImage
+        from ToothAnalyserMicroCTLib.tha.components import components_above_size, largest_component
+
+        rng = np.random.default_rng(0)
+        arrays = [(rng.random((12, 17, 23)) < density).astype(np.int16) * 2 for density in (0.2, 0.3, 0.5)]
+        # equal sizes, the component that comes first in the image is the largest one
+        tie = np.zeros((5, 6, 7), dtype=np.int16)
+        tie[1, 1, 1] = tie[3, 4, 5] = 1
+        arrays += [tie, np.zeros((5, 6, 7), dtype=np.int16)]
+        for array in arrays:
+            img = sitk.GetImageFromArray(array)
+            for minSize in (1, 4, 30):
+                np.testing.assert_array_equal(
+                    sitk.GetArrayFromImage(largest_component(img, minSize)),
+                    sitk.GetArrayFromImage(ccMinSize(img, minSize) == 1))
+                np.testing.assert_array_equal(
+                    sitk.GetArrayFromImage(components_above_size(img, minSize)),
+                    sitk.GetArrayFromImage(ccMinSize(img, minSize) > 0))
+
+        # with a region, components are searched inside of it and nothing is selected outside
+        img = sitk.GetImageFromArray(arrays[1])
+        region = ([3, 2, 1], [15, 11, 9])
+        inside = tuple(slice(i, i + s) for i, s in zip(region[0][::-1], region[1][::-1]))
+        largest = sitk.GetArrayFromImage(largest_component(img, 1, region))
+        np.testing.assert_array_equal(largest[inside], sitk.GetArrayFromImage(ccMinSize(cropImage(img, region), 1) == 1))
+        largest[inside] = 0
+        self.assertFalse(largest.any())
+
+    def testDistanceMorphologyMatchesFilters(self):
+        """Test that the distance transform morphology equals the SimpleITK filters with a ball."""
+        import numpy as np
+        import SimpleITK as sitk
+        from ToothAnalyserMicroCTLib.tha import morphology
+
+        rng = np.random.default_rng(0)
+        arrays = [(rng.random((14, 16, 18)) < density).astype(np.uint8) for density in (0.1, 0.5, 0.8)]
+        # a mask touching the image border
+        block = np.zeros((14, 16, 18), dtype=np.uint8)
+        block[:6, 3:12, 5:] = 1
+        arrays.append(block)
+        for array in arrays:
+            img = sitk.GetImageFromArray(array)
+            for radius in (1, 2, 4):
+                cases = [
+                    (morphology.closing, sitk.BinaryMorphologicalClosing(img, [radius] * 3, sitk.sitkBall)),
+                    (morphology.opening, sitk.BinaryMorphologicalOpening(img, [radius] * 3, sitk.sitkBall)),
+                    (morphology.dilate, sitk.BinaryDilate(img, [radius] * 3, sitk.sitkBall)),
+                    (morphology.erode, sitk.BinaryErode(img, [radius] * 3, sitk.sitkBall)),
+                    (morphology.closing_by_reconstruction, sitk.BinaryClosingByReconstruction(img, [radius] * 3)),
+                    (morphology.opening_by_reconstruction, sitk.BinaryOpeningByReconstruction(img, [radius] * 3)),
+                ]
+                for function, expected in cases:
+                    result = function(img, radius)
+                    self.assertEqual(result.GetPixelID(), img.GetPixelID())
+                    np.testing.assert_array_equal(
+                        sitk.GetArrayFromImage(result), sitk.GetArrayFromImage(expected),
+                        f"{function.__name__}, radius {radius}")
@@ -8,6 +8,7 @@ but WITHOUT ANY WARRANTY
 This module contains all the logic related to the 3D Slicer core system
 """
 
+import filecmp
 import logging
 import os
 import sys
@@ -102,6 +103,8 @@ class PreProcessing:
     Pre Processing
     """
     compress: bool
+    stepCache: bool = False
+    stepCacheSize: float = 2.0
 
 @parameterPack
 class AnatomicalParameters:
@@ -121,6 +124,7 @@ class Batch:
     sourcePath: str
     targetPath: str
     fileType: Annotated[str, Choice([".nrrd", ".nii", ".mhd"])] = ".nrrd"
+    writeProfile: bool = False
 
 @parameterNodeWrapper
 class ToothAnalyserMicroCTParameterNode:
@@ -345,9 +349,11 @@ class ToothAnalyserMicroCTWidget(ScriptedLoadableModuleWidget, VTKObservationMix
             self.ui.targetPath.setVisible(True)
             self.ui.label_7.setVisible(True)
             self.ui.fileType.setVisible(True)
+            self.ui.writeProfile.setVisible(True)
             self.ui.sourcePath.enabled = True
             self.ui.targetPath.enabled = True
             self.ui.fileType.enabled = True
+            self.ui.writeProfile.enabled = True
         else:
             self.ui.label_3.setVisible(True)
             self.ui.currentImage.setVisible(True)
@@ -358,9 +364,11 @@ class ToothAnalyserMicroCTWidget(ScriptedLoadableModuleWidget, VTKObservationMix
             self.ui.targetPath.setVisible(False)
             self.ui.label_7.setVisible(False)
             self.ui.fileType.setVisible(False)
+            self.ui.writeProfile.setVisible(False)
             self.ui.sourcePath.enabled = False
             self.ui.targetPath.enabled = False
             self.ui.fileType.enabled = False
+            self.ui.writeProfile.enabled = False
 
     def handleApplyButton(self):
         """
@@ -538,7 +546,7 @@ class AnatomicalSegmentationLogic(ToothAnalyserMicroCTLogic):
     _midSurfaceName: str = "_MedialSurface"
     _stlModelName: str = "_Mesh"
     _segmentNames: list[str] = ["Dentin", "Enamel"]
-    _fileTypes: tuple[str] = (".ISQ", ".mhd", ".nrrd", ".nii")
+    _fileTypes: tuple[str] = (".ISQ", ".AIM", ".mhd", ".nrrd", ".nii")
 
     def __str__(self):
         return "Anatomical Segmentation"
@@ -803,6 +811,22 @@ class AnatomicalSegmentationLogic(ToothAnalyserMicroCTLogic):
         """
         return sitkUtils.PushVolumeToSlicer(img)
 
+    def loadPreviewVolume(self, sourcePath: str, targetVoxels: int, cacheDirectory: Optional[str] = None):
+        """
+        Load the pyramid level of a file that is closest to the given
+        number of voxels into the scene, e.g. for fast previews and
+        parameter tuning on large scans.
+
+        @param sourcePath: the path to the file to be loaded
+        @param targetVoxels: the desired number of voxels, e.g. 256**3
+        @param cacheDirectory: the directory for the pyramid cache, None stores it next to the file
+        @return: the created volume node
+        """
+        from ToothAnalyserMicroCTLib.Algorithms.Anatomical import loadImageLevel
+
+        img, name = loadImageLevel(sourcePath, targetVoxels, cacheDirectory)
+        return sitkUtils.PushVolumeToSlicer(img, None, f"{name}_Preview", "vtkMRMLScalarVolumeNode")
+
     def runSegmentationPipeline(
             self,
             param: ToothAnalyserMicroCTParameterNode,
@@ -817,6 +841,7 @@ class AnatomicalSegmentationLogic(ToothAnalyserMicroCTLogic):
         @return:
         """
         from ToothAnalyserMicroCTLib.Algorithms.Anatomical import calcSegmentationGen
+        from ToothAnalyserMicroCTLib.Algorithms.utils import profileSteps
 
         segmentationType = "otsu"
 
@@ -833,17 +858,28 @@ class AnatomicalSegmentationLogic(ToothAnalyserMicroCTLogic):
             sourcePath=sourcePath,
             selectedAlgorithm="Otsu",
             calcMedialSurfaces=param.anatomical.calcMidSurface,
-            compress=param.pre.compress)
-
-        while True:
-            result = next(segmentationStep)
-
-            if isinstance(result, dict):
-                toothDict = result
-                break
-            else:
-                progressBar.value = result
-                slicer.app.processEvents()
+            compress=param.pre.compress,
+            stepCacheDirectory=(
+                os.path.join(slicer.app.cachePath, "ToothAnalyserMicroCT", "steps")
+                if param.pre.stepCache else None),
+            stepCacheBytes=int(param.pre.stepCacheSize * 1024**3),
+            # lean mode, only the images used below and by writeToothDict are kept
+            outputs={
+                "img",
+                f"segmentation_{segmentationType}_{segmentationType}_labels",
+                f"enamel_{segmentationType}_{segmentationType}_midsurface",
+                f"dentin_{segmentationType}_{segmentationType}_midsurface"})
+
+        with profileSteps() as profile:
+            while True:
+                result = next(segmentationStep)
+
+                if isinstance(result, dict):
+                    toothDict = result
+                    break
+                else:
+                    progressBar.value = result
+                    slicer.app.processEvents()
 
         # provide results in dict
         results = {
@@ -853,7 +889,8 @@ class AnatomicalSegmentationLogic(ToothAnalyserMicroCTLogic):
             "labelImage": toothDict.get(f"segmentation_{segmentationType}_{segmentationType}_labels"),
             "imageName": toothDict.get("name", os.path.basename(sourcePath)),
             "image": toothDict.get("img"),
-            "toothDict": toothDict
+            "toothDict": toothDict,
+            "profile": profile
         }
         return results
 
@@ -930,7 +967,8 @@ class AnatomicalSegmentationLogic(ToothAnalyserMicroCTLogic):
             AnatomicalSegmentationLogic.executeAsBatch(param=self._param)
         """
         from ToothAnalyserMicroCTLib.Algorithms.Anatomical import writeToothDict
-        from ToothAnalyserMicroCTLib.Algorithms.utils import createSTL
+        from ToothAnalyserMicroCTLib.Algorithms.utils import createSTL, writeProfile
+        from ToothAnalyserMicroCTLib.tha.cache import fingerprint
 
         # create local variables for all parameters
         if not os.path.isdir(param.batch.sourcePath):
@@ -955,10 +993,24 @@ class AnatomicalSegmentationLogic(ToothAnalyserMicroCTLogic):
         # Delete the old segmentation to keep order
         self.clearDirectory(targetDirectory)
 
+        seenFingerprints = {}
         for file in files:
             fullFilePath = os.path.join(sourcePath, file)
 
             try:
+                # the fingerprint samples the file, a match is confirmed by comparing all bytes
+                fileFingerprint = fingerprint(fullFilePath)
+                sameFiles = seenFingerprints.setdefault(fileFingerprint, [])
+                duplicate = next((other for other in sameFiles if filecmp.cmp(
+                    os.path.join(sourcePath, other), fullFilePath, shallow=False)), None)
+                if duplicate is not None:
+                    self.warning(f"Skipping '{file}': same scan as '{duplicate}'")
+                    continue
+                if sameFiles:
+                    logging.info("'%s' shares its fingerprint with '%s' but differs, processing it",
+                                 file, "', '".join(sameFiles))
+                sameFiles.append(file)
+
                 segmentationResults = self.runSegmentationPipeline(
                     param=param,
                     progressBar=progressBar,
@@ -976,6 +1028,12 @@ class AnatomicalSegmentationLogic(ToothAnalyserMicroCTLogic):
                     calcMidSurface=param.anatomical.calcMidSurface,
                     fileType=param.batch.fileType)
 
+                if param.batch.writeProfile:
+                    writeProfile(
+                        records=segmentationResults["profile"],
+                        filePath=os.path.join(
+                            targetFileDirectory, f"{segmentationResults['imageName']}_profile.json"))
+
                 if param.anatomical.createMesh:
                     stlFileName = (
                         f"{segmentationResults['imageName']}_"
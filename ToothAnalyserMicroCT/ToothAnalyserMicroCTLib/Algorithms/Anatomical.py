@@ -11,13 +11,23 @@ calculate an anatomical segmentation starting from µCTs
 """
 
 import os
+import importlib
 import logging
+import weakref
+import numpy as np
 import SimpleITK as sitk
 from SimpleITK import Image
 
-from .Scanco import isq_to_mhd_as_string
-from .utils import measure_time
-from ..tha.filtering import downsample_2
+from .Scanco import isq_to_image, aim_to_image
+from .utils import measure_time, runGraph, peakMemory
+from ..tha.filtering import downsample_2, downsample_2_isq
+from ..tha.cache import (chunk_cache_dir, is_chunked, write_chunked, pyramid_dir, read_pyramid_header,
+                         build_pyramid, closest_pyramid_level, load_pyramid_level, fingerprint,
+                         decompressed_file, image_key, step_key, load_step, store_step, evict_steps)
+from ..tha.histogram import threshold as histogramThreshold, binary_mask, image_statistics
+from ..tha import labels as labelAlgebra
+from ..tha.components import largest_component
+from ..tha import morphology
 
 
 def generateToothSetKeys(filter_selection_1: str, filter_selection_2: str) -> set:
@@ -74,16 +84,48 @@ __TOOTH_SET_RENYI_RENYI = generateToothSetKeys('Renyi', 'Renyi')
 
 # ----- Selection of adaptive thresholding methods ----- #
 # not filters, but point operations
-__THRESHOLD_FILTERS = {'Otsu': sitk.OtsuThresholdImageFilter(),
-                     'Huang' : sitk.HuangThresholdImageFilter(),
-                     'MaxEntropy' : sitk.MaximumEntropyThresholdImageFilter(),
-                     'Intermodes' : sitk.IntermodesThresholdImageFilter(),
-                     'IsoData' : sitk.IsoDataThresholdImageFilter(),
-                     'Kittler' : sitk.KittlerIllingworthThresholdImageFilter(),
-                     'Renyi' : sitk.RenyiEntropyThresholdImageFilter(),
-                     'Moments' : sitk.MomentsThresholdImageFilter(),
-                     'Shanbhag' : sitk.ShanbhagThresholdImageFilter(),
-                     'Yen' : sitk.YenThresholdImageFilter()}
+# a new filter is created for every call, so steps can run concurrently
+__THRESHOLD_FILTERS = {'Otsu': sitk.OtsuThresholdImageFilter,
+                     'Huang' : sitk.HuangThresholdImageFilter,
+                     'MaxEntropy' : sitk.MaximumEntropyThresholdImageFilter,
+                     'Intermodes' : sitk.IntermodesThresholdImageFilter,
+                     'IsoData' : sitk.IsoDataThresholdImageFilter,
+                     'Kittler' : sitk.KittlerIllingworthThresholdImageFilter,
+                     'Renyi' : sitk.RenyiEntropyThresholdImageFilter,
+                     'Moments' : sitk.MomentsThresholdImageFilter,
+                     'Shanbhag' : sitk.ShanbhagThresholdImageFilter,
+                     'Yen' : sitk.YenThresholdImageFilter}
+
+
+# ----- Parameters of the segmentation steps ----- #
+__SEGMENTATION_PARAMETERS = {
+    'medianSize': 5,            # size of the median filter in smoothImage
+    'enamelMinSize': 50,        # ccMinSize limit in enamelSelect
+    'preparationMinSize': 10,   # ccMinSize limit in enamelPreparation
+    'fillingMinSize': 10,       # ccMinSize limit in enamelFilling
+    'dentinMinSize': 50,        # ccMinSize limit in dentinLayers
+}
+
+def thresholdMethods() -> list[str]:
+    """
+    This function returns the names of the possible threshold methods
+    @return: the names, e.g. 'Otsu', 'Renyi'
+    """
+    return list(__THRESHOLD_FILTERS)
+
+def segmentationParameters(**overrides) -> dict:
+    """
+    This function returns the parameters of the segmentation steps.
+    The defaults are listed in __SEGMENTATION_PARAMETERS.
+    @param overrides: the parameters that differ from the defaults
+    @return: all parameters of the segmentation steps
+    @example:
+        parameters = segmentationParameters(medianSize=3, dentinMinSize=100)
+    """
+    unknown = set(overrides) - set(__SEGMENTATION_PARAMETERS)
+    if unknown:
+        raise ValueError(f"Unknown segmentation parameters: {sorted(unknown)}")
+    return {**__SEGMENTATION_PARAMETERS, **overrides}
 
 # ----- Name parser -----#
 def parseName(path: str) -> str:
@@ -142,62 +184,116 @@ def parseTyp(path: str) -> str:
 
 
 # ----- Morphological filters ----- #
-def bcbr(img: Image, size: int=10) -> Image:
+# from this size on the distance transform is faster than the ball kernels,
+# the cost of both grows linearly with the number of voxels
+__DISTANCE_MORPHOLOGY_SIZE = 8
+
+def useDistanceMorphology(size: int, backend: str=None) -> bool:
+    """
+    This function decides whether a morphological filter runs as threshold
+    on a distance transform, which costs the same for every size, or with
+    the ball kernels of SimpleITK. Both give the same result.
+    @param size: the size of the filter mask
+    @param backend: 'kernel' or 'distance', None chooses by the size
+    @return: true if the distance transform is used
+    @example:
+        if useDistanceMorphology(10):
+            filteredImage = morphology.closing(image, 10)
+    """
+    if backend is None:
+        return size >= __DISTANCE_MORPHOLOGY_SIZE
+    if backend not in ('kernel', 'distance'):
+        raise ValueError(f"Unknown morphology backend '{backend}', use 'kernel' or 'distance'")
+    return backend == 'distance'
+
+def bcbr(img: Image, size: int=10, backend: str=None) -> Image:
     """
     Filter for closing small holes within the segment (Closing).
     @param img: the image to be filtered
     @param size: the size of the filter mask
+    @param backend: 'kernel' for the SimpleITK filter, 'distance' for thresholds on a
+        distance transform, None chooses by the size (see useDistanceMorphology)
     @return: the filtered image
     @example:
         path = "/data/MicroCT/Original_ISQ/P01A-C0005278.ISQ"
         image = isq_to_mhd(path=path, name="P01A-C0005278.mhd")
         filteredImage = bcbr(img=image, size=10)
     """
+    if useDistanceMorphology(size, backend):
+        return morphology.closing_by_reconstruction(img, size)
     return sitk.BinaryClosingByReconstruction(img, [size, size, size])
 
-def bobr(img: Image, size:int =10) -> Image:
+def bobr(img: Image, size:int =10, backend: str=None) -> Image:
     """
     Filter for removing small structures outside the segment (Opening).
     @param img: the image to be filtered
     @param size: the size of the filter mask
+    @param backend: 'kernel' for the SimpleITK filter, 'distance' for thresholds on a
+        distance transform, None chooses by the size (see useDistanceMorphology)
     @return: the filtered image
     @example:
         path = "/data/MicroCT/Original_ISQ/P01A-C0005278.ISQ"
         image = isq_to_mhd(path=path, name="P01A-C0005278.mhd")
         filteredImage = bobr(img=image, size=10)
     """
+    if useDistanceMorphology(size, backend):
+        return morphology.opening_by_reconstruction(img, size)
     return sitk.BinaryOpeningByReconstruction(img, [size, size, size])
 
-def bmc(img: Image, size: int=1) -> Image:
+def bmc(img: Image, size: int=1, backend: str=None) -> Image:
     """
     Filter for closing small holes within the segment (Closing).
     @param img: the image to be filtered
     @param size: the size of the filter mask
+    @param backend: 'kernel' for the SimpleITK filter, 'distance' for thresholds on a
+        distance transform, None chooses by the size (see useDistanceMorphology)
     @return: the filtered image
     @example:
         path = "/data/MicroCT/Original_ISQ/P01A-C0005278.ISQ"
         image = isq_to_mhd(path=path, name="P01A-C0005278.mhd")
         filteredImage = bmc(img=image, size=1)
     """
+    if useDistanceMorphology(size, backend):
+        return morphology.closing(img, size)
     vectorRadius=(size,size,size)
     kernel=sitk.sitkBall
     return sitk.BinaryMorphologicalClosing(img, vectorRadius, kernel)
 
-def bmo(img: Image, size: int=1) -> Image:
+def bmo(img: Image, size: int=1, backend: str=None) -> Image:
     """
     Filter for removing small structures outside the segment (Opening).
     @param img: the image to be filtered
     @param size: the size of the filter mask
+    @param backend: 'kernel' for the SimpleITK filter, 'distance' for thresholds on a
+        distance transform, None chooses by the size (see useDistanceMorphology)
     @return: the filtered image
     @example:
         path = "/data/MicroCT/Original_ISQ/P01A-C0005278.ISQ"
         image = isq_to_mhd(path=path, name="P01A-C0005278.mhd")
         filteredImage = bmo(img=image, size=1)
     """
+    if useDistanceMorphology(size, backend):
+        return morphology.opening(img, size)
     vectorRadius=(size,size,size)
     kernel=sitk.sitkBall
     return sitk.BinaryMorphologicalOpening(img, vectorRadius, kernel)
 
+def bmd(img: Image, size: int=1, backend: str=None) -> Image:
+    """
+    Filter for growing the segment by the size of the filter mask (Dilation).
+    @param img: the image to be filtered
+    @param size: the size of the filter mask
+    @param backend: 'kernel' for the SimpleITK filter, 'distance' for thresholds on a
+        distance transform, None chooses by the size (see useDistanceMorphology)
+    @return: the filtered image
+    @example:
+        contour = sitk.BinaryContour(tooth) > 0
+        contourExtended = bmd(img=contour, size=2)
+    """
+    if useDistanceMorphology(size, backend):
+        return morphology.dilate(img, size)
+    return sitk.BinaryDilate(img, [size, size, size], sitk.sitkBall)
+
 
 # ----- Smoothing filter Edge preserving ----- #
 def medianFilter(img: Image, size: int=1) -> Image:
@@ -329,8 +425,22 @@ def thresholdFilter(img: Image, mask: Image=None, filter_selection: str= 'Otsu',
      @example:
         threshedImage = threshold_filter(sitk_img, mask=False, filter_selection = 'Renyi', debug=True)
     """
+    # the binary mask is kept per mask, so its histograms are shared by all threshold calls
+    mask_bin = binary_mask(mask) if mask is not None else None
+    # the histogram service computes most thresholds from cached grey value counts
+    thresh_value = histogramThreshold(img, filter_selection, mask_bin)
+    if thresh_value is not None:
+        thresh_img = img > thresh_value
+        if mask_bin is not None:
+            thresh_img = sitk.Mask(thresh_img, mask_bin)
+        elif debug:
+            logging.info("no mask specified")
+        if debug:
+            logging.info("Threshold used: %s", thresh_value)
+        return thresh_img
+
     try:
-        thresh_filter = __THRESHOLD_FILTERS[filter_selection]
+        thresh_filter = __THRESHOLD_FILTERS[filter_selection]()
         thresh_filter.SetInsideValue(0)
         thresh_filter.SetOutsideValue(1)
         if filter_selection == 'Intermodes':
@@ -340,9 +450,8 @@ def thresholdFilter(img: Image, mask: Image=None, filter_selection: str= 'Otsu',
         else:
             pass
             #thresh_filter.SetNumberOfHistogramBins(int(calcHistogramBins(img)))
-        if mask is not None:
+        if mask_bin is not None:
             # binary roi mask
-            mask_bin = sitk.Cast(mask > 0, sitk.sitkUInt8)
             thresh_filter.SetMaskValue(1)
             thresh_img = thresh_filter.Execute(img, mask_bin)
         else:
@@ -412,6 +521,40 @@ def writeToothDict(tooth: dict, path:str, calcMidSurface: bool, fileType: str) -
             write(tooth[key], name + "_" + key, path, fileType)
         else:
             write(tooth[key], name + "_" + key, path, fileType)
+    if tooth.get('path') and os.path.isfile(tooth['path']):
+        writeFingerprint(tooth['path'], name, path)
+
+def writeFingerprint(sourcePath: str, name: str, path: str) -> None:
+    """
+    This method stores the content fingerprint of the source file
+    next to the written results, so they can be recognized as stale
+    once the source changes.
+    @param sourcePath: the source file the results were computed from
+    @param name: the name of the stored results
+    @param path: the storage location in the file system
+    @example:
+        writeFingerprint('/data/P01A-C0005278.ISQ', 'P01A-C0005278', '/results/')
+    """
+    with open(path + name + ".fingerprint", "w", encoding="utf8") as f:
+        f.write(fingerprint(sourcePath))
+
+def isOutputStale(sourcePath: str, name: str, path: str) -> bool:
+    """
+    This method checks whether results stored by writeToothDict
+    belong to the current content of the source file.
+    @param sourcePath: the source file the results were computed from
+    @param name: the name of the stored results
+    @param path: the storage location in the file system
+    @return: true if there are no results or the source has changed
+    @example:
+        if isOutputStale('/data/P01A-C0005278.ISQ', 'P01A-C0005278', '/results/'):
+            writeToothDict(tooth, '/results/', False, '.nii.gz')
+    """
+    fingerprintFile = path + name + ".fingerprint"
+    if not os.path.isfile(fingerprintFile):
+        return True
+    with open(fingerprintFile, "r", encoding="utf8") as f:
+        return f.read().strip() != fingerprint(sourcePath)
 
 def getDirectoryForFile(filePath: str) -> str:
     """
@@ -431,18 +574,31 @@ def getDirectoryForFile(filePath: str) -> str:
 # ----- Load ISQ-File ----- #
 def loadISQ(path: str) -> Image:
     """
-    This methode loads an ISQ-File from a given directory
-    and convert it into an MHD-File by using the
-    isq_to_mhd module from Peter Rösch
+    This methode loads an ISQ-File from a given directory.
+    The grey value block is memory mapped at the offset given
+    in the ISQ header and copied once into the SimpleITK image.
     @param path: the path to the ISQ-File to be loaded
-    @return: The loaded and converted MHD-File
+    @return: The loaded image
     @example:
         path = "/data/MicroCT/Original_ISQ/P01A-C0005278.ISQ"
-        image = isq_to_mhd(path)
-        image -> "P01A-C0005278.mhd"
+        image = loadISQ(path)
     """
-    img = isq_to_mhd_as_string(path)
-    return sitk.ReadImage(img)
+    return isq_to_image(path)
+
+
+# ----- Load AIM-File ----- #
+def loadAIM(path: str) -> Image:
+    """
+    This methode loads an AIM-File from a given directory.
+    The image data is memory mapped at the offset given
+    in the AIM header and copied once into the SimpleITK image.
+    @param path: the path to the AIM-File to be loaded
+    @return: The loaded image
+    @example:
+        path = "/data/MicroCT/Original_AIM/P01A-C0005278.AIM"
+        image = loadAIM(path)
+    """
+    return aim_to_image(path)
 
 
 # ----- Load MHD-File ----- #
@@ -463,18 +619,162 @@ def loadMHD(targetPath: str, name: str) -> Image:
         name = targetPath + name + "MHD.mhd"
     return sitk.ReadImage(name)
 
-def loadFile(path: str) -> Image:
+def loadFile(path: str, cacheDirectory: str = None) -> Image:
     """
-    This methode loads any file with any type into the module
+    This methode loads any file with any type into the module.
+    If a cache directory is given, gzip compressed files (e.g. .nii.gz)
+    are decompressed once into the cache and read from there afterwards.
     @param path: the path to the file to be loaded
+    @param cacheDirectory: the directory for the transcoding cache (optional)
     @return: the loaded Image
     @example:
         path = '/data/MicroCT/Original_ISQ/P01A-C0005278.ISQ'
         image = loadFile(path)
+        image = loadFile('/data/P01A-C0005278.nii.gz', '/tmp/tha_cache')
     """
+    if cacheDirectory is not None and path.lower().endswith(".gz"):
+        path = decompressed_file(path, cacheDirectory)
     return sitk.ReadImage(path)
 
 
+# ----- Region of interest ----- #
+def toothRegion(tooth: Image, padding: int=15) -> tuple:
+    """
+    This methode calculates the bounding box of the tooth mask
+    enlarged by a padding. The padding has to exceed the largest
+    morphological radius used on the region (bcbr with radius 10).
+    @param tooth: the binary tooth mask
+    @param padding: the number of voxels added on each side
+    @return: index and size of the region or None if the mask is empty
+    @example:
+        region = toothRegion(tooth)
+        tooth_cropped = cropImage(tooth, region)
+    """
+    stats = sitk.LabelShapeStatisticsImageFilter()
+    stats.Execute(tooth)
+    if not stats.HasLabel(1):
+        return None
+    box = stats.GetBoundingBox(1)
+    fullSize = tooth.GetSize()
+    lower = [max(b - padding, 0) for b in box[:3]]
+    upper = [min(b + s + padding, n) for b, s, n in zip(box[:3], box[3:], fullSize)]
+    return lower, [u - l for u, l in zip(upper, lower)]
+
+def cropImage(img: Image, region: tuple) -> Image:
+    """
+    This methode extracts a region from an image. The origin
+    of the cropped image is adapted to the region.
+    @param img: the image to be cropped
+    @param region: index and size of the region
+    @return: the cropped image
+    @example:
+        tooth_cropped = cropImage(tooth, toothRegion(tooth))
+    """
+    index, size = region
+    return sitk.RegionOfInterest(img, size, index)
+
+def imageGeometry(img: Image) -> tuple:
+    """
+    This methode collects the geometry of an image, so the image
+    itself can be released before its extent is needed again.
+    @param img: the image
+    @return: size, spacing, origin and direction of the image
+    @example:
+        geometry = imageGeometry(img)
+    """
+    return img.GetSize(), img.GetSpacing(), img.GetOrigin(), img.GetDirection()
+
+def uncropImage(img: Image, region: tuple, geometry: tuple) -> Image:
+    """
+    This methode pastes a cropped image into an empty image
+    with the extent of the full image.
+    @param img: the cropped image
+    @param region: index and size of the region the image was cropped from
+    @param geometry: size, spacing, origin and direction of the full image
+    @return: the image in full extent
+    @example:
+        labels = uncropImage(labels_cropped, region, imageGeometry(img))
+    """
+    if img is None:
+        return None
+    fullSize, spacing, origin, direction = geometry
+    full = sitk.Image(fullSize, img.GetPixelID())
+    full.SetSpacing(spacing)
+    full.SetOrigin(origin)
+    full.SetDirection(direction)
+    index, size = region
+    return sitk.Paste(full, img, size, [0, 0, 0], index)
+
+
+# ----- Step cache ----- #
+# changes of these modules or of SimpleITK invalidate all cached step outputs
+__STEP_MODULES = (
+    '.Anatomical', '.Scanco', '.utils', '..tha.filtering', '..tha.cache', '..tha.histogram',
+    '..tha.labels', '..tha.components', '..tha.morphology', '..tha.dependencies',
+)
+__CODE_VERSION = step_key(
+    sitk.Version_VersionString(),
+    *(fingerprint(importlib.import_module(name, __package__).__file__) for name in __STEP_MODULES),
+)
+
+def sourceKey(path: str, compress: bool=False) -> str:
+    """
+    This methode computes the step cache key of an image loaded from a file.
+    The sampled fingerprint is combined with the size and the modification
+    time of the file, so a scan edited outside of the sampled blocks gets a
+    new key as well.
+    @param path: the path to the loaded file
+    @param compress: true if the image was loaded compressed
+    @return: the key of the loaded image
+    @example:
+        imageKeys[id(img)] = (weakref.ref(img), sourceKey(path))
+    """
+    stat = os.stat(path)
+    return step_key(fingerprint(path), stat.st_size, stat.st_mtime_ns, compress)
+
+def cachedStep(stepCacheDirectory: str, imageKeys: dict, step, *args) -> any:
+    """
+    This methode runs a pipeline step or takes its outputs from the step
+    cache. The outputs are keyed by the step name, the code version, the
+    content of the input images and the remaining arguments. The keys of the
+    output images are kept in imageKeys, so they are not hashed again when
+    they are passed to the next step. The images are only referenced weakly,
+    so they can still be released.
+    @param stepCacheDirectory: the directory of the step cache, None runs the step uncached
+    @param imageKeys: the keys of the images of this run, id(image) -> (weak reference, key)
+    @param step: the pipeline step
+    @param args: the arguments of the step
+    @return: the result of the step
+    @example:
+        imageKeys = {}
+        img_smooth = cachedStep('/tmp/tha_cache/steps', imageKeys, smoothImage, img)
+    """
+    if stepCacheDirectory is None:
+        return step(*args)
+    parts = [step.__name__, __CODE_VERSION]
+    for arg in args:
+        if isinstance(arg, Image):
+            # the id of a released image can be reused by a new one
+            if id(arg) not in imageKeys or imageKeys[id(arg)][0]() is not arg:
+                imageKeys[id(arg)] = (weakref.ref(arg), image_key(arg))
+            parts.append(imageKeys[id(arg)][1])
+        else:
+            parts.append(arg)
+    key = step_key(*parts)
+    outputs = load_step(stepCacheDirectory, key)
+    if outputs is not None:
+        logging.info("%s: Done (cached)", step.__name__)
+        result = outputs if len(outputs) > 1 else outputs[0]
+    else:
+        result = step(*args)
+        outputs = result if isinstance(result, tuple) else (result,)
+        store_step(stepCacheDirectory, key, outputs)
+    for i, output in enumerate(outputs):
+        if isinstance(output, Image):
+            imageKeys[id(output)] = (weakref.ref(output), step_key(key, i))
+    return result
+
+
 # ----- Medial Surface ----- #
 def medialSurface(segment: any) -> any:
     """
@@ -503,26 +803,110 @@ def medialSurface(segment: any) -> any:
 
 # ----- Pipeline methods ----- #
 @measure_time
-def loadImage(path: str) -> tuple[Image, str]:
+def loadImage(path: str, cacheDirectory: str = None) -> tuple[Image, str]:
     """
     This methode loads an image into the algorithm
-    depending on the type.
+    depending on the type. If a cache directory is given, the image
+    is stored there as chunked cache the first time it is loaded, so
+    that sub-volumes can later be read without loading the full scan.
+    The chunked cache is keyed by the sampled fingerprint of the file
+    content (see chunk_cache_dir).
     @param path: the path to the file to be loaded
+    @param cacheDirectory: the directory for the chunked cache, None (default) does not write it
     @returns: the loaded image and the name of the loaded image
     @example:
         img, name = loadImage(path)
+        roi = read_chunked_region(chunk_cache_dir(path, cacheDirectory), index, size)
     """
     name = parseName(path)
     fileType = parseTyp(path)
     try:
         if fileType == "isq":
             img = loadISQ(path)
+        elif fileType == "aim":
+            img = loadAIM(path)
         elif fileType == "mhd":
             img = loadMHD(path, name)
         else:
-            img = loadFile(path)
+            img = loadFile(path, cacheDirectory)
     except:
-        img = loadFile(path)
+        img = loadFile(path, cacheDirectory)
+    if cacheDirectory is not None:
+        chunkDirectory = chunk_cache_dir(path, cacheDirectory)
+        if not is_chunked(chunkDirectory):
+            write_chunked(img, chunkDirectory)
+    return img, name
+
+@measure_time
+def loadImageCompressed(path: str, cacheDirectory: str = None) -> tuple[Image, str]:
+    """
+    This methode loads an image downsampled by a factor of 2 and
+    converted to uint8. ISQ and AIM files are reduced while they are read,
+    so the full resolution volume is never held in memory. If a cache
+    directory is given, the reduced image is taken from the pyramid
+    cache of the file, or stored there for the next run.
+    @param path: the path to the file to be loaded
+    @param cacheDirectory: the directory for the chunked and pyramid cache (optional)
+    @returns: the compressed image and the name of the loaded image
+    @example:
+        img, name = loadImageCompressed(path)
+    """
+    name = parseName(path)
+    img = None
+    pyramidDirectory = None
+    if cacheDirectory is not None:
+        pyramidDirectory = pyramid_dir(path, cacheDirectory)
+        header = read_pyramid_header(pyramidDirectory, path)
+        if header is not None and "1" in header["levels"]:
+            img = load_pyramid_level(pyramidDirectory, 1)
+    if img is None and parseTyp(path) in ("isq", "aim"):
+        try:
+            img = downsample_2_isq(
+                isq_file_name=path,
+                use_median=False,
+                adapt_origin=True
+            )
+        except Exception:
+            logging.warning("Reading '%s' downsampled failed, loading full resolution", path)
+    if img is None:
+        img, name = loadImage(path, cacheDirectory)
+        img = downsample_2(
+            input_image=img,
+            use_median=False,
+            adapt_origin=True
+        )
+    if pyramidDirectory is not None and read_pyramid_header(pyramidDirectory, path) is None:
+        build_pyramid(img, pyramidDirectory, image_level=1, source_file_name=path)
+    if img.GetPixelID() != sitk.sitkUInt8:
+        img = cast8UInt(img)
+    return img, name
+
+@measure_time
+def loadImageLevel(path: str, targetVoxels: int, cacheDirectory: str = None) -> tuple[Image, str]:
+    """
+    This methode loads the resolution level of an image whose number
+    of voxels is closest to the given target. The levels 1/2, 1/4 and 1/8
+    are built once and stored in the pyramid cache of the file.
+    @param path: the path to the file to be loaded
+    @param targetVoxels: the desired number of voxels, e.g. 256**3
+    @param cacheDirectory: the directory for the pyramid cache, None stores it next to the file
+    @returns: the loaded image level and the name of the loaded image
+    @example:
+        preview, name = loadImageLevel(path, 256**3)
+    """
+    name = parseName(path)
+    pyramidDirectory = pyramid_dir(path, cacheDirectory)
+    img = None
+    if read_pyramid_header(pyramidDirectory, path) is None:
+        img, name = loadImage(path)
+        build_pyramid(img, pyramidDirectory, source_file_name=path)
+    level = closest_pyramid_level(pyramidDirectory, targetVoxels)
+    if level == 0:
+        # the full image is only loaded again if the pyramid already existed
+        if img is None:
+            img, name = loadImage(path)
+    else:
+        img = load_pyramid_level(pyramidDirectory, level)
     return img, name
 
 def isSmoothed(image: Image) -> bool:
@@ -531,24 +915,23 @@ def isSmoothed(image: Image) -> bool:
     @param image: the image to be checked
     @return true if the given image is smoothed
     """
-    import numpy as np
-    array = sitk.GetArrayFromImage(image)
-    std_dev = np.std(array)
+    std_dev = image_statistics(image)["std"]
     return 3200.00 > std_dev > 3100.00
 
 @measure_time
-def smoothImage(img: Image) -> Image:
+def smoothImage(img: Image, size: int=5) -> Image:
     """
     This methode apply a median filter on the given image if there
     is no smoothed image in the current directory
     @param img: the image to be smoothed
+    @param size: the size of the median filter
     @return: the smoothed image
     @example:
         img, name = loadImage(path)
         smoothImage = smoothImage(img)
     """
     # apply a median filter on the loaded image with the given size
-    img_smooth = medianFilter(img, 5)
+    img_smooth = medianFilter(img, size)
     return img_smooth
 
 @measure_time
@@ -586,12 +969,13 @@ def smoothImageMask(img_smooth: Image, tooth: Image) -> any:
     return tooth_smooth_masked
 
 @measure_time
-def enamelSelect(filter_selection_1: str, tooth_masked: any, tooth) -> NotImplemented:
+def enamelSelect(filter_selection_1: str, tooth_masked: any, tooth, minSize: int=50) -> NotImplemented:
     """
     This methode extract the enamel area from the rest of the tooth by
     choosing the largest coherent object in the image.
     @param filter_selection_1: the current segmentation typ (e.g. "otsu", "renyi")
     @param tooth_masked: the created tooth mask
+    @param minSize: components below this size are removed
     @return: the extracted enamel from the tooth
     @example:
         enamel_select = enamelSelect(filter_selection_1, tooth_masked)
@@ -604,7 +988,7 @@ def enamelSelect(filter_selection_1: str, tooth_masked: any, tooth) -> NotImplem
     # preparation
     enamel_select = bcbr(enamel_select)
     # largest coherent object
-    enamel_select = ccMinSize(enamel_select, 50) == 1 # war mal 50
+    enamel_select = largest_component(enamel_select, minSize) # war mal 50
     # Enamel segment finished on masked original tooth
     return enamel_select
 
@@ -646,10 +1030,11 @@ def enamelLayering(enamel_select: any, enamel_smooth_select: Image) -> Image:
     return enamel_layers
 
 @measure_time
-def enamelPreparation(enamel_layers: Image) -> NotImplemented:
+def enamelPreparation(enamel_layers: Image, minSize: int=10) -> NotImplemented:
     """
     This methode performs an extended smoothing on the given enamel layer
     @param enamel_layers: the enamel layer to be smooth extended
+    @param minSize: components below this size are removed
     @return: the extended smoothed enamel layer image
     @example:
         enamel_layers_extended_smooth_2 = enamelPreparation(enamel_layers)
@@ -659,22 +1044,34 @@ def enamelPreparation(enamel_layers: Image) -> NotImplemented:
     # comparable to binary opening result, only faster
     enamel_layers_extended_smooth = sitk.SmoothingRecursiveGaussian(enamel_layers_extended_2, 0.04) > 0.7
     enamel_layers_extended_smooth_2 = bmc(enamel_layers_extended_smooth) > 0
-    enamel_layers_extended_smooth_2 = ccMinSize(enamel_layers_extended_smooth_2, 10) == 1  # size = 10
+    enamel_layers_extended_smooth_2 = largest_component(enamel_layers_extended_smooth_2, minSize)  # size = 10
     return enamel_layers_extended_smooth_2
 
 @measure_time
-def enamelFilling(enamel_layers_extended_smooth_2: any, tooth: Image) -> tuple:
+def enamelFilling(enamel_layers_extended_smooth_2: any, tooth: Image, minSize: int=10, fused: bool=True) -> tuple:
     """
     This methode fills up the small structures inside the
     enamel segment in the tooth. This happens on the filtered enamel layer
     @param enamel_layers_extended_smooth_2: the image to be filled
     @param tooth: the image of the tooth that contains the enamel part
+    @param minSize: dentin components below this size are added to the enamel
+    @param fused: evaluates the label algebra in fused kernels if true is given,
+        otherwise with SimpleITK operators (reference)
     @return: the filled and smoothed image
     @example:
         contourExtended, enamelLayersExtendedSmooth3 = enamelFilling(enamelLayersExtendedSmooth2, tooth)
     """
     # extended tooth contour
-    contour_extended = sitk.BinaryDilate((sitk.BinaryContour(tooth) > 0), [2, 2, 2], sitk.sitkBall) > 0
+    contour_extended = bmd(sitk.BinaryContour(tooth) > 0, 2) > 0
+    if fused:
+        # tooth without enamel and thick tooth contour -> dentin and small structures inside tooth
+        dentin_and_partial_decay = labelAlgebra.dentin_candidates(
+            enamel_layers_extended_smooth_2, tooth, contour_extended)
+        # adding everything but the biggest part in dentin to the enamel segment
+        enamel_layers_extended_smooth_3 = labelAlgebra.add_minor_components(
+            enamel_layers_extended_smooth_2, dentin_and_partial_decay,
+            largest_component(dentin_and_partial_decay, minSize))
+        return contour_extended, enamel_layers_extended_smooth_3
     # image background
     background = (~tooth) == 255
     # enamel_layers_extended_smooth_2 + background -> enamel and image background
@@ -683,28 +1080,82 @@ def enamelFilling(enamel_layers_extended_smooth_2: any, tooth: Image) -> tuple:
     # == 255, as the inversion maps the foreground to 255, then Label == 1 again
     dentin_and_partial_decay = (~((((enamel_layers_extended_smooth_2 + background) > 0) + contour_extended) > 0)) == 255
     # biggest part in dentin and smallest structure inside tooth -> dentin
-    dentin_parts = ccMinSize(dentin_and_partial_decay, 10) == 1
+    dentin_parts = ccMinSize(dentin_and_partial_decay, minSize) == 1
     # dentin and small structures inside tooth -> dentin -> small structures inside tooth
     partial_decay = dentin_and_partial_decay - dentin_parts
     # adding the small structures to the enamel segment
     enamel_layers_extended_smooth_3 = enamel_layers_extended_smooth_2 + partial_decay
     return contour_extended, enamel_layers_extended_smooth_3
 
-def additionalEnamelFilling(enamel_layers, enamel_layers_extended_smooth_3):
+def enamelHolesInRegion(enamel_negative: Image, region: tuple, fullSize: tuple) -> Image:
+    """
+    This methode finds the same holes as "ccMinSize(enamel_negative, 1) > 1"
+    would find in the full image, for an image cropped to a region.
+    Everything outside the region belongs to the exterior, which is connected
+    to all components touching a cropped side and has the outside voxels
+    in addition. If only one axis is cropped, on both sides, the outside
+    consists of two slabs that are only connected through the region.
+    @param enamel_negative: everything outside enamel in the region
+    @param region: index and size of the region
+    @param fullSize: the size of the full image
+    @return: the holes as binary image
+    """
+    index, size = region
+    lowerPad = [1 if i > 0 else 0 for i in index]
+    upperPad = [1 if i + s < n else 0 for i, s, n in zip(index, size, fullSize)]
+    padded = sitk.ConstantPad(enamel_negative, lowerPad, upperPad, 1)
+    labelImage = sitk.ConnectedComponent(padded)
+    labels = sitk.GetArrayViewFromImage(labelImage)
+    sizes = np.bincount(labels.ravel())
+    sizes[0] = 0
+    # every padded side holds exterior voxels only, the sides of different axes touch each other
+    croppedAxes = [a for a in range(3) if lowerPad[a] or upperPad[a]]
+    if len(croppedAxes) == 1 and lowerPad[croppedAxes[0]] and upperPad[croppedAxes[0]]:
+        axis = croppedAxes[0]
+        sliceVoxels = int(np.prod(fullSize, dtype=np.int64)) // fullSize[axis]
+        sizes[np.take(labels, 0, axis=2 - axis).flat[0]] += index[axis] * sliceVoxels
+        sizes[np.take(labels, -1, axis=2 - axis).flat[0]] += (
+            fullSize[axis] - index[axis] - size[axis]) * sliceVoxels
+    elif croppedAxes:
+        axis = croppedAxes[0]
+        exteriorLabel = np.take(labels, 0 if lowerPad[axis] else -1, axis=2 - axis).flat[0]
+        sizes[exteriorLabel] += int(np.prod(fullSize, dtype=np.int64)) - labels.size
+    largest = np.argmax(sizes)
+    inner = tuple(slice(l, l + s) for l, s in zip(lowerPad[::-1], size[::-1]))
+    holes = sitk.GetImageFromArray(((labels > 0) & (labels != largest))[inner].astype(np.uint8))
+    holes.CopyInformation(enamel_negative)
+    return holes
+
+def additionalEnamelFilling(enamel_layers, enamel_layers_extended_smooth_3, region: tuple=None,
+                            fullSize: tuple=None, fused: bool=True):
     """
     this method performs an additional filtering of the enamel segment.
     This is needed for the Calculation of the dentin Segment.
     @param enamel_layers:
     @param enamel_layers_extended_smooth_3:
+    @param region: index and size of the region if the images are cropped (optional)
+    @param fullSize: the size of the full image if the images are cropped (optional)
+    @param fused: evaluates the label algebra in fused kernels if true is given,
+        otherwise with SimpleITK operators (reference)
     @return:
     @example:
        enamelLayers = additionalEnamelFilling(enamel_layers, enamel_layers_extended_smooth_3)
     """
     # Inversion enamel -> everything outside enamel
-    enamel_negative = ~enamel_layers_extended_smooth_3 == 255
-    # all connected components -> one large component outside enamel and small components inside enamel
-    # "> 1" -> not the biggest component in enamel -> its a small component
-    holes_enamel = ccMinSize(enamel_negative, 1) > 1
+    if fused:
+        enamel_negative = enamel_layers_extended_smooth_3 == 0
+    else:
+        enamel_negative = ~enamel_layers_extended_smooth_3 == 255
+    if region is not None and tuple(region[1]) != tuple(fullSize):
+        holes_enamel = enamelHolesInRegion(enamel_negative, region, fullSize)
+    elif fused:
+        # every component but the large one outside enamel is added
+        return labelAlgebra.add_minor_components(
+            enamel_layers_extended_smooth_3, enamel_negative, largest_component(enamel_negative))
+    else:
+        # all connected components -> one large component outside enamel and small components inside enamel
+        # "> 1" -> not the biggest component in enamel -> its a small component
+        holes_enamel = ccMinSize(enamel_negative, 1) > 1
     # add small structures
     enamel_layers_extended_smooth_4 = enamel_layers_extended_smooth_3 + holes_enamel
     enamel_layers = enamel_layers_extended_smooth_4
@@ -712,7 +1163,8 @@ def additionalEnamelFilling(enamel_layers, enamel_layers_extended_smooth_3):
     return enamel_layers
 
 @measure_time
-def dentinLayers(contour_extended: Image, enamel_layers: Image, tooth: any) -> any:
+def dentinLayers(contour_extended: Image, enamel_layers: Image, tooth: any, minSize: int=50,
+                 fused: bool=True) -> any:
     """
     This methode calculates the layer Image for the dentin segment
     by using the smoothed image and the already created enamel layer.
@@ -720,33 +1172,44 @@ def dentinLayers(contour_extended: Image, enamel_layers: Image, tooth: any) -> a
     @param contour_extended:
     @param enamel_layers:
     @param tooth:
+    @param minSize: components below this size are removed
+    @param fused: evaluates the label algebra in fused kernels if true is given,
+        otherwise with SimpleITK operators (reference)
     @return:
     @example:
         dentinLayers = dentinLayers(contour_extended, enamel_layers, tooth)
     """
-    # ~tooth -> not tooth -> everything outside tooth
-    # Enamel + everything outside the tooth + thick contour -> everything except dentin
-    not_dentin = enamel_layers + (~tooth == 255) + contour_extended > 0
-    # Inversion everything except dentin -> dentin
-    dentin_layers = (~not_dentin) == 255
-    # Deduction from each other to avoid double assigned voxels
-    dentin_layers = dentin_layers - enamel_layers == 1
+    if fused:
+        # tooth without enamel and thick contour -> dentin
+        dentin_layers = labelAlgebra.dentin_candidates(enamel_layers, tooth, contour_extended)
+    else:
+        # ~tooth -> not tooth -> everything outside tooth
+        # Enamel + everything outside the tooth + thick contour -> everything except dentin
+        not_dentin = enamel_layers + (~tooth == 255) + contour_extended > 0
+        # Inversion everything except dentin -> dentin
+        dentin_layers = (~not_dentin) == 255
+        # Deduction from each other to avoid double assigned voxels
+        dentin_layers = dentin_layers - enamel_layers == 1
     # if individual voxels were still available
-    dentin_layers = ccMinSize(dentin_layers, 50) == 1
+    dentin_layers = largest_component(dentin_layers, minSize)
     return dentin_layers
 
 @measure_time
-def segmentationLabels(dentin_layers: any, enamel_layers: any) -> Image:
+def segmentationLabels(dentin_layers: any, enamel_layers: any, fused: bool=True) -> Image:
     """
     This methode calculates a label image based on the
     given dentin layer and the enamel layer.
     @param dentin_layers: the dentin layer for the label image
     @param enamel_layers: the enamel layer for the label image
+    @param fused: evaluates the label algebra in a fused kernel if true is given,
+        otherwise with SimpleITK operators (reference)
     @return: the calculated label image
     @example:
         segmentationLabels = segmentationLabels(dentinLayers, enamelLayers)
     """
     # Label file, dentin == 2, enamel == 3
+    if fused:
+        return labelAlgebra.segmentation_labels(enamel_layers, dentin_layers)
     segmentation_labels = enamel_layers * 3 + dentin_layers * 2
     return segmentation_labels
 
@@ -777,8 +1240,64 @@ def dentinMedialSurface(dentin_layers: any) -> Image:
     return dentin_midsurface
 
 
+def segmentationGraph(filter_selection_1: str, filter_selection_2: str, runStep, region: tuple = None,
+                      fullSize: tuple = None, calcMedialSurfaces: bool = False, parameters: dict = None) -> dict:
+    """
+    This methode creates the dependency graph of the steps after the tooth
+    mask (5.-12.) for runGraph. The inputs of the graph are 'tooth',
+    'tooth_masked' and 'tooth_smooth_masked'.
+    @param filter_selection_1: the threshold method of the enamel selection (e.g. "Otsu", "Renyi")
+    @param filter_selection_2: the threshold method of the smoothed enamel selection
+    @param runStep: runs a step with its arguments, e.g. through the step cache
+    @param region: index and size of the region if the images are cropped (optional)
+    @param fullSize: the size of the full image if the images are cropped (optional)
+    @param calcMedialSurfaces: adds the medial surfaces for enamel and dentin if true is given
+    @param parameters: the parameters of the steps, see segmentationParameters
+    @return: the graph, name -> (function, names of the dependencies, progress value or None)
+    @example:
+        graph = segmentationGraph('Otsu', 'Otsu', lambda step, *args: step(*args))
+    """
+    parameters = segmentationParameters(**(parameters or {}))
+
+    def step(function, *fixed, trailing=()):
+        return lambda *args: runStep(function, *fixed, *args, *trailing)
+
+    graph = {
+        # 5. select enamel area
+        'enamel_select': (step(enamelSelect, filter_selection_1, trailing=(parameters['enamelMinSize'],)),
+                          ('tooth_masked', 'tooth'), 5),
+        'enamel_smooth_select': (step(enamelSmoothSelect, filter_selection_2), ('tooth_smooth_masked',), 5),
+        # 6. stack the enamels
+        'enamel_layers_stacked': (step(enamelLayering), ('enamel_select', 'enamel_smooth_select'), 6),
+        # 7. Prepare the enamel
+        'enamel_layers_extended_smooth_2': (step(enamelPreparation, trailing=(parameters['preparationMinSize'],)),
+                                            ('enamel_layers_stacked',), 7),
+        # 8. Filling of small structures within the tooth
+        ('contour_extended', 'enamel_layers_extended_smooth_3'): (
+            step(enamelFilling, trailing=(parameters['fillingMinSize'],)),
+            ('enamel_layers_extended_smooth_2', 'tooth'), 8),
+        # 9. Filling of small structures within the tooth, important with many datasets
+        'enamel_layers': (step(additionalEnamelFilling, trailing=(region, fullSize)),
+                          ('enamel_layers_stacked', 'enamel_layers_extended_smooth_3'), 9),
+        # 10. generate dentin segment
+        'dentin_layers': (step(dentinLayers, trailing=(parameters['dentinMinSize'],)),
+                          ('contour_extended', 'enamel_layers', 'tooth'), 10),
+        # 11. generate label file for segmentation
+        'segmentation_labels': (step(segmentationLabels), ('dentin_layers', 'enamel_layers'),
+                                11 if calcMedialSurfaces else None),
+    }
+    # 12. generating medial surface for enamel and dentin if needed
+    if calcMedialSurfaces:
+        graph['enamelMidSurface'] = (step(enamelMedialSurface), ('enamel_layers',), 12)
+        graph['dentinMidSurface'] = (step(dentinMedialSurface), ('dentin_layers',), None)
+    return graph
+
+
 # ----- Calculate Segmentation Pipeline ----- #
-def calcSegmentationGen(sourcePath: str, selectedAlgorithm: str, calcMedialSurfaces: bool = False, compress: bool = False):
+def calcSegmentationGen(sourcePath: str, selectedAlgorithm: str, calcMedialSurfaces: bool = False, compress: bool = False,
+                        cacheDirectory: str = None, crop: bool = True, stepCacheDirectory: str = None,
+                        maxWorkers: int = None, outputs: set = None, parameters: dict = None,
+                        stepCacheBytes: int = 2 * 1024**3):
     """
     This Method combines all segmentation steps and store dem in a dictionary.
     This dictionary can be used in the ToothAnalyserMicroCT core application
@@ -786,102 +1305,126 @@ def calcSegmentationGen(sourcePath: str, selectedAlgorithm: str, calcMedialSurfa
     @param selectedAlgorithm:
     @param calcMedialSurfaces:
     @param compress:
+    @param cacheDirectory: directory for on-disk caches, None disables caching
+    @param crop: run the steps after the tooth mask on the bounding box of the tooth only,
+        the results are pasted back into the full image extent
+    @param stepCacheDirectory: directory for the outputs of the single steps, None disables
+        the step cache. Only steps whose inputs or parameters changed are recomputed.
+    @param stepCacheBytes: the size limit of the step cache, the least recently used steps
+        are removed after the run
+    @param maxWorkers: the maximum number of steps running concurrently, None uses the default
+    @param outputs: the keys of the tooth dictionary to be returned (lean mode), e.g.
+        {'segmentation_otsu_otsu_labels'}. Every other image is released as soon as it is
+        not needed anymore. None returns all keys.
+    @param parameters: the parameters of the steps that differ from the defaults,
+        see segmentationParameters
     @return:
     """
+    # keys of the tooth dictionary
+    filter1 = selectedAlgorithm.lower()
+    filter2 = selectedAlgorithm.lower()
 
-    # 1. load and filter image
-    img, name = loadImage(sourcePath)
-    logging.info("Image pixel type: %s", img.GetPixelIDTypeAsString())
-    yield 1
+    enamel_key = 'enamel_' + filter1
+    enamel_smooth_key = 'enamel_smooth_' + filter2
+    enamel_layers_key = 'enamel_' + filter1 + '_' + filter2 + '_layers'
+    dentin_layers_key = 'dentin_' + filter1 + '_' + filter2 + '_layers'
+    segmentation_labels_key = 'segmentation_' + filter1 + '_' + filter2 + '_labels'
+    enamelMidSurfaceKey = 'enamel_' + filter1 + '_' + filter2 + '_midsurface'
+    dentinMidSurfaceKey = 'dentin_' + filter1 + '_' + filter2 + '_midsurface'
+
+    # tooth dictionary key -> result of the step graph
+    graphKeys = {
+        enamel_key: 'enamel_select',
+        enamel_smooth_key: 'enamel_smooth_select',
+        enamel_layers_key: 'enamel_layers',
+        dentin_layers_key: 'dentin_layers',
+        segmentation_labels_key: 'segmentation_labels',
+        enamelMidSurfaceKey: 'enamelMidSurface',
+        dentinMidSurfaceKey: 'dentinMidSurface'
+    }
+    if outputs is None:
+        outputs = generateToothSetKeys(selectedAlgorithm, selectedAlgorithm)
+    parameters = segmentationParameters(**(parameters or {}))
 
-    # 2. compress if needed
+    # 1. load and filter image, compress while reading if needed
     if compress:
         logging.info("Down sampling image")
-        img = downsample_2(
-            input_image=img,
-            use_median=False,
-            adapt_origin=True,
-            convert_to_uint8=True
-        )
+        img, name = loadImageCompressed(sourcePath, cacheDirectory)
+    else:
+        img, name = loadImage(sourcePath, cacheDirectory)
+    logging.info("Image pixel type: %s", img.GetPixelIDTypeAsString())
+    # the loaded image is keyed by its source, so it is never hashed as a whole
+    imageKeys = {}
+    if stepCacheDirectory is not None:
+        imageKeys[id(img)] = (weakref.ref(img), sourceKey(sourcePath, compress))
+    yield 1
+
+    # 2. compress if needed (already done while loading)
     yield 2
 
     # 3. smoothing image if necessary
     if isSmoothed(img):
         img_smooth = img
     else:
-        img_smooth = smoothImage(img)
+        img_smooth = cachedStep(stepCacheDirectory, imageKeys, smoothImage, img, parameters['medianSize'])
     yield 3
     # 4. extract the tooth from the background
-    tooth, tooth_masked = imageMask(img, img_smooth)
-    tooth_smooth_masked = smoothImageMask(img_smooth, tooth)
+    tooth, tooth_masked = cachedStep(stepCacheDirectory, imageKeys, imageMask, img, img_smooth)
+    geometry = imageGeometry(img)
+    if 'img' not in outputs:
+        img = None
+    tooth_smooth_masked = cachedStep(stepCacheDirectory, imageKeys, smoothImageMask, img_smooth, tooth)
+    if 'img_smooth' not in outputs:
+        img_smooth = None
+    # all following steps only need the padded bounding box of the tooth
+    tooth_full = tooth if 'tooth' in outputs else None
+    region = toothRegion(tooth) if crop else None
+    if region is not None:
+        logging.info("Cropping to tooth region index %s size %s", region[0], region[1])
+        tooth = cropImage(tooth, region)
+        tooth_masked = cropImage(tooth_masked, region)
+        tooth_smooth_masked = cropImage(tooth_smooth_masked, region)
     yield 4
 
-    # 5. select enamel area
-    enamel_select = enamelSelect(selectedAlgorithm, tooth_masked, tooth)
-    enamel_smooth_select = enamelSmoothSelect(selectedAlgorithm, tooth_smooth_masked)
-    yield 5
-
-    # 6. stack the enamels
-    enamel_layers = enamelLayering(enamel_select, enamel_smooth_select)
-    yield 6
-
-    # 7. Prepare the enamel
-    enamel_layers_extended_smooth_2 = enamelPreparation(enamel_layers)
-    yield 7
-
-    # 8. Filling of small structures within the tooth
-    contour_extended, enamel_layers_extended_smooth_3 = enamelFilling(enamel_layers_extended_smooth_2, tooth)
-    yield 8
-
-    # 9. Filling of small structures within the tooth, important with many datasets
-    enamel_layers = additionalEnamelFilling(enamel_layers, enamel_layers_extended_smooth_3)
-    yield 9
-
-    # 10. generate dentin segment
-    dentin_layers = dentinLayers(contour_extended, enamel_layers, tooth)
-    yield 10
-
-    # 11. generate label file for segmentation
-    segmentation_labels = segmentationLabels(dentin_layers, enamel_layers)
-
-    # 12. generating medial surface for enamel and dentin if needed
-    if calcMedialSurfaces:
-        yield 11
-
-        enamelMidSurface = enamelMedialSurface(enamel_layers)
-        yield 12
-
-        dentinMidSurface = dentinMedialSurface(dentin_layers)
-    else:
-        enamelMidSurface = None
-        dentinMidSurface = None
+    # 5.-12. run the remaining steps as dependency graph, independent steps run concurrently
+    graph = segmentationGraph(
+        selectedAlgorithm, selectedAlgorithm,
+        lambda function, *args: cachedStep(stepCacheDirectory, imageKeys, function, *args),
+        region, geometry[0], calcMedialSurfaces, parameters)
+
+    inputs = {'tooth': tooth, 'tooth_masked': tooth_masked, 'tooth_smooth_masked': tooth_smooth_masked}
+    # the graph releases the inputs once their last step is done
+    tooth = tooth_masked = tooth_smooth_masked = None
+    keep = {graphKeys[key] for key in outputs if key in graphKeys}
+    for result in runGraph(graph, inputs, maxWorkers, keep):
+        if isinstance(result, dict):
+            results = result
+        else:
+            yield result
+    inputs = None
+    if stepCacheDirectory is not None:
+        # no step reads the cache anymore
+        evict_steps(stepCacheDirectory, stepCacheBytes)
 
     # 13. generate tooth dictionary to store all generated data sets local
-    filter1 = selectedAlgorithm.lower()
-    filter2 = selectedAlgorithm.lower()
-
-    enamel_key = 'enamel_' + filter1
-    enamel_smooth_key = 'enamel_smooth_' + filter2
-    enamel_layers_key = 'enamel_' + filter1 + '_' + filter2 + '_layers'
-    dentin_layers_key = 'dentin_' + filter1 + '_' + filter2 + '_layers'
-    segmentation_labels_key = 'segmentation_' + filter1 + '_' + filter2 + '_labels'
-    enamelMidSurfaceKey = 'enamel_' + filter1 + '_' + filter2 + '_midsurface'
-    dentinMidSurfaceKey = 'dentin_' + filter1 + '_' + filter2 + '_midsurface'
-
     tooth_dict = {
         'path': sourcePath,
         'name': name,
         'img': img,
         'img_smooth': img_smooth,
-        'tooth': tooth,
-        enamel_key: enamel_select,
-        enamel_smooth_key: enamel_smooth_select,
-        enamel_layers_key: enamel_layers,
-        dentin_layers_key: dentin_layers,
-        segmentation_labels_key: segmentation_labels,
-        enamelMidSurfaceKey: enamelMidSurface,
-        dentinMidSurfaceKey: dentinMidSurface
+        'tooth': tooth_full,
     }
+    for key, graphKey in graphKeys.items():
+        result = results.pop(graphKey, None)
+        if region is not None:
+            result = uncropImage(result, region, geometry)
+        tooth_dict[key] = result
+    result = None
+    tooth_dict = {key: value for key, value in tooth_dict.items() if key in ('path', 'name') or key in outputs}
+
+    peak = peakMemory()
+    if peak is not None:
+        logging.info("Peak memory: %.2f GB", peak / 1024**3)
 
     #writeToothDict(
     #    tooth=tooth_dict,
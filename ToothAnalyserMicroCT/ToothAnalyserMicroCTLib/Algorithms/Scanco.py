@@ -35,6 +35,7 @@ import os
 import sys
 from collections import OrderedDict
 import numpy as np
+import SimpleITK as sitk
 from io import StringIO
 
 
@@ -54,6 +55,14 @@ __ISQ_OFFSETS_INT_4 = {
     'data_offset': -1
 }
 
+# numpy types of the supported AIM data types
+__AIM_DATA_TYPES = {
+    0x00010001: np.dtype('i1'),
+    0x00160001: np.dtype('u1'),
+    0x00020002: np.dtype('<i2'),
+    0x001a0004: np.dtype('<f4'),
+}
+
 # Default values for mhd file parameters
 __MHD_DEFAULTS = OrderedDict([
     ('ObjectType', 'Image'),
@@ -147,6 +156,336 @@ def isq_to_mhd_as_string(isq_file_name) -> str:
     return mhd_buffer.getvalue()
 
 
+def read_isq_header(isq_file_name) -> dict:
+    """
+        Read the geometry of an ISQ file without loading grey value data.
+        ARGS:
+            isq_file_name (str): full path name of isq image file
+        RETURNS:
+            dict: size (x, y, z), spacing in mm (x, y, z), origin,
+                offset of the data part in bytes, grey value range
+                and numpy dtype of the grey values
+    """
+    mhd_param, offset, grey_range = _read_isq_param(isq_file_name)
+    return {
+        'size': tuple(int(v) for v in mhd_param['DimSize'].split()),
+        'spacing': tuple(float(v) for v in mhd_param['ElementSpacing'].split()),
+        'origin': (0.0, 0.0, 0.0),
+        'offset': int(offset),
+        'grey_range': (int(grey_range[0]), int(grey_range[1])),
+        'dtype': np.dtype('<i2'),
+    }
+
+
+def isq_to_array(isq_file_name, mode='r') -> np.memmap:
+    """
+        Map the grey value block of an ISQ file into memory.
+        No data is read until the array is accessed, so slicing the
+        result only touches the pages that are actually needed.
+        ARGS:
+            isq_file_name (str): full path name of isq image file
+            mode (str): np.memmap access mode, default is read only
+        RETURNS:
+            np.memmap: int16 array of shape (z, y, x)
+    """
+    return _map_data(isq_file_name, read_isq_header(isq_file_name), mode)
+
+
+def _map_data(file_name, header, mode='r') -> np.memmap:
+    """Map the data part described by a header dict into memory."""
+    return np.memmap(
+        file_name,
+        dtype=header['dtype'],
+        mode=mode,
+        offset=header['offset'],
+        shape=header['size'][::-1]
+    )
+
+
+def _decode_vax_float(data) -> np.ndarray:
+    """Decode VAX F-floats as used by AIM V020 headers."""
+    b = np.frombuffer(data, dtype=np.uint8).reshape(-1, 4).astype(np.uint32)
+    bits = (b[:, 0] << 16) | (b[:, 1] << 24) | b[:, 2] | (b[:, 3] << 8)
+    return bits.view(np.float32) * 0.25
+
+
+def read_aim_header(aim_file_name) -> dict:
+    """
+        Read the geometry of an AIM file without loading the image data.
+        AIM V020 (32 bit header fields, VAX float element size) and
+        AIM V030 (64 bit header fields) headers are supported.
+        ARGS:
+            aim_file_name (str): full path name of aim image file
+        RETURNS:
+            dict: size (x, y, z), spacing in mm (x, y, z), origin,
+                offset of the data part in bytes, grey value range (None)
+                and numpy dtype of the voxels
+    """
+    with open(aim_file_name, 'rb') as aim_file:
+        magic = aim_file.read(16)
+        if magic.startswith(b'AIMDATA_V030'):
+            int_type, magic_size = np.dtype('<i8'), 16
+        else:
+            int_type, magic_size = np.dtype('<i4'), 0
+        aim_file.seek(magic_size)
+        pre_header = np.frombuffer(aim_file.read(5 * int_type.itemsize), int_type)
+        pre_header_size, struct_size, log_size = (int(v) for v in pre_header[:3])
+        aim_file.seek(magic_size + pre_header_size)
+        struct = aim_file.read(struct_size)
+    # image structure: 6 fields, then pos, dim, off, supdim, suppos,
+    # subdim, testoff (3 values each), then the element size
+    data_type = int(np.frombuffer(struct[20:24], '<i4')[0])
+    if int_type.itemsize == 4:
+        values = np.frombuffer(struct[24:108], '<i4')
+        element_size = _decode_vax_float(struct[108:120])
+    else:
+        values = np.frombuffer(struct[24:192], '<i8')
+        element_size = np.frombuffer(struct[192:216], '<i8') * 1e-6
+    if data_type not in __AIM_DATA_TYPES:
+        raise ValueError(f"Unsupported AIM data type 0x{data_type:08x}")
+    spacing = tuple(float(s) for s in element_size)
+    return {
+        'size': tuple(int(v) for v in values[3:6]),
+        'spacing': spacing,
+        'origin': tuple(float(p) * s for p, s in zip(values[0:3], spacing)),
+        'offset': magic_size + pre_header_size + struct_size + log_size,
+        'grey_range': None,
+        'dtype': __AIM_DATA_TYPES[data_type],
+    }
+
+
+def aim_to_array(aim_file_name, mode='r') -> np.memmap:
+    """
+        Map the image data of an AIM file into memory.
+        ARGS:
+            aim_file_name (str): full path name of aim image file
+            mode (str): np.memmap access mode, default is read only
+        RETURNS:
+            np.memmap: array of shape (z, y, x)
+    """
+    return _map_data(aim_file_name, read_aim_header(aim_file_name), mode)
+
+
+def read_scanco_header(file_name) -> dict:
+    """
+        Read the header of an ISQ or AIM file depending on its suffix.
+        ARGS:
+            file_name (str): full path name of isq or aim image file
+        RETURNS:
+            dict: see read_isq_header
+    """
+    if file_name.lower().endswith('.aim'):
+        return read_aim_header(file_name)
+    return read_isq_header(file_name)
+
+
+def scanco_to_array(file_name, mode='r') -> np.memmap:
+    """
+        Map the data part of an ISQ or AIM file into memory.
+        ARGS:
+            file_name (str): full path name of isq or aim image file
+            mode (str): np.memmap access mode, default is read only
+        RETURNS:
+            np.memmap: array of shape (z, y, x)
+    """
+    return _map_data(file_name, read_scanco_header(file_name), mode)
+
+
+def array_to_image(array, spacing, origin=(0.0, 0.0, 0.0)) -> sitk.Image:
+    """
+        Copy a (z, y, x) array into a SimpleITK image with the given geometry.
+        Only the given array is copied, so views of a mapped file
+        materialise just the selected region.
+        ARGS:
+            array (np.ndarray): grey values in (z, y, x) order
+            spacing (tuple): element spacing in mm (x, y, z)
+            origin (tuple): physical position of the first voxel (x, y, z)
+        RETURNS:
+            sitk.Image: image holding a copy of the array
+    """
+    image = sitk.GetImageFromArray(np.ascontiguousarray(array))
+    image.SetSpacing(tuple(float(s) for s in spacing))
+    image.SetOrigin(tuple(float(o) for o in origin))
+    return image
+
+
+def isq_to_image(isq_file_name) -> sitk.Image:
+    """
+        Load an ISQ file through the memory mapped grey value block.
+        ARGS:
+            isq_file_name (str): full path name of isq image file
+        RETURNS:
+            sitk.Image: int16 image with spacing taken from the ISQ header
+    """
+    header = read_isq_header(isq_file_name)
+    return array_to_image(
+        isq_to_array(isq_file_name), header['spacing'], header['origin'])
+
+
+def aim_to_image(aim_file_name) -> sitk.Image:
+    """
+        Load an AIM file through the memory mapped image data.
+        ARGS:
+            aim_file_name (str): full path name of aim image file
+        RETURNS:
+            sitk.Image: image with geometry taken from the AIM header
+    """
+    header = read_aim_header(aim_file_name)
+    return array_to_image(
+        aim_to_array(aim_file_name), header['spacing'], header['origin'])
+
+
+def isq_crop(isq_file_name, index, size) -> sitk.Image:
+    """
+        Read an index bounding box from an ISQ or AIM file.
+        Only the rows of the requested slices that overlap the box are
+        read from disk, the rest of the grey value block is not touched.
+        ARGS:
+            isq_file_name (str): full path name of isq or aim image file
+            index (tuple): first voxel of the box (x, y, z)
+            size (tuple): extent of the box in voxels (x, y, z)
+        RETURNS:
+            sitk.Image: cropped image, origin adjusted to the box position
+    """
+    header = read_scanco_header(isq_file_name)
+    dims = header['size']
+    for i in range(3):
+        if size[i] < 1 or index[i] < 0 or index[i] + size[i] > dims[i]:
+            raise ValueError(
+                f"Crop box index {tuple(index)} size {tuple(size)} "
+                f"exceeds image size {dims}")
+    array = scanco_to_array(isq_file_name)
+    region = array[
+        index[2]:index[2] + size[2],
+        index[1]:index[1] + size[1],
+        index[0]:index[0] + size[0]
+    ]
+    spacing = header['spacing']
+    origin = tuple(
+        header['origin'][i] + index[i] * spacing[i] for i in range(3))
+    return array_to_image(region, spacing, origin)
+
+
+def isq_preview(isq_file_name, step=4) -> sitk.Image:
+    """
+        Read a low resolution preview of an ISQ or AIM file by strided access.
+        Only every step-th slice, row and voxel is copied from the mapped
+        grey value block, no filtering is applied.
+        ARGS:
+            isq_file_name (str): full path name of isq or aim image file
+            step (int): sampling step along every axis
+        RETURNS:
+            sitk.Image: preview image with spacing scaled by step
+    """
+    if step < 1:
+        raise ValueError("step must be at least 1")
+    header = read_scanco_header(isq_file_name)
+    array = scanco_to_array(isq_file_name)
+    spacing = tuple(s * step for s in header['spacing'])
+    return array_to_image(array[::step, ::step, ::step], spacing, header['origin'])
+
+
+def isq_slabs(isq_file_name, slab_size=64, halo=0):
+    """
+        Iterate over an ISQ or AIM volume in z-slabs with a halo of extra slices.
+        Only one slab including its halo is held in memory at a time.
+        The halo is clipped at the first and last slice of the volume.
+        ARGS:
+            isq_file_name (str): full path name of isq or aim image file
+            slab_size (int): number of slices per slab without halo
+            halo (int): number of neighbouring slices added on each side
+        YIELDS:
+            tuple of
+                sitk.Image: slab including its halo, origin and spacing
+                    set according to the position in the volume
+                slice: z range of the slab core relative to the slab image
+                slice: z range of the slab core in the full volume
+    """
+    if slab_size < 1:
+        raise ValueError("slab_size must be at least 1")
+    if halo < 0:
+        raise ValueError("halo must not be negative")
+    header = read_scanco_header(isq_file_name)
+    array = scanco_to_array(isq_file_name)
+    spacing = header['spacing']
+    origin = header['origin']
+    dim_z = array.shape[0]
+    for z_start in range(0, dim_z, slab_size):
+        z_stop = min(z_start + slab_size, dim_z)
+        read_start = max(z_start - halo, 0)
+        read_stop = min(z_stop + halo, dim_z)
+        slab_origin = (origin[0], origin[1], origin[2] + read_start * spacing[2])
+        slab = array_to_image(array[read_start:read_stop], spacing, slab_origin)
+        core = slice(z_start - read_start, z_stop - read_start)
+        yield slab, core, slice(z_start, z_stop)
+
+
+def write_isq(isq_file_name, source, spacing=None, mu_scaling=4096, slab_size=64) -> None:
+    """
+        Write an ISQ file slab by slab.
+        The header is completed after the last slab, so dimensions and
+        grey value range are taken from the data that was written.
+        Grey values are clipped to the int16 range.
+        ARGS:
+            isq_file_name (str): full path name of isq image file to be written
+            source: sitk.Image or an iterable of z-slabs, each slab given as
+                sitk.Image or numpy array in (z, y, x) order
+            spacing (tuple): element spacing in mm (x, y, z). Default is None
+                in which case the spacing of the image or first slab is used
+            mu_scaling (int): scaling of grey values to linear attenuation
+            slab_size (int): number of slices written at once for image input
+    """
+    if isinstance(source, sitk.Image):
+        if spacing is None:
+            spacing = source.GetSpacing()
+        # keep the image bound, its buffer is freed with the last reference
+        image = source
+        array = sitk.GetArrayViewFromImage(image)
+        source = (array[z:z + slab_size] for z in range(0, array.shape[0], slab_size))
+    int16_info = np.iinfo(np.int16)
+    dim_x, dim_y, dim_z = 0, 0, 0
+    grey_min, grey_max = int16_info.max, int16_info.min
+    with open(isq_file_name, 'wb') as out_file:
+        out_file.write(bytes(512))
+        for slab in source:
+            if isinstance(slab, sitk.Image):
+                if spacing is None:
+                    spacing = slab.GetSpacing()
+                slab_image = slab
+                slab = sitk.GetArrayViewFromImage(slab_image)
+            if dim_z == 0:
+                dim_y, dim_x = slab.shape[1], slab.shape[2]
+            elif slab.shape[1:] != (dim_y, dim_x):
+                raise ValueError("All slabs must have the same x and y size")
+            slab = np.clip(slab, int16_info.min, int16_info.max).astype('<i2')
+            grey_min = min(grey_min, int(slab.min()))
+            grey_max = max(grey_max, int(slab.max()))
+            dim_z += slab.shape[0]
+            out_file.write(slab.tobytes())
+        if spacing is None:
+            raise ValueError("spacing is required for array slabs")
+        nr_of_bytes = out_file.tell()
+        spacing_um = [s * 1000. for s in spacing]
+        header = np.zeros(128, dtype='<i4')
+        header[4] = 3  # data type: short
+        header[5] = nr_of_bytes
+        header[6] = (nr_of_bytes + 511) // 512
+        header[__ISQ_OFFSETS_INT_4['dimx_p']:__ISQ_OFFSETS_INT_4['dimz_p'] + 1] = (dim_x, dim_y, dim_z)
+        header[__ISQ_OFFSETS_INT_4['dimx_um']:__ISQ_OFFSETS_INT_4['dimz_um'] + 1] = [
+            round(d * s) for d, s in zip((dim_x, dim_y, dim_z), spacing_um)]
+        header[__ISQ_OFFSETS_INT_4['slice_thickness']] = round(spacing_um[2])
+        header[__ISQ_OFFSETS_INT_4['slice_increment_um']] = round(spacing_um[2])
+        header[__ISQ_OFFSETS_INT_4['min_data_value']] = grey_min
+        header[__ISQ_OFFSETS_INT_4['max_data_value']] = grey_max
+        header[__ISQ_OFFSETS_INT_4['mu_scaling']] = mu_scaling
+        # grey values start directly after the first header block
+        header[__ISQ_OFFSETS_INT_4['data_offset']] = 0
+        header_bytes = bytearray(header.tobytes())
+        header_bytes[:16] = b'CTDATA-HEADER_V1'
+        out_file.seek(0)
+        out_file.write(header_bytes)
+
+
 def main():
     """Run CLI conversion from ISQ to MHD using command-line arguments."""
     if len(sys.argv) != 3:
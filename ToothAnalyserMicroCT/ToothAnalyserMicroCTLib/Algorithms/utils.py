@@ -13,35 +13,200 @@ Author
 Lukas Konietzka, lukas.konietzka@tha.de
 """
 
+import contextlib
+import json
 import logging
+import threading
 
+# record lists of the active profiles, see profileSteps
+__PROFILES = []
+__PROFILES_LOCK = threading.Lock()
+
+
+def imageInfo(values) -> list:
+    """
+    This function describes the images among the given values
+    @param values: a value or a sequence of values, e.g. the arguments or the result of a step
+    @return: size and pixel type of every image in the values
+    """
+    import SimpleITK as sitk
+    if not isinstance(values, (tuple, list)):
+        values = (values,)
+    return [
+        {"size": list(value.GetSize()), "pixelType": value.GetPixelIDTypeAsString()}
+        for value in values if isinstance(value, sitk.Image)
+    ]
 
 
 def measure_time(func):
     """
-    This function is a decorator to measure the
-    runtime of a method
+    This function is a decorator to profile a pipeline step. It logs
+    the runtime and records wall and CPU time, the increase of the peak
+    memory, the input and output images and the number of ITK threads
+    in every active profile, see profileSteps. The CPU time is the one of
+    the process, so it includes steps running at the same time.
     @param func:
     @return:
     """
     import time
     import functools
+    import SimpleITK as sitk
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        start = time.time()
+        start = time.perf_counter()
+        cpuStart = time.process_time()
+        peakStart = peakMemory()
         result = func(*args, **kwargs)
-        stop = time.time()
+        elapsed = time.perf_counter() - start
+        cpuTime = time.process_time() - cpuStart
+        peakStop = peakMemory()
+        peakDelta = None if peakStart is None else peakStop - peakStart
 
-        elapsed = stop - start
         minutes = int(elapsed // 60)
         seconds = int(elapsed % 60)
-
         logging.info("%s: Done %d:%02d minutes", func.__name__, minutes, seconds)
+
+        record = {
+            "step": func.__name__,
+            "wallTime": elapsed,
+            "cpuTime": cpuTime,
+            "peakMemoryDelta": peakDelta,
+            "inputs": imageInfo(list(args) + list(kwargs.values())),
+            "outputs": imageInfo(result),
+            "itkThreads": sitk.ProcessObject.GetGlobalDefaultNumberOfThreads(),
+        }
+        with __PROFILES_LOCK:
+            for records in __PROFILES:
+                records.append(record)
         return result
 
     return wrapper
 
 
+@contextlib.contextmanager
+def profileSteps():
+    """
+    This function is a context manager that collects the records of all
+    steps decorated with measure_time, also of steps running in other threads.
+    @return: the list of records, one dictionary per step
+    @example:
+        with profileSteps() as profile:
+            *progress, toothDict = calcSegmentationGen(path, 'Otsu')
+        writeProfile(profile, '/results/P01A-C0005278_profile.json')
+    """
+    records = []
+    with __PROFILES_LOCK:
+        __PROFILES.append(records)
+    try:
+        yield records
+    finally:
+        with __PROFILES_LOCK:
+            __PROFILES.remove(records)
+
+
+def writeProfile(records: list, filePath: str) -> None:
+    """
+    This function stores the records of a profile as JSON file
+    @param records: the records collected by profileSteps
+    @param filePath: the path of the JSON file
+    @example:
+        writeProfile(profile, '/results/P01A-C0005278_profile.json')
+    """
+    with open(filePath, "w", encoding="utf8") as f:
+        json.dump(records, f, indent=1)
+
+
+def runGraph(graph: dict, inputs: dict = None, maxWorkers: int = None, keep: set = None):
+    """
+    This function is a generator that runs the nodes of a dependency
+    graph on a thread pool. A node is started as soon as all nodes it
+    depends on are done, so independent nodes run concurrently.
+    Progress values are yielded once and in increasing order, as soon as
+    all nodes with this or a smaller progress value are done. At last the
+    results of all nodes are yielded as dictionary. If the results to keep
+    are named, every other result is released as soon as its last consumer
+    is done.
+    @param graph: name -> (function, names of the dependencies, progress value or None).
+        The function is called with the results of the dependencies. A tuple
+        of names stores the items of a returned tuple under these names.
+    @param inputs: name -> value of the data the nodes can depend on (optional)
+    @param maxWorkers: the maximum number of concurrent nodes, None uses the default of the thread pool
+    @param keep: the names of the results to be yielded, None keeps all results
+    @return:
+    @example:
+        graph = {
+            'a': (lambda: 1, (), 1),
+            'b': (lambda: 2, (), 2),
+            'c': (lambda a, b: a + b, ('a', 'b'), 3),
+        }
+        *progress, results = runGraph(graph)
+        results['c'] -> 3
+    """
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+    results = dict(inputs or {})
+    pending = dict(graph)
+    running = {}
+    finished = set()
+    progress = sorted((node[2], str(name), name) for name, node in graph.items() if node[2] is not None)
+    consumers = {}
+    for _, dependencies, _ in graph.values():
+        for dependency in dependencies:
+            consumers[dependency] = consumers.get(dependency, 0) + 1
+
+    def release(name) -> None:
+        if keep is not None and name not in keep and consumers.get(name, 0) == 0:
+            results.pop(name, None)
+
+    def isReady(name) -> bool:
+        return all(dependency in results for dependency in pending[name][1])
+
+    with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+        while pending or running:
+            for name in [name for name in pending if isReady(name)]:
+                function, dependencies, _ = pending.pop(name)
+                running[executor.submit(function, *(results[d] for d in dependencies))] = name
+            if not running:
+                raise ValueError(f"Unresolvable dependencies in graph: {sorted(pending, key=str)}")
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                # raises the exception of a failed node
+                result = future.result()
+                outputs = name if isinstance(name, tuple) else (name,)
+                results.update(zip(outputs, result if isinstance(name, tuple) else (result,)))
+                finished.add(name)
+                for dependency in graph[name][1]:
+                    consumers[dependency] -= 1
+                    release(dependency)
+                for output in outputs:
+                    release(output)
+            # the futures hold their results as well
+            done = future = result = None
+            while progress and progress[0][2] in finished:
+                value = progress.pop(0)[0]
+                if not progress or progress[0][0] != value:
+                    yield value
+    yield results
+
+
+def peakMemory() -> int:
+    """
+    This function returns the peak resident memory of the process
+    @return: the peak memory in bytes, None if it is not available (Windows)
+    @example:
+        logging.info("Peak memory: %.2f GB", peakMemory() / 1024**3)
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    import sys
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
 def createSTL(
     labelImage,
     outputDirectory: str,
@@ -0,0 +1,646 @@
+"""
+ToothAnalyserMicroCTLib.tha.cache
+=================================
+
+This module provides on-disk caches for large µCT volumes.
+
+A chunked cache stores a volume as a directory of zlib compressed,
+fixed-size 3D chunks plus a JSON header holding the image geometry.
+Any sub-volume can be read by decompressing only the chunks it overlaps.
+Chunks that contain zeros only are not stored at all. It is opt-in, the
+loaders only write it when they are given a cache directory.
+
+A pyramid cache stores the 1/2, 1/4, 1/8, ... resolution levels of a scan
+so that previews and compressed runs do not recompute the reduction.
+
+A transcoding cache keeps an uncompressed copy of gzip compressed inputs
+such as .nii.gz, so they are decompressed once instead of on every load.
+
+All caches above are keyed by a sampled content fingerprint of the source,
+so a moved scan keeps its cache and a rewritten scan gets a new one.
+
+A step cache stores the outputs of single pipeline steps, keyed by a hash
+of the step inputs, the step parameters and the code version. It is kept
+below a size limit by removing the least recently used entries.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY.
+
+Example Usage
+-------------
+In Python:
+    import ToothAnalyserMicroCTLib.tha.cache as cache
+    cache_dir = cache.chunk_cache_dir("sample.isq", "/tmp/tha_cache")
+    cache.write_chunked(image, cache_dir)
+    roi = cache.read_chunked_region(cache_dir, index=(10, 20, 30), size=(64, 64, 64))
+    key = cache.fingerprint("sample.isq")
+    pyramid = cache.pyramid_dir("sample.isq")
+    cache.build_pyramid(image, pyramid, source_file_name="sample.isq")
+    preview = cache.load_pyramid_level(pyramid, cache.closest_pyramid_level(pyramid, 256**3))
+    image = sitk.ReadImage(cache.decompressed_file("sample.nii.gz", "/tmp/tha_cache"))
+    key = cache.step_key("smoothImage", cache.image_key(image), 5)
+    outputs = cache.load_step("/tmp/tha_cache/steps", key)
+
+Author
+-------
+Lukas Konietzka, lukas.konietzka@tha.de
+"""
+
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import itertools
+import json
+import gzip
+import os
+import shutil
+import subprocess
+import zlib
+
+import numpy as np
+import SimpleITK as sitk
+
+from ..Algorithms.Scanco import read_scanco_header
+
+__CHUNK_HEADER_NAME = "header.json"
+__PYRAMID_HEADER_NAME = "pyramid.json"
+__STEP_HEADER_NAME = "step.json"
+
+
+def _header_size(file_name: str) -> int:
+    """Number of leading bytes of a file that hold its header."""
+    if file_name.lower().endswith((".isq", ".aim")):
+        return read_scanco_header(file_name)["offset"]
+    if file_name.lower().endswith(".nii"):
+        return 352
+    # compressed or unknown formats, the header is somewhere in the start
+    return 64 * 1024
+
+
+def fingerprint(
+    file_name: str, block_count: int = 32, block_size: int = 64 * 1024
+) -> str:
+    """
+    Compute a content key of a (large) image file from a sample of it.
+
+    The key hashes the file size, the file header and block_count evenly
+    spaced blocks of the file. Only a few MB are read whatever the file
+    size, so identical scans get identical keys at different paths, while
+    a rewritten scan gets a new key.
+
+    Args:
+        file_name (str): Name of the image file.
+        block_count (int): Number of sampled blocks.
+        block_size (int): Size of a sampled block in bytes.
+
+    Returns:
+        str: Hexadecimal content key.
+    """
+    file_size = os.path.getsize(file_name)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(str(file_size).encode("utf8"))
+    with open(file_name, "rb") as f:
+        digest.update(f.read(_header_size(file_name)))
+        if file_size > block_size:
+            offsets = np.linspace(0, file_size - block_size, block_count)
+            for offset in offsets.astype(np.int64):
+                f.seek(int(offset))
+                digest.update(f.read(block_size))
+    return digest.hexdigest()
+
+
+def find_duplicates(file_names: Sequence[str]) -> list[list[str]]:
+    """
+    Group files with identical content keys.
+
+    Args:
+        file_names (Sequence[str]): Names of image files.
+
+    Returns:
+        list[list[str]]: Groups of two or more files sharing a fingerprint.
+    """
+    groups = {}
+    for file_name in file_names:
+        groups.setdefault(fingerprint(file_name), []).append(file_name)
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def chunk_cache_dir(file_name: str, cache_dir_name: str) -> str:
+    """
+    Get the chunked cache directory of a source file.
+
+    The directory is named after the file stem and its sampled content
+    fingerprint, not after its path, size or modification time.
+
+    Args:
+        file_name (str): Name of the source image file.
+        cache_dir_name (str): Directory containing all caches.
+
+    Returns:
+        str: Directory name of the chunked cache for this file.
+    """
+    stem = os.path.basename(file_name).split(".")[0]
+    return os.path.join(
+        cache_dir_name, f"{stem}_{fingerprint(file_name)}.chunks"
+    )
+
+
+def is_chunked(chunk_dir_name: str) -> bool:
+    """
+    Check whether a complete chunked cache exists.
+
+    Args:
+        chunk_dir_name (str): Directory of the chunked cache.
+
+    Returns:
+        bool: True if the cache header is present.
+    """
+    return os.path.isfile(os.path.join(chunk_dir_name, __CHUNK_HEADER_NAME))
+
+
+def _chunk_file_name(chunk_dir_name: str, chunk_index: Sequence[int]) -> str:
+    """Name of the file holding the chunk with index (z, y, x)."""
+    return os.path.join(
+        chunk_dir_name, "_".join(str(i) for i in chunk_index) + ".zlib"
+    )
+
+
+def write_chunked(
+    image: sitk.Image,
+    chunk_dir_name: str,
+    chunk_size: Sequence[int] = (64, 64, 64),
+    compression_level: int = 1,
+) -> None:
+    """
+    Store an image as a chunked cache.
+
+    The chunks are compressed in parallel. The header is written last,
+    so an interrupted run never leaves a cache that looks complete.
+
+    Args:
+        image (sitk.Image): Scalar 3D image to be stored.
+        chunk_dir_name (str): Directory of the chunked cache.
+        chunk_size (Sequence[int]): Chunk size in voxels (x, y, z).
+        compression_level (int): zlib compression level.
+    """
+    array = sitk.GetArrayViewFromImage(image)
+    chunk_shape = tuple(chunk_size[::-1])
+    if os.path.isdir(chunk_dir_name):
+        shutil.rmtree(chunk_dir_name)
+    os.makedirs(chunk_dir_name)
+
+    def write_chunk(chunk_index):
+        region = tuple(
+            slice(i * c, (i + 1) * c) for i, c in zip(chunk_index, chunk_shape)
+        )
+        chunk = np.ascontiguousarray(array[region])
+        if not chunk.any():
+            return
+        with open(_chunk_file_name(chunk_dir_name, chunk_index), "wb") as f:
+            f.write(zlib.compress(chunk.tobytes(), compression_level))
+
+    grid = [range(-(-s // c)) for s, c in zip(array.shape, chunk_shape)]
+    with ThreadPoolExecutor() as executor:
+        list(executor.map(write_chunk, itertools.product(*grid)))
+
+    header = {
+        "size": list(image.GetSize()),
+        "spacing": list(image.GetSpacing()),
+        "origin": list(image.GetOrigin()),
+        "direction": list(image.GetDirection()),
+        "dtype": array.dtype.str,
+        "chunk_size": list(chunk_size),
+    }
+    with open(
+        os.path.join(chunk_dir_name, __CHUNK_HEADER_NAME), "w", encoding="utf8"
+    ) as header_file:
+        json.dump(header, header_file, indent=1)
+
+
+def read_chunked_header(chunk_dir_name: str) -> dict:
+    """
+    Read the header of a chunked cache.
+
+    Args:
+        chunk_dir_name (str): Directory of the chunked cache.
+
+    Returns:
+        dict: size, spacing, origin, direction, dtype and chunk_size.
+    """
+    with open(
+        os.path.join(chunk_dir_name, __CHUNK_HEADER_NAME), "r", encoding="utf8"
+    ) as header_file:
+        return json.load(header_file)
+
+
+def read_chunked_region(
+    chunk_dir_name: str,
+    index: Sequence[int] = None,
+    size: Sequence[int] = None,
+) -> sitk.Image:
+    """
+    Read a sub-volume from a chunked cache.
+
+    Only the chunks overlapping the region are decompressed.
+
+    Args:
+        chunk_dir_name (str): Directory of the chunked cache.
+        index (Sequence[int]): First voxel of the region (x, y, z).
+            Default is None (start of the volume).
+        size (Sequence[int]): Size of the region in voxels (x, y, z).
+            Default is None (up to the end of the volume).
+
+    Returns:
+        sitk.Image: The region with origin adapted to its position.
+    """
+    header = read_chunked_header(chunk_dir_name)
+    image_size = header["size"]
+    if index is None:
+        index = (0, 0, 0)
+    if size is None:
+        size = tuple(s - i for s, i in zip(image_size, index))
+    for i in range(3):
+        if size[i] < 1 or index[i] < 0 or index[i] + size[i] > image_size[i]:
+            raise ValueError(
+                f"Region index {tuple(index)} size {tuple(size)} "
+                f"exceeds image size {tuple(image_size)}"
+            )
+    dtype = np.dtype(header["dtype"])
+    chunk_shape = tuple(header["chunk_size"][::-1])
+    array_shape = tuple(image_size[::-1])
+    start = tuple(index[::-1])
+    stop = tuple(i + s for i, s in zip(start, size[::-1]))
+    out_array = np.zeros(tuple(size[::-1]), dtype=dtype)
+
+    def read_chunk(chunk_index):
+        chunk_file_name = _chunk_file_name(chunk_dir_name, chunk_index)
+        if not os.path.isfile(chunk_file_name):
+            return
+        chunk_start = tuple(i * c for i, c in zip(chunk_index, chunk_shape))
+        this_shape = tuple(
+            min(c, s - cs)
+            for c, s, cs in zip(chunk_shape, array_shape, chunk_start)
+        )
+        with open(chunk_file_name, "rb") as f:
+            chunk = np.frombuffer(
+                zlib.decompress(f.read()), dtype=dtype
+            ).reshape(this_shape)
+        src = tuple(
+            slice(max(a, cs) - cs, min(b, cs + n) - cs)
+            for a, b, cs, n in zip(start, stop, chunk_start, this_shape)
+        )
+        dst = tuple(
+            slice(max(a, cs) - a, min(b, cs + n) - a)
+            for a, b, cs, n in zip(start, stop, chunk_start, this_shape)
+        )
+        out_array[dst] = chunk[src]
+
+    grid = [
+        range(a // c, (b - 1) // c + 1)
+        for a, b, c in zip(start, stop, chunk_shape)
+    ]
+    with ThreadPoolExecutor() as executor:
+        list(executor.map(read_chunk, itertools.product(*grid)))
+
+    out_image = sitk.GetImageFromArray(out_array)
+    out_image.SetSpacing(header["spacing"])
+    out_image.SetDirection(header["direction"])
+    out_image.SetOrigin(header["origin"])
+    out_image.SetOrigin(
+        out_image.TransformIndexToPhysicalPoint([int(i) for i in index])
+    )
+    return out_image
+
+
+def pyramid_dir(file_name: str, cache_dir_name: str = None) -> str:
+    """
+    Get the pyramid directory of a source file.
+
+    Args:
+        file_name (str): Name of the source image file.
+        cache_dir_name (str): Directory containing all caches. Default is
+            None in which case the pyramid is stored next to the source.
+
+    Returns:
+        str: Directory name of the pyramid for this file.
+    """
+    stem = os.path.basename(file_name).split(".")[0]
+    if cache_dir_name is None:
+        return os.path.join(os.path.dirname(file_name), stem + ".pyramid")
+    return os.path.join(
+        cache_dir_name, f"{stem}_{fingerprint(file_name)}.pyramid"
+    )
+
+
+def _level_file_name(pyramid_dir_name: str, level: int) -> str:
+    """Name of the file holding one pyramid level."""
+    return os.path.join(pyramid_dir_name, f"level_{level}.mha")
+
+
+def read_pyramid_header(
+    pyramid_dir_name: str, source_file_name: str = None
+) -> dict:
+    """
+    Read the header of a pyramid.
+
+    Args:
+        pyramid_dir_name (str): Directory of the pyramid.
+        source_file_name (str): If given, the pyramid is only accepted if
+            it was built from the current version of this file.
+
+    Returns:
+        dict: Header with the size of every stored level, or None if
+        there is no (valid) pyramid.
+    """
+    header_file_name = os.path.join(pyramid_dir_name, __PYRAMID_HEADER_NAME)
+    if not os.path.isfile(header_file_name):
+        return None
+    with open(header_file_name, "r", encoding="utf8") as header_file:
+        header = json.load(header_file)
+    if (
+        source_file_name is not None
+        and header["source_key"] != fingerprint(source_file_name)
+    ):
+        return None
+    return header
+
+
+def build_pyramid(
+    image: sitk.Image,
+    pyramid_dir_name: str,
+    levels: int = 3,
+    image_level: int = 0,
+    source_file_name: str = None,
+) -> dict:
+    """
+    Build and store the reduced resolution levels of an image.
+
+    Every level halves the resolution of the previous one by grey value
+    averaging with downsample_2. Level 0 (full resolution) is not stored.
+
+    Args:
+        image (sitk.Image): Image at resolution level image_level.
+        pyramid_dir_name (str): Directory of the pyramid.
+        levels (int): Coarsest level to be stored, 3 means 1/8.
+        image_level (int): Level of the given image. Use 1 to store an
+            already halved image without recomputing it.
+        source_file_name (str): Source file the image was loaded from,
+            used to detect stale pyramids.
+
+    Returns:
+        dict: The pyramid header.
+    """
+    from .filtering import downsample_2
+
+    os.makedirs(pyramid_dir_name, exist_ok=True)
+    size = image.GetSize()
+    # full resolution size, odd sizes are rounded down for image_level > 0
+    level_sizes = {0: [s * 2**image_level for s in size]}
+    level_image = image
+    for level in range(image_level, levels + 1):
+        if level > image_level:
+            level_image = downsample_2(level_image, use_median=False)
+        if level > 0:
+            sitk.WriteImage(
+                level_image, _level_file_name(pyramid_dir_name, level)
+            )
+            level_sizes[level] = list(level_image.GetSize())
+
+    header = {
+        "source_key": (
+            fingerprint(source_file_name) if source_file_name else None
+        ),
+        "levels": {str(k): v for k, v in level_sizes.items() if k > 0},
+        "full_size": level_sizes[0],
+    }
+    with open(
+        os.path.join(pyramid_dir_name, __PYRAMID_HEADER_NAME),
+        "w",
+        encoding="utf8",
+    ) as header_file:
+        json.dump(header, header_file, indent=1)
+    return header
+
+
+def closest_pyramid_level(pyramid_dir_name: str, target_voxels: int) -> int:
+    """
+    Find the stored level whose voxel count is closest to a target.
+
+    Level 0 (the full resolution source) is a candidate as well.
+
+    Args:
+        pyramid_dir_name (str): Directory of the pyramid.
+        target_voxels (int): Desired number of voxels.
+
+    Returns:
+        int: The level closest to the target on a logarithmic scale.
+    """
+    header = read_pyramid_header(pyramid_dir_name)
+    candidates = {0: header["full_size"]}
+    candidates.update({int(k): v for k, v in header["levels"].items()})
+    return min(
+        candidates,
+        key=lambda level: abs(
+            np.log(max(np.prod(candidates[level]), 1))
+            - np.log(max(target_voxels, 1))
+        ),
+    )
+
+
+def load_pyramid_level(pyramid_dir_name: str, level: int) -> sitk.Image:
+    """
+    Load one stored level of a pyramid.
+
+    Args:
+        pyramid_dir_name (str): Directory of the pyramid.
+        level (int): Level to be loaded, 1 means 1/2 resolution.
+
+    Returns:
+        sitk.Image: The image of that level.
+    """
+    return sitk.ReadImage(_level_file_name(pyramid_dir_name, level))
+
+
+def decompressed_file(file_name: str, cache_dir_name: str) -> str:
+    """
+    Get an uncompressed copy of a gzip compressed file, e.g. .nii.gz.
+
+    The copy is created on first use, with pigz if it is installed and
+    with the gzip module otherwise. It is written to a temporary name
+    and renamed when complete, so an interrupted run leaves no copy.
+
+    Args:
+        file_name (str): Name of the gzip compressed file.
+        cache_dir_name (str): Directory containing all caches.
+
+    Returns:
+        str: Name of the uncompressed file in the cache directory.
+    """
+    base_name = os.path.basename(file_name)
+    stem, suffix = os.path.splitext(base_name[: -len(".gz")])
+    out_file_name = os.path.join(
+        cache_dir_name, f"{stem}_{fingerprint(file_name)}{suffix}"
+    )
+    if os.path.isfile(out_file_name):
+        return out_file_name
+
+    os.makedirs(cache_dir_name, exist_ok=True)
+    tmp_file_name = out_file_name + ".partial"
+    with open(tmp_file_name, "wb") as out_file:
+        pigz = shutil.which("pigz")
+        if pigz is not None:
+            subprocess.run(
+                [pigz, "--decompress", "--stdout", file_name],
+                stdout=out_file,
+                check=True,
+            )
+        else:
+            with gzip.open(file_name, "rb") as in_file:
+                shutil.copyfileobj(in_file, out_file, 16 * 1024 * 1024)
+    os.replace(tmp_file_name, out_file_name)
+    return out_file_name
+
+
+def image_key(image: sitk.Image) -> str:
+    """
+    Compute a content key of an image held in memory.
+
+    The key hashes the geometry, the pixel type and all voxels, so two
+    images get the same key only if they are identical.
+
+    Args:
+        image (sitk.Image): The image.
+
+    Returns:
+        str: Hexadecimal content key.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    geometry = (
+        image.GetSize(),
+        image.GetSpacing(),
+        image.GetOrigin(),
+        image.GetDirection(),
+        image.GetPixelIDValue(),
+    )
+    digest.update(repr(geometry).encode("utf8"))
+    digest.update(
+        np.ascontiguousarray(sitk.GetArrayViewFromImage(image)).data
+    )
+    return digest.hexdigest()
+
+
+def step_key(*parts) -> str:
+    """
+    Combine the name, the input keys and the parameters of a step.
+
+    Args:
+        *parts: Strings or values with a stable repr.
+
+    Returns:
+        str: Hexadecimal key of the step.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        digest.update(repr(part).encode("utf8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def load_step(step_dir_name: str, key: str) -> tuple:
+    """
+    Load the outputs of a step from the step cache.
+
+    A hit marks the entry as recently used.
+
+    Args:
+        step_dir_name (str): Directory of the step cache.
+        key (str): Key of the step, see step_key.
+
+    Returns:
+        tuple: The outputs of the step, or None if they are not cached.
+    """
+    entry_dir_name = os.path.join(step_dir_name, key)
+    header_file_name = os.path.join(entry_dir_name, __STEP_HEADER_NAME)
+    if not os.path.isfile(header_file_name):
+        return None
+    try:
+        with open(header_file_name, "r", encoding="utf8") as header_file:
+            header = json.load(header_file)
+        outputs = tuple(
+            sitk.ReadImage(os.path.join(entry_dir_name, output["image"]))
+            if "image" in output
+            else output["value"]
+            for output in header["outputs"]
+        )
+        os.utime(entry_dir_name)
+    except (OSError, ValueError, KeyError, TypeError, RuntimeError):
+        # a damaged or removed entry is a miss, the step is computed again
+        shutil.rmtree(entry_dir_name, ignore_errors=True)
+        return None
+    return outputs
+
+
+def store_step(step_dir_name: str, key: str, outputs: Sequence) -> None:
+    """
+    Store the outputs of a step in the step cache.
+
+    Images are written as .mha files, other outputs must be JSON
+    serializable. The entry is written to a temporary name and renamed
+    when complete. The cache is not limited here, call evict_steps when
+    no step is running anymore.
+
+    Args:
+        step_dir_name (str): Directory of the step cache.
+        key (str): Key of the step, see step_key.
+        outputs (Sequence): The outputs of the step.
+    """
+    entry_dir_name = os.path.join(step_dir_name, key)
+    tmp_dir_name = entry_dir_name + ".partial"
+    if os.path.isdir(tmp_dir_name):
+        shutil.rmtree(tmp_dir_name)
+    os.makedirs(tmp_dir_name)
+    header = {"outputs": []}
+    for i, output in enumerate(outputs):
+        if isinstance(output, sitk.Image):
+            sitk.WriteImage(output, os.path.join(tmp_dir_name, f"{i}.mha"))
+            header["outputs"].append({"image": f"{i}.mha"})
+        else:
+            header["outputs"].append({"value": output})
+    with open(
+        os.path.join(tmp_dir_name, __STEP_HEADER_NAME), "w", encoding="utf8"
+    ) as header_file:
+        json.dump(header, header_file, indent=1)
+    if os.path.isdir(entry_dir_name):
+        shutil.rmtree(entry_dir_name)
+    os.replace(tmp_dir_name, entry_dir_name)
+
+
+def evict_steps(step_dir_name: str, max_bytes: int = 2 * 1024**3) -> None:
+    """
+    Remove the least recently used entries of a step cache.
+
+    Entries may be removed while they are read, so call this after the
+    steps using the cache have finished.
+
+    Args:
+        step_dir_name (str): Directory of the step cache.
+        max_bytes (int): Size limit of the step cache in bytes.
+    """
+    if not os.path.isdir(step_dir_name):
+        return
+    entries = []
+    for entry in os.scandir(step_dir_name):
+        if not entry.is_dir() or entry.name.endswith(".partial"):
+            continue
+        try:
+            size = sum(f.stat().st_size for f in os.scandir(entry.path))
+            entries.append((entry.stat().st_mtime, size, entry.path))
+        except OSError:
+            # removed in the meantime
+            continue
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
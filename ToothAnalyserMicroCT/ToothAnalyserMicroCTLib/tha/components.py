@@ -0,0 +1,244 @@
+"""
+ToothAnalyserMicroCTLib.tha.components
+=================================
+
+This module selects connected components of binary images without a
+label image.
+
+The foreground of every image row is stored as runs of voxels. The runs are
+joined by a union-find in parallel slabs along z, which are merged at their
+borders afterwards. Components are face connected, as with the SimpleITK
+ConnectedComponentImageFilter. The result is a uint8 mask, so neither the
+four byte label image nor the sort of the relabel filter is needed.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY.
+
+Example Usage
+-------------
+In Python:
+    import ToothAnalyserMicroCTLib.tha.components as components
+    enamel = components.largest_component(enamel, min_size=50)
+    parts = components.components_above_size(parts, min_size=10)
+
+Author
+-------
+Lukas Konietzka, lukas.konietzka@tha.de
+"""
+
+import numpy as np
+import SimpleITK as sitk
+import slicer
+
+try:
+    import numba
+except ModuleNotFoundError:
+    if slicer.util.confirmOkCancelDisplay(
+            "This module requires the 'numba' Python package. Click OK to install it now."):
+        slicer.util.pip_install("numba")
+
+from .dependencies import NUMBA_PARALLEL_LOCK
+
+
+@numba.njit(parallel=True)
+def _count_runs_numba(arr: np.ndarray) -> np.ndarray:
+    """Number of foreground runs of every row (z, y)."""
+    nz, ny, nx = arr.shape
+    counts = np.zeros(nz * ny, dtype=np.int64)
+    for z in numba.prange(nz):  # pylint: disable=not-an-iterable
+        for y in range(ny):
+            n = 0
+            inside = False
+            for x in range(nx):
+                if arr[z, y, x] != 0:
+                    if not inside:
+                        n += 1
+                        inside = True
+                else:
+                    inside = False
+            counts[z * ny + y] = n
+    return counts
+
+
+@numba.njit(parallel=True)
+def _fill_runs_numba(arr: np.ndarray, offsets: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> None:
+    """First and last x of every run, the runs of a row start at its offset."""
+    nz, ny, nx = arr.shape
+    for z in numba.prange(nz):  # pylint: disable=not-an-iterable
+        for y in range(ny):
+            r = offsets[z * ny + y]
+            inside = False
+            for x in range(nx):
+                if arr[z, y, x] != 0:
+                    if not inside:
+                        starts[r] = x
+                        inside = True
+                elif inside:
+                    ends[r] = x - 1
+                    r += 1
+                    inside = False
+            if inside:
+                ends[r] = nx - 1
+
+
+@numba.njit
+def _find(parent: np.ndarray, i: int) -> int:
+    """Root of a run, with path halving."""
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+@numba.njit
+def _union(parent: np.ndarray, i: int, j: int) -> None:
+    """Join the components of two runs, the smaller run index becomes the root."""
+    i = _find(parent, i)
+    j = _find(parent, j)
+    if i < j:
+        parent[j] = i
+    elif j < i:
+        parent[i] = j
+
+
+@numba.njit
+def _union_rows(
+    parent: np.ndarray, starts: np.ndarray, ends: np.ndarray, offsets: np.ndarray, row: int, other: int
+) -> None:
+    """Join the overlapping runs of two neighbouring rows."""
+    i, i_end = offsets[row], offsets[row + 1]
+    j, j_end = offsets[other], offsets[other + 1]
+    while i < i_end and j < j_end:
+        if ends[i] < starts[j]:
+            i += 1
+        elif ends[j] < starts[i]:
+            j += 1
+        else:
+            _union(parent, i, j)
+            if ends[i] < ends[j]:
+                i += 1
+            else:
+                j += 1
+
+
+@numba.njit(parallel=True)
+def _union_slabs_numba(
+    parent: np.ndarray, starts: np.ndarray, ends: np.ndarray, offsets: np.ndarray,
+    nz: int, ny: int, slab: int
+) -> None:
+    """Union-find in slabs of z planes in parallel, then across the slab borders."""
+    n_slabs = (nz + slab - 1) // slab
+    for s in numba.prange(n_slabs):  # pylint: disable=not-an-iterable
+        # runs of a slab only refer to runs of the same slab
+        for z in range(s * slab, min(nz, (s + 1) * slab)):
+            for y in range(ny):
+                row = z * ny + y
+                if y > 0:
+                    _union_rows(parent, starts, ends, offsets, row, row - 1)
+                if z > s * slab:
+                    _union_rows(parent, starts, ends, offsets, row, row - ny)
+    for s in range(1, n_slabs):
+        z = s * slab
+        for y in range(ny):
+            row = z * ny + y
+            _union_rows(parent, starts, ends, offsets, row, row - ny)
+
+
+@numba.njit
+def _component_sizes_numba(parent: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """Point every run to its root and sum the voxels of every root."""
+    sizes = np.zeros(parent.shape[0], dtype=np.int64)
+    for i in range(parent.shape[0]):
+        # roots have smaller indices, so parent[i] already points to its root
+        parent[i] = parent[parent[i]]
+        sizes[parent[i]] += ends[i] - starts[i] + 1
+    return sizes
+
+
+@numba.njit(parallel=True)
+def _paint_runs_numba(
+    out: np.ndarray, parent: np.ndarray, keep: np.ndarray, starts: np.ndarray, ends: np.ndarray,
+    offsets: np.ndarray
+) -> None:
+    """Set the voxels of the kept components to 1."""
+    nz, ny, _ = out.shape
+    for z in numba.prange(nz):  # pylint: disable=not-an-iterable
+        for y in range(ny):
+            row = z * ny + y
+            for r in range(offsets[row], offsets[row + 1]):
+                if keep[parent[r]]:
+                    out[z, y, starts[r]:ends[r] + 1] = 1
+
+
+def _select_components(image: sitk.Image, min_size: int, largest: bool, region: tuple) -> sitk.Image:
+    """Mask of the components with at least min_size voxels, or of the largest one only."""
+    arr = sitk.GetArrayViewFromImage(image)
+    out = np.zeros(arr.shape, dtype=np.uint8)
+    if region is not None:
+        index, size = region
+        box = tuple(slice(i, i + s) for i, s in zip(index[::-1], size[::-1]))
+        arr, out_box = arr[box], out[box]
+    else:
+        out_box = out
+    nz, ny, _ = arr.shape
+    with NUMBA_PARALLEL_LOCK:
+        counts = _count_runs_numba(arr)
+        offsets = np.zeros(counts.size + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        n_runs = int(offsets[-1])
+        starts = np.empty(n_runs, dtype=np.int32)
+        ends = np.empty(n_runs, dtype=np.int32)
+        _fill_runs_numba(arr, offsets, starts, ends)
+        parent = np.arange(n_runs, dtype=np.int64)
+        slab = max(1, -(-nz // numba.get_num_threads()))
+        _union_slabs_numba(parent, starts, ends, offsets, nz, ny, slab)
+    sizes = _component_sizes_numba(parent, starts, ends)
+    if largest:
+        keep = np.zeros(n_runs, dtype=np.bool_)
+        if n_runs > 0:
+            # ties go to the component that comes first in the image, as in the relabel filter
+            root = int(np.argmax(sizes))
+            keep[root] = sizes[root] >= min_size
+    else:
+        keep = sizes >= max(min_size, 1)
+    with NUMBA_PARALLEL_LOCK:
+        _paint_runs_numba(out_box, parent, keep, starts, ends, offsets)
+    result = sitk.GetImageFromArray(out)
+    result.CopyInformation(image)
+    return result
+
+
+def largest_component(image: sitk.Image, min_size: int = 1, region: tuple = None) -> sitk.Image:
+    """
+    Select the largest connected component of a binary image.
+
+    Same as "ccMinSize(image, min_size) == 1".
+
+    Args:
+        image (sitk.Image): Image, every voxel that is not zero is foreground.
+        min_size (int): The component is dropped if it has fewer voxels.
+        region (tuple): Index and size of a bounding box, the components
+            are searched inside it only. Default is None (whole image).
+
+    Returns:
+        sitk.Image: Binary uint8 mask of the component.
+    """
+    return _select_components(image, min_size, True, region)
+
+
+def components_above_size(image: sitk.Image, min_size: int, region: tuple = None) -> sitk.Image:
+    """
+    Select the connected components of a binary image with a minimum size.
+
+    Same as "ccMinSize(image, min_size) > 0".
+
+    Args:
+        image (sitk.Image): Image, every voxel that is not zero is foreground.
+        min_size (int): Components with fewer voxels are dropped.
+        region (tuple): Index and size of a bounding box, the components
+            are searched inside it only. Default is None (whole image).
+
+    Returns:
+        sitk.Image: Binary uint8 mask of the components.
+    """
+    return _select_components(image, min_size, False, region)
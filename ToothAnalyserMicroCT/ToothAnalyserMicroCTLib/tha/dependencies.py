@@ -2,8 +2,15 @@
 Helpers for optional runtime dependencies used by the tha package.
 """
 
+import threading
+
 import slicer
 
+# The workqueue threading layer of numba, used if neither TBB nor OpenMP is
+# available, aborts if parallel kernels are launched from several threads at
+# once. Pipeline steps run concurrently, so their kernels take turns.
+NUMBA_PARALLEL_LOCK = threading.Lock()
+
 
 class DependencyInstallationRequired(RuntimeError):
     """Raised to stop the current workflow after an on-demand install."""
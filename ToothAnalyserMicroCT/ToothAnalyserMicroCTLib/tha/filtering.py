@@ -35,6 +35,8 @@ from typing import Union
 
 from SimpleITK import Image
 
+from ..Algorithms.Scanco import read_scanco_header, scanco_to_array
+
 try:
     import numba
 except ModuleNotFoundError:
@@ -200,6 +202,53 @@ def downsample_2(
 
 
 
+def downsample_2_isq(
+    isq_file_name: str,
+    use_median: bool = False,
+    adapt_origin: bool = True,
+    convert_to_uint8: bool = False,
+    slab_size: int = 16,
+) -> Image:
+    """
+    Downsample an ISQ (or AIM) file by a factor of 2 while reading it. Pairs
+    of slices are taken from the memory mapped grey value block and reduced
+    immediately, so the full resolution volume is never held in memory.
+
+    Args:
+        isq_file_name (str): Name of the ISQ or AIM file to read.
+        use_median (bool): Apply median filtering. Default is False
+            (apply  grey value averaging).
+        adapt_origin (bool): Adapt origin of output image to new resolution.
+            Default ist True (perform origin adaption).
+        convert_to_uint8: Rescale grey values to 0..255 and cast to uint8.
+        slab_size (int): Number of output slices computed at once.
+
+    @return
+        out_image (Image): The image that has been down sampled
+    """
+    header = read_scanco_header(isq_file_name)
+    in_array = scanco_to_array(isq_file_name)
+    out_shape = tuple(s // 2 for s in in_array.shape)
+    out_array = np.empty(out_shape, dtype=in_array.dtype)
+    for out_z in range(0, out_shape[0], slab_size):
+        out_z_stop = min(out_z + slab_size, out_shape[0])
+        in_slab = np.ascontiguousarray(in_array[2 * out_z : 2 * out_z_stop])
+        out_array[out_z:out_z_stop] = downsample_2_numba(in_slab, use_median)
+    out_im = sitk.GetImageFromArray(out_array)
+    in_spacing = header["spacing"]
+    out_im.SetSpacing(tuple([s * 2 for s in in_spacing]))
+    in_origin = header["origin"]
+    if adapt_origin:
+        out_origin = tuple(o + 0.5 * s for o, s in zip(in_origin, in_spacing))
+    else:
+        out_origin = in_origin
+    out_im.SetOrigin(out_origin)
+    if convert_to_uint8:
+        if not use_median:
+            out_im = sitk.RescaleIntensity(out_im, 0, 255)
+        out_im = sitk.Cast(out_im, sitk.sitkUInt8)
+    return out_im
+
 
 def downsample_2_file_system(
     in_file_name: str,
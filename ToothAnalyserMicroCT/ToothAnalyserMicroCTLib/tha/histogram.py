@@ -0,0 +1,389 @@
+"""
+ToothAnalyserMicroCTLib.tha.histogram
+=================================
+
+This module provides a shared histogram and statistics service for images
+held in memory.
+
+The grey values of an 8 or 16 bit image are counted once in a single parallel
+pass, optionally restricted to a mask. The counts are cached per image and mask,
+so the statistics and every binned histogram needed by the threshold methods
+are derived from them without another pass over the volume.
+
+The thresholds reproduce the SimpleITK threshold filters, including their
+histogram binning. Methods not implemented here return None, so the caller
+can fall back to the SimpleITK filter.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY.
+
+Example Usage
+-------------
+In Python:
+    import ToothAnalyserMicroCTLib.tha.histogram as histogram
+    stats = histogram.image_statistics(image)
+    mask = histogram.binary_mask(tooth)
+    value = histogram.threshold(image, "Otsu", mask=mask)
+    binary = image > value
+
+Author
+-------
+Lukas Konietzka, lukas.konietzka@tha.de
+"""
+
+import math
+import threading
+import weakref
+
+import numpy as np
+import SimpleITK as sitk
+import slicer
+
+try:
+    import numba
+except ModuleNotFoundError:
+    if slicer.util.confirmOkCancelDisplay(
+            "This module requires the 'numba' Python package. Click OK to install it now."):
+        slicer.util.pip_install("numba")
+
+from .dependencies import NUMBA_PARALLEL_LOCK
+
+# id(image) -> (weak reference to the image, {(..., id(mask)): (weak reference to the mask, cached value)})
+__CACHE = {}
+# reentrant, as the weak reference callbacks may run while the lock is held
+__CACHE_LOCK = threading.RLock()
+
+# default number of bins of the SimpleITK threshold filters
+__DEFAULT_BINS = {"Otsu": 128}
+
+
+@numba.njit(parallel=True)
+def _value_counts_numba(
+    values: np.ndarray, mask: np.ndarray, offset: int, n_values: int, n_chunks: int
+) -> np.ndarray:
+    """
+    Count the grey values of a flat integer array in parallel.
+
+    Args:
+        values (np.ndarray): Flat array of grey values.
+        mask (np.ndarray): Flat mask of the same length, or an empty array
+            to count all voxels.
+        offset (int): Added to a grey value to get its index.
+        n_values (int): Number of possible grey values.
+        n_chunks (int): Number of chunks counted in parallel.
+
+    Returns:
+        np.ndarray: The count of every grey value.
+    """
+    counts = np.zeros((n_chunks, n_values), dtype=np.int64)
+    n = values.shape[0]
+    chunk = (n + n_chunks - 1) // n_chunks
+    use_mask = mask.shape[0] > 0
+    for c in numba.prange(n_chunks):  # pylint: disable=not-an-iterable
+        for i in range(c * chunk, min(n, (c + 1) * chunk)):
+            if use_mask and mask[i] == 0:
+                continue
+            counts[c, values[i] + offset] += 1
+    return counts.sum(axis=0)
+
+
+def _forget(image_id: int) -> None:
+    """Remove the cache entry of a released image."""
+    with __CACHE_LOCK:
+        __CACHE.pop(image_id, None)
+
+
+def _cached(image: sitk.Image, mask: sitk.Image, key: tuple, compute):
+    """Get a value cached for an image and mask, compute it on the first request."""
+    key = key + (None if mask is None else id(mask),)
+    with __CACHE_LOCK:
+        entry = __CACHE.get(id(image))
+        if entry is None or entry[0]() is not image:
+            entry = (weakref.ref(image, lambda _, i=id(image): _forget(i)), {})
+            __CACHE[id(image)] = entry
+        cached = entry[1].get(key)
+        # the id of a released mask can be reused by a new one
+        if cached is not None and (mask is None or cached[0]() is mask):
+            return cached[1]
+    value = compute()
+    with __CACHE_LOCK:
+        entry[1][key] = (None if mask is None else weakref.ref(mask), value)
+    return value
+
+
+def binary_mask(mask: sitk.Image) -> sitk.Image:
+    """
+    Convert a mask to a uint8 mask of 0 and 1.
+
+    The result is cached per mask, so the histograms of an image restricted
+    to the same mask are reused by every threshold computed with it.
+
+    Args:
+        mask (sitk.Image): Mask, every voxel that is not zero is inside.
+
+    Returns:
+        sitk.Image: The binary uint8 mask.
+    """
+    return _cached(mask, None, ("binary",), lambda: sitk.Cast(mask > 0, sitk.sitkUInt8))
+
+
+def _is_counted(image: sitk.Image) -> bool:
+    """Check whether the grey values of an image are counted, not binned."""
+    return image.GetPixelID() in (
+        sitk.sitkUInt8, sitk.sitkInt8, sitk.sitkUInt16, sitk.sitkInt16
+    )
+
+
+def _masked_values(image: sitk.Image, mask: sitk.Image) -> np.ndarray:
+    """The grey values of an image inside a mask as flat array."""
+    values = sitk.GetArrayViewFromImage(image).reshape(-1)
+    if mask is None:
+        return values
+    return values[sitk.GetArrayViewFromImage(mask).reshape(-1) != 0]
+
+
+def value_counts(image: sitk.Image, mask: sitk.Image = None) -> tuple:
+    """
+    Count the grey values of an 8 or 16 bit integer image.
+
+    Args:
+        image (sitk.Image): The image.
+        mask (sitk.Image): Only voxels where the mask is not zero are
+            counted. Default is None (all voxels).
+
+    Returns:
+        tuple: The grey values that occur and their counts.
+    """
+
+    def compute():
+        dtype = sitk.GetArrayViewFromImage(image).dtype
+        info = np.iinfo(dtype)
+        values = sitk.GetArrayViewFromImage(image).reshape(-1)
+        if mask is None:
+            mask_values = np.zeros(0, dtype=np.uint8)
+        else:
+            mask_values = sitk.GetArrayViewFromImage(mask).reshape(-1)
+        with NUMBA_PARALLEL_LOCK:
+            counts = _value_counts_numba(
+                values, mask_values, -int(info.min), int(info.max) - int(info.min) + 1,
+                numba.get_num_threads()
+            )
+        present = np.nonzero(counts)[0]
+        return present + int(info.min), counts[present]
+
+    return _cached(image, mask, ("counts",), compute)
+
+
+def image_statistics(image: sitk.Image, mask: sitk.Image = None) -> dict:
+    """
+    Compute the grey value statistics of an image.
+
+    Args:
+        image (sitk.Image): The image.
+        mask (sitk.Image): Only voxels where the mask is not zero are
+            used. Default is None (all voxels).
+
+    Returns:
+        dict: count, minimum, maximum, mean and std of the grey values.
+    """
+
+    def compute():
+        if _is_counted(image):
+            values, counts = value_counts(image, mask)
+            values = values.astype(np.float64)
+            count = int(counts.sum())
+            mean = float(values @ counts) / count
+            std = math.sqrt(float(((values - mean) ** 2) @ counts) / count)
+            return {"count": count, "minimum": float(values[0]), "maximum": float(values[-1]),
+                    "mean": mean, "std": std}
+        values = _masked_values(image, mask)
+        return {"count": int(values.size), "minimum": float(values.min()),
+                "maximum": float(values.max()), "mean": float(values.mean()),
+                "std": float(values.std())}
+
+    return _cached(image, mask, ("statistics",), compute)
+
+
+def histogram(image: sitk.Image, mask: sitk.Image = None, bins: int = 256) -> tuple:
+    """
+    Compute the histogram of an image as the SimpleITK threshold filters do.
+
+    8 bit images are binned over the whole pixel type range, all other
+    images from the minimum to slightly above the maximum grey value.
+
+    Args:
+        image (sitk.Image): The image.
+        mask (sitk.Image): Only voxels where the mask is not zero are
+            counted. Default is None (all voxels).
+        bins (int): Number of bins.
+
+    Returns:
+        tuple: The counts and the bin edges.
+    """
+
+    def compute():
+        if image.GetPixelID() in (sitk.sitkUInt8, sitk.sitkInt8):
+            info = np.iinfo(sitk.GetArrayViewFromImage(image).dtype)
+            low, high = info.min - 0.5, info.max + 0.5
+            edges = bins
+        elif image.GetPixelID() in (sitk.sitkFloat32, sitk.sitkFloat64):
+            stats = image_statistics(image, mask)
+            low = stats["minimum"]
+            # the filters round the upper bound and the bin width of float images to single precision
+            single, n = np.float32, np.float32(bins)
+            high = single(stats["maximum"]) + single(stats["maximum"] - low) / n / single(100)
+            width = (high - single(low)) / n
+            edges = low + (np.arange(bins + 1, dtype=np.float32) * width).astype(np.float64)
+            edges[-1] = high
+        else:
+            stats = image_statistics(image, mask)
+            low, high = stats["minimum"], stats["maximum"]
+            high += (high - low) / bins / 100.0
+            edges = bins
+        if _is_counted(image):
+            values, weights = value_counts(image, mask)
+        else:
+            values, weights = _masked_values(image, mask), None
+        counts, edges = np.histogram(
+            values.astype(np.float64), bins=edges, range=(float(low), float(high)), weights=weights
+        )
+        return counts.astype(np.float64), edges
+
+    return _cached(image, mask, ("histogram", bins), compute)
+
+
+def _otsu(counts: np.ndarray, edges: np.ndarray) -> float:
+    """Otsu threshold, the upper edge of the last background bin."""
+    p = counts / counts.sum()
+    centers = (edges[:-1] + edges[1:]) / 2
+    w = np.cumsum(p)
+    mu = np.cumsum(p * centers)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        between = (mu[-1] * w - mu) ** 2 / (w * (1 - w))
+    return edges[int(np.nanargmax(between[:-1])) + 1]
+
+
+def _moments(counts: np.ndarray) -> int:
+    """Moment preserving threshold (Tsai) as bin index."""
+    p = counts / counts.sum()
+    i = np.arange(len(counts), dtype=np.float64)
+    m1, m2, m3 = (i * p).sum(), (i * i * p).sum(), (i * i * i * p).sum()
+    cd = m2 - m1 * m1
+    c0 = (-m2 * m2 + m1 * m3) / cd
+    c1 = (-m3 + m2 * m1) / cd
+    root = math.sqrt(c1 * c1 - 4 * c0)
+    z0, z1 = 0.5 * (-c1 - root), 0.5 * (-c1 + root)
+    p0 = (z1 - m1) / (z1 - z0)
+    above = np.nonzero(np.cumsum(p) > p0)[0]
+    return int(above[0]) if above.size else len(counts) - 1
+
+
+def _yen(counts: np.ndarray) -> int:
+    """Yen threshold as bin index."""
+    p = counts / counts.sum()
+    p1 = np.cumsum(p)
+    p1_sq = np.cumsum(p * p)
+    p2_sq = np.append(np.cumsum((p * p)[::-1])[::-1][1:], 0.0)
+    a = p1_sq * p2_sq
+    b = p1 * (1.0 - p1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        criterion = -np.where(a > 0, np.log(a), 0.0) + 2 * np.where(b > 0, np.log(b), 0.0)
+    return int(np.argmax(criterion))
+
+
+def _entropy_range(counts: np.ndarray) -> tuple:
+    """Normalized histogram, cumulative sums and the range of valid thresholds."""
+    p = counts / counts.sum()
+    p1 = np.cumsum(p)
+    p2 = 1.0 - p1
+    eps = np.finfo(np.float64).eps
+    first = int(np.argmax(np.abs(p1) >= eps))
+    last = len(counts) - 1 - int(np.argmax(np.abs(p2[::-1]) >= eps))
+    return p, p1, p2, first, max(first, last)
+
+
+def _max_entropy_index(counts: np.ndarray) -> int:
+    """Maximum entropy (Kapur) threshold as bin index."""
+    p, p1, p2, first, last = _entropy_range(counts)
+    best, best_entropy = -1, -np.inf
+    nonzero = counts != 0
+    for t in range(first, last + 1):
+        back = p[: t + 1][nonzero[: t + 1]] / p1[t]
+        obj = p[t + 1:][nonzero[t + 1:]] / p2[t]
+        entropy = -(back * np.log(back)).sum() - (obj * np.log(obj)).sum()
+        if best_entropy < entropy:
+            best, best_entropy = t, entropy
+    return best
+
+
+def _renyi_index(counts: np.ndarray, alpha: float) -> int:
+    """Renyi entropy threshold of order alpha as bin index."""
+    p, p1, p2, first, last = _entropy_range(counts)
+    term = 1.0 / (1.0 - alpha)
+    best, best_entropy = 0, 0.0
+    for t in range(first, last + 1):
+        back = ((p[: t + 1] / p1[t]) ** alpha).sum()
+        obj = ((p[t + 1:] / p2[t]) ** alpha).sum()
+        entropy = term * (math.log(back * obj) if back * obj > 0 else 0.0)
+        if entropy > best_entropy:
+            best, best_entropy = t, entropy
+    return best
+
+
+def _renyi(counts: np.ndarray) -> int:
+    """Renyi entropy threshold, combined from the orders 0.5, 1 and 2, as bin index."""
+    _, p1, _, _, _ = _entropy_range(counts)
+    t1, t2, t3 = sorted(
+        (_renyi_index(counts, 0.5), _max_entropy_index(counts), _renyi_index(counts, 2.0))
+    )
+    if abs(t1 - t2) <= 5:
+        beta = (1, 2, 1) if abs(t2 - t3) <= 5 else (0, 1, 3)
+    else:
+        beta = (3, 1, 0) if abs(t2 - t3) <= 5 else (1, 2, 1)
+    omega = p1[t3] - p1[t1]
+    return int(
+        t1 * (p1[t1] + 0.25 * omega * beta[0])
+        + 0.25 * t2 * omega * beta[1]
+        + t3 * (1.0 - p1[t3] + 0.25 * omega * beta[2])
+    )
+
+
+# method -> threshold as bin index, the threshold is the center of that bin
+__BIN_METHODS = {"Moments": _moments, "Yen": _yen, "Renyi": _renyi}
+
+
+def threshold(
+    image: sitk.Image, method: str, mask: sitk.Image = None, bins: int = None
+):
+    """
+    Compute the threshold of a SimpleITK threshold filter from the cached histogram.
+
+    Args:
+        image (sitk.Image): The image.
+        method (str): Name of the method, e.g. "Otsu", "Renyi".
+        mask (sitk.Image): Only voxels where the mask is not zero are
+            used. Default is None (all voxels).
+        bins (int): Number of bins. Default is None (the default of the filter).
+
+    Returns:
+        The threshold, cast to the pixel type of the image as the filters
+        do, or None if the method is not implemented here or the histogram
+        has a single grey value.
+    """
+    if method != "Otsu" and method not in __BIN_METHODS:
+        return None
+    if bins is None:
+        bins = __DEFAULT_BINS.get(method, 256)
+    counts, edges = histogram(image, mask, bins)
+    if np.count_nonzero(counts) < 2:
+        # nothing to separate, leave the degenerate cases to the filters
+        return None
+    if method == "Otsu":
+        value = _otsu(counts, edges)
+    else:
+        index = __BIN_METHODS[method](counts)
+        value = (edges[index] + edges[index + 1]) / 2
+    dtype = sitk.GetArrayViewFromImage(image).dtype
+    if np.issubdtype(dtype, np.integer):
+        return int(value)
+    return float(dtype.type(value))
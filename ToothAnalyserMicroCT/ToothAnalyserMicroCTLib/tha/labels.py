@@ -0,0 +1,134 @@
+"""
+ToothAnalyserMicroCTLib.tha.labels
+=================================
+
+This module provides fused kernels for the voxelwise label algebra of the
+anatomical segmentation.
+
+Chains of SimpleITK operators like "(~tooth) == 255", "... + contour > 0"
+and "enamel * 3 + dentin * 2" allocate a full size image for every operator.
+The kernels here evaluate such an expression in one parallel pass over the
+binary masks and allocate the result only.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY.
+
+Example Usage
+-------------
+In Python:
+    import ToothAnalyserMicroCTLib.tha.labels as labels
+    dentin = labels.dentin_candidates(enamel, tooth, contour)
+    segmentation = labels.segmentation_labels(enamel, dentin)
+
+Author
+-------
+Lukas Konietzka, lukas.konietzka@tha.de
+"""
+
+import numpy as np
+import SimpleITK as sitk
+import slicer
+
+try:
+    import numba
+except ModuleNotFoundError:
+    if slicer.util.confirmOkCancelDisplay(
+            "This module requires the 'numba' Python package. Click OK to install it now."):
+        slicer.util.pip_install("numba")
+
+from .dependencies import NUMBA_PARALLEL_LOCK
+
+
+@numba.njit(parallel=True)
+def _dentin_candidates_numba(
+    enamel: np.ndarray, tooth: np.ndarray, contour: np.ndarray, out: np.ndarray
+) -> None:
+    """Voxels of the tooth that are neither enamel nor contour."""
+    for i in numba.prange(out.shape[0]):  # pylint: disable=not-an-iterable
+        out[i] = 1 if enamel[i] == 0 and tooth[i] != 0 and contour[i] == 0 else 0
+
+
+@numba.njit(parallel=True)
+def _add_minor_components_numba(
+    mask: np.ndarray, candidates: np.ndarray, labels: np.ndarray, out: np.ndarray
+) -> None:
+    """Mask plus the candidate voxels outside of the largest component."""
+    for i in numba.prange(out.shape[0]):  # pylint: disable=not-an-iterable
+        out[i] = 1 if mask[i] != 0 or (candidates[i] != 0 and labels[i] != 1) else 0
+
+
+@numba.njit(parallel=True)
+def _segmentation_labels_numba(enamel: np.ndarray, dentin: np.ndarray, out: np.ndarray) -> None:
+    """Label image with enamel 3 and dentin 2."""
+    for i in numba.prange(out.shape[0]):  # pylint: disable=not-an-iterable
+        out[i] = enamel[i] * 3 + dentin[i] * 2
+
+
+def _run_kernel(kernel, *images: sitk.Image) -> sitk.Image:
+    """Run a kernel on flat views of the images and return its uint8 result."""
+    size = images[0].GetSize()
+    if any(image.GetSize() != size for image in images[1:]):
+        raise ValueError("Image sizes must agree")
+    arrays = [sitk.GetArrayViewFromImage(image) for image in images]
+    out = np.empty(arrays[0].shape, dtype=np.uint8)
+    with NUMBA_PARALLEL_LOCK:
+        kernel(*(array.reshape(-1) for array in arrays), out.reshape(-1))
+    result = sitk.GetImageFromArray(out)
+    result.CopyInformation(images[0])
+    return result
+
+
+def dentin_candidates(enamel: sitk.Image, tooth: sitk.Image, contour: sitk.Image) -> sitk.Image:
+    """
+    Select the voxels of the tooth that are neither enamel nor contour.
+
+    Same as "(~((((enamel + ((~tooth) == 255)) > 0) + contour) > 0)) == 255"
+    for binary masks.
+
+    Args:
+        enamel (sitk.Image): Binary enamel mask.
+        tooth (sitk.Image): Binary tooth mask.
+        contour (sitk.Image): Binary mask of the thick tooth contour.
+
+    Returns:
+        sitk.Image: Binary uint8 mask.
+    """
+    return _run_kernel(_dentin_candidates_numba, enamel, tooth, contour)
+
+
+def add_minor_components(mask: sitk.Image, candidates: sitk.Image, labels: sitk.Image) -> sitk.Image:
+    """
+    Add the candidate voxels outside of the largest component to a mask.
+
+    Same as "mask + (candidates - (labels == 1))" for binary masks and
+    labels sorted by size, where the candidates are disjoint from the
+    mask. Pass the labels as candidates to add every labeled component
+    but the largest.
+
+    Args:
+        mask (sitk.Image): Binary mask.
+        candidates (sitk.Image): Binary mask of the voxels to be added.
+        labels (sitk.Image): Components of the candidates, the largest
+            one labeled 1, e.g. from ccMinSize or the mask of
+            components.largest_component.
+
+    Returns:
+        sitk.Image: Binary uint8 mask.
+    """
+    return _run_kernel(_add_minor_components_numba, mask, candidates, labels)
+
+
+def segmentation_labels(enamel: sitk.Image, dentin: sitk.Image) -> sitk.Image:
+    """
+    Combine the enamel and dentin masks to a label image.
+
+    Same as "enamel * 3 + dentin * 2" for uint8 masks.
+
+    Args:
+        enamel (sitk.Image): Binary enamel mask, labeled 3.
+        dentin (sitk.Image): Binary dentin mask, labeled 2.
+
+    Returns:
+        sitk.Image: The uint8 label image.
+    """
+    return _run_kernel(_segmentation_labels_numba, enamel, dentin)
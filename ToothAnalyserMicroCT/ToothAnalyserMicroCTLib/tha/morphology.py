@@ -0,0 +1,159 @@
+"""
+ToothAnalyserMicroCTLib.tha.morphology
+=================================
+
+This module provides binary morphology with ball kernels as thresholds on a
+Euclidean distance transform.
+
+A voxel belongs to the dilation of a mask with a ball of radius r if its
+squared distance to the mask is at most r * (r + 1), the ball of the
+SimpleITK filters. The distance transform takes linear time, so the cost
+does not grow with the radius as for the kernel based filters. Erosion is
+the dilation of the background, with the voxels outside the image counted
+as foreground as in the SimpleITK filters. Distances are measured in voxels,
+like the kernels.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY.
+
+Example Usage
+-------------
+In Python:
+    import ToothAnalyserMicroCTLib.tha.morphology as morphology
+    closed = morphology.closing(mask, 10)
+    filled = morphology.closing_by_reconstruction(mask, 10)
+
+Author
+-------
+Lukas Konietzka, lukas.konietzka@tha.de
+"""
+
+import SimpleITK as sitk
+
+
+def _ball_threshold(radius: int) -> int:
+    """Largest squared distance inside the ball of a radius."""
+    return radius * (radius + 1)
+
+
+def _within(mask: sitk.Image, radius: int) -> sitk.Image:
+    """Voxels with a distance of at most radius to the foreground of a mask."""
+    voxels = sitk.GetArrayViewFromImage(mask)
+    # the distance map needs foreground and background voxels
+    if not voxels.any():
+        return mask != mask
+    if voxels.all():
+        return mask == mask
+    distance = sitk.SignedMaurerDistanceMap(
+        mask != 0, insideIsPositive=False, squaredDistance=True, useImageSpacing=False
+    )
+    return distance <= _ball_threshold(radius)
+
+
+def _as_input(result: sitk.Image, mask: sitk.Image) -> sitk.Image:
+    """Cast a binary result to the pixel type of the input mask."""
+    if result.GetPixelID() != mask.GetPixelID():
+        result = sitk.Cast(result, mask.GetPixelID())
+    return result
+
+
+def dilate(mask: sitk.Image, radius: int) -> sitk.Image:
+    """
+    Dilate a binary mask with a ball.
+
+    Same as sitk.BinaryDilate(mask, [radius] * 3, sitk.sitkBall).
+
+    Args:
+        mask (sitk.Image): Binary mask.
+        radius (int): Radius of the ball in voxels.
+
+    Returns:
+        sitk.Image: The dilated mask.
+    """
+    return _as_input(_within(mask, radius), mask)
+
+
+def erode(mask: sitk.Image, radius: int) -> sitk.Image:
+    """
+    Erode a binary mask with a ball.
+
+    Same as sitk.BinaryErode(mask, [radius] * 3, sitk.sitkBall).
+
+    Args:
+        mask (sitk.Image): Binary mask.
+        radius (int): Radius of the ball in voxels.
+
+    Returns:
+        sitk.Image: The eroded mask.
+    """
+    return _as_input(_within(mask == 0, radius) == 0, mask)
+
+
+def closing(mask: sitk.Image, radius: int) -> sitk.Image:
+    """
+    Close a binary mask with a ball.
+
+    Same as sitk.BinaryMorphologicalClosing(mask, [radius] * 3, sitk.sitkBall),
+    the dilation may grow beyond the image border before it is eroded.
+
+    Args:
+        mask (sitk.Image): Binary mask.
+        radius (int): Radius of the ball in voxels.
+
+    Returns:
+        sitk.Image: The closed mask.
+    """
+    pad = [radius] * 3
+    dilated = _within(sitk.ConstantPad(mask != 0, pad, pad, 0), radius)
+    closed = _within(dilated == 0, radius) == 0
+    return _as_input(sitk.Crop(closed, pad, pad), mask)
+
+
+def opening(mask: sitk.Image, radius: int) -> sitk.Image:
+    """
+    Open a binary mask with a ball.
+
+    Same as sitk.BinaryMorphologicalOpening(mask, [radius] * 3, sitk.sitkBall).
+
+    Args:
+        mask (sitk.Image): Binary mask.
+        radius (int): Radius of the ball in voxels.
+
+    Returns:
+        sitk.Image: The opened mask.
+    """
+    return _as_input(_within(_within(mask == 0, radius) == 0, radius), mask)
+
+
+def closing_by_reconstruction(mask: sitk.Image, radius: int) -> sitk.Image:
+    """
+    Close a binary mask by reconstruction with a ball.
+
+    Same as sitk.BinaryClosingByReconstruction(mask, [radius] * 3).
+
+    Args:
+        mask (sitk.Image): Binary mask.
+        radius (int): Radius of the ball in voxels.
+
+    Returns:
+        sitk.Image: The closed mask.
+    """
+    binary = mask != 0
+    return _as_input(sitk.BinaryReconstructionByErosion(_within(binary, radius), binary), mask)
+
+
+def opening_by_reconstruction(mask: sitk.Image, radius: int) -> sitk.Image:
+    """
+    Open a binary mask by reconstruction with a ball.
+
+    Same as sitk.BinaryOpeningByReconstruction(mask, [radius] * 3).
+
+    Args:
+        mask (sitk.Image): Binary mask.
+        radius (int): Radius of the ball in voxels.
+
+    Returns:
+        sitk.Image: The opened mask.
+    """
+    binary = mask != 0
+    return _as_input(sitk.BinaryReconstructionByDilation(_within(binary == 0, radius) == 0, binary), mask)
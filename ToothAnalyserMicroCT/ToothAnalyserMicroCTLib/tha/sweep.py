@@ -0,0 +1,319 @@
+"""
+ToothAnalyserMicroCTLib.tha.sweep
+=================================
+
+This module runs the anatomical segmentation for a grid of parameters,
+e.g. to validate the threshold methods, the median size and the limits
+of the connected component filters.
+
+The runs are arranged as a tree. The common prefix of loading, compressing,
+median filtering and extracting the tooth mask is computed once for all
+runs that share it. Of the remaining steps, only those whose parameters or
+inputs differ from the previous run are computed again. The label image
+and the timings of the steps are written for every combination.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY.
+
+Example Usage
+-------------
+In Python:
+    import ToothAnalyserMicroCTLib.tha.sweep as sweep
+    grid = {"filter1": ["Otsu", "Renyi"], "medianSize": [3, 5], "dentinMinSize": [50, 100]}
+    sweep.run_sweep("P01A-C0005278.ISQ", "sweep_results", grid)
+
+From the command line:
+    $ python -m ToothAnalyserMicroCTLib.tha.sweep P01A-C0005278.ISQ sweep_results --methods Otsu Renyi --median_sizes 3 5
+
+Author
+-------
+Lukas Konietzka, lukas.konietzka@tha.de
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import time
+
+import SimpleITK as sitk
+
+from ..Algorithms.Anatomical import (
+    cachedStep,
+    cropImage,
+    imageGeometry,
+    imageMask,
+    isSmoothed,
+    loadImage,
+    loadImageCompressed,
+    segmentationGraph,
+    segmentationParameters,
+    smoothImage,
+    smoothImageMask,
+    thresholdMethods,
+    toothRegion,
+    uncropImage,
+)
+from ..Algorithms.utils import profileSteps, runGraph
+from .cache import evict_steps
+
+# parameters of the common prefix, the outer levels of the tree
+__PREFIX_PARAMETERS = ("compress", "medianSize")
+# parameters of the remaining steps, the last one changes fastest
+__TAIL_PARAMETERS = (
+    "filter2",
+    "filter1",
+    "enamelMinSize",
+    "preparationMinSize",
+    "fillingMinSize",
+    "dentinMinSize",
+)
+
+
+def sweep_grid(grid: dict = None) -> dict:
+    """
+    Complete a parameter grid with the defaults of the segmentation.
+
+    Args:
+        grid (dict): Parameter name -> list of values. The names are
+            "compress", "filter1" and "filter2" (the threshold methods of
+            the enamel selection and the smoothed enamel selection) and the
+            names of segmentationParameters. A filter2 of None uses filter1.
+
+    Returns:
+        dict: The grid with a list of values for every parameter.
+    """
+    grid = dict(grid or {})
+    unknown = set(grid) - set(__PREFIX_PARAMETERS) - set(__TAIL_PARAMETERS)
+    if unknown:
+        raise ValueError(f"Unknown sweep parameters: {sorted(unknown)}")
+    methods = thresholdMethods()
+    for method in itertools.chain(grid.get("filter1", []), grid.get("filter2", [])):
+        if method is not None and method not in methods:
+            raise ValueError(f"Unknown threshold method '{method}', use one of {methods}")
+    defaults = {"compress": False, "filter1": "Otsu", "filter2": None, **segmentationParameters()}
+    return {name: list(grid.get(name, [defaults[name]]))
+            for name in __PREFIX_PARAMETERS + __TAIL_PARAMETERS}
+
+
+def _memoized_step(run_step, previous: dict, current: dict):
+    """
+    Run steps through run_step, reusing the results of the previous run.
+
+    A step is identified by its name, its input images and its remaining
+    arguments. As every input image is either an input of the graph or the
+    result of another step, equal keys mean equal results.
+    """
+
+    def run(function, *args):
+        key = (function.__name__,) + tuple(
+            ("image", id(arg)) if isinstance(arg, sitk.Image) else repr(arg) for arg in args
+        )
+        if key not in current:
+            current[key] = previous[key] if key in previous else run_step(function, *args)
+        return current[key]
+
+    return run
+
+
+def run_sweep(
+    source_path: str,
+    out_dir_name: str,
+    grid: dict = None,
+    file_type: str = ".nrrd",
+    crop: bool = True,
+    cache_dir_name: str = None,
+    step_cache_dir_name: str = None,
+    max_workers: int = None,
+    step_cache_bytes: int = 2 * 1024**3,
+) -> list[dict]:
+    """
+    Run the anatomical segmentation for every combination of a parameter grid.
+
+    For every combination, <name>_sweep_<index>_labels<file_type> and
+    <name>_sweep_<index>_timings.json are written, <name>_sweep.json
+    lists all combinations.
+
+    Args:
+        source_path (str): The image file (ISQ, AIM, mhd, nrrd, ...).
+        out_dir_name (str): Directory of the results.
+        grid (dict): Parameter name -> list of values, see sweep_grid.
+        file_type (str): File extension of the label images.
+        crop (bool): Run the steps after the tooth mask on the bounding
+            box of the tooth only.
+        cache_dir_name (str): Directory of the on-disk caches of loading,
+            None disables them.
+        step_cache_dir_name (str): Directory of the step cache, None
+            disables it.
+        max_workers (int): Maximum number of steps running concurrently.
+        step_cache_bytes (int): Size limit of the step cache in bytes.
+
+    Returns:
+        list[dict]: Parameters, label file and timings of every combination.
+    """
+    grid = sweep_grid(grid)
+    os.makedirs(out_dir_name, exist_ok=True)
+    summary = []
+
+    def cached(function, *args):
+        return cachedStep(step_cache_dir_name, image_keys, function, *args)
+
+    for compress in grid["compress"]:
+        image_keys = {}
+        with profileSteps() as load_profile:
+            start = time.perf_counter()
+            if compress:
+                img, name = loadImageCompressed(source_path, cache_dir_name)
+            else:
+                img, name = loadImage(source_path, cache_dir_name)
+            load_time = time.perf_counter() - start
+        smoothed = isSmoothed(img)
+        geometry = imageGeometry(img)
+        # an already smoothed image is not filtered again, the prefix is the same for all sizes
+        median_sizes = grid["medianSize"][:1] if smoothed else grid["medianSize"]
+        for median_size in median_sizes:
+            with profileSteps() as prefix_profile:
+                start = time.perf_counter()
+                img_smooth = img if smoothed else cached(smoothImage, img, median_size)
+                tooth, tooth_masked = cached(imageMask, img, img_smooth)
+                tooth_smooth_masked = cached(smoothImageMask, img_smooth, tooth)
+                img_smooth = None
+                region = toothRegion(tooth) if crop else None
+                if region is not None:
+                    tooth = cropImage(tooth, region)
+                    tooth_masked = cropImage(tooth_masked, region)
+                    tooth_smooth_masked = cropImage(tooth_smooth_masked, region)
+                prefix_time = time.perf_counter() - start
+            inputs = {"tooth": tooth, "tooth_masked": tooth_masked,
+                      "tooth_smooth_masked": tooth_smooth_masked}
+            shared = {
+                "load": {"wallTime": load_time, "steps": load_profile},
+                "prefix": {"wallTime": prefix_time, "steps": prefix_profile},
+            }
+            previous = {}
+            tails = itertools.product(*(grid[p] for p in __TAIL_PARAMETERS))
+            for tail in tails:
+                values = dict(zip(__TAIL_PARAMETERS, tail))
+                filter1 = values.pop("filter1")
+                filter2 = values.pop("filter2") or filter1
+                parameters = {"medianSize": median_size, **values}
+                current = {}
+                graph = segmentationGraph(
+                    filter1, filter2, _memoized_step(cached, previous, current),
+                    region, geometry[0], parameters=parameters)
+                with profileSteps() as profile:
+                    start = time.perf_counter()
+                    *_, results = runGraph(graph, dict(inputs), max_workers, {"segmentation_labels"})
+                    wall_time = time.perf_counter() - start
+                if step_cache_dir_name is not None:
+                    evict_steps(step_cache_dir_name, step_cache_bytes)
+                previous = current
+                labels = results["segmentation_labels"]
+                if region is not None:
+                    labels = uncropImage(labels, region, geometry)
+
+                index = len(summary)
+                logging.info("Sweep %d: %s %s %s", index, filter1, filter2, parameters)
+                prefix_name = os.path.join(out_dir_name, f"{name}_sweep_{index:03d}")
+                sitk.WriteImage(labels, prefix_name + "_labels" + file_type)
+                entry = {
+                    "parameters": {"compress": compress, "filter1": filter1,
+                                   "filter2": filter2, **parameters},
+                    "labels": os.path.basename(prefix_name + "_labels" + file_type),
+                    "wallTime": wall_time,
+                    "steps": profile,
+                    "shared": shared,
+                }
+                with open(prefix_name + "_timings.json", "w", encoding="utf8") as f:
+                    json.dump(entry, f, indent=1)
+                summary.append(entry)
+        img = None
+
+    with open(os.path.join(out_dir_name, f"{name}_sweep.json"), "w", encoding="utf8") as f:
+        json.dump(summary, f, indent=1)
+    return summary
+
+
+def sweep_main():
+    """
+    Run the anatomical segmentation for a grid of parameters.
+
+    Args:
+        source_path (str): The image file.
+        out_dir_name (str): Directory of the results.
+    """
+    parser = argparse.ArgumentParser(
+        description="Run the anatomical segmentation for a grid of parameters",
+        epilog="Runs sharing the same loading, median filter and tooth mask compute them once.",
+    )
+    parser.add_argument("source_path", type=str, help="Name of the image file")
+    parser.add_argument("out_dir_name", type=str, help="Directory of the results")
+    parser.add_argument(
+        "--methods",
+        type=str,
+        nargs="+",
+        default=["Otsu"],
+        choices=thresholdMethods(),
+        help="Threshold methods of the enamel selection",
+    )
+    parser.add_argument(
+        "--smooth_methods",
+        type=str,
+        nargs="+",
+        default=None,
+        choices=thresholdMethods(),
+        help="Threshold methods of the smoothed enamel selection, default is the same as --methods",
+    )
+    defaults = segmentationParameters()
+    for option, name in (
+        ("--median_sizes", "medianSize"),
+        ("--enamel_min_sizes", "enamelMinSize"),
+        ("--preparation_min_sizes", "preparationMinSize"),
+        ("--filling_min_sizes", "fillingMinSize"),
+        ("--dentin_min_sizes", "dentinMinSize"),
+    ):
+        parser.add_argument(
+            option,
+            type=int,
+            nargs="+",
+            default=[defaults[name]],
+            dest=name,
+            help=f"Values of {name}, default is {defaults[name]}",
+        )
+    parser.add_argument(
+        "--compress",
+        action="store_true",
+        help="Down sample the image by 2 while reading",
+    )
+    parser.add_argument(
+        "--file_type",
+        type=str,
+        default=".nrrd",
+        help="File extension of the label images",
+    )
+    parser.add_argument(
+        "--step_cache_dir_name",
+        type=str,
+        default=None,
+        help="Directory of the step cache, steps of earlier sweeps are not computed again",
+    )
+
+    args = parser.parse_args()
+    grid = {
+        "compress": [args.compress],
+        "filter1": args.methods,
+        "filter2": args.smooth_methods or [None],
+        **{name: getattr(args, name) for name in segmentationParameters()},
+    }
+    run_sweep(
+        args.source_path,
+        args.out_dir_name,
+        grid,
+        file_type=args.file_type,
+        step_cache_dir_name=args.step_cache_dir_name,
+    )
+
+
+if __name__ == "__main__":
+    sweep_main()
@@ -6,7 +6,7 @@ This module provides various utility functions for handling, converting,
 and visualizing µCT image data used in the ToothAnalyserMicroCT framework.
 
 It includes tools for matching corresponding image files between directories,
-reading and converting Scanco ISQ image files to MetaImage (MHD) or other formats,
+reading, cropping, stitching and converting Scanco ISQ image files to MetaImage (MHD) or other formats,
 and comparing intensity profiles across multiple 3D images.
 
 This program is distributed in the hope that it will be useful,
@@ -32,16 +32,27 @@ Lukas Konietzka, lukas.konietzka@tha.de
 import argparse
 from collections.abc import Sequence
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import json
 import os
 from pathlib import Path
 import re
 import sys
 from tempfile import TemporaryDirectory
+import time
 
 import SimpleITK as sitk
 import numpy as np
 import matplotlib.pyplot as plt
 
+from ..Algorithms.Scanco import (
+    isq_crop,
+    isq_preview,
+    isq_to_array,
+    read_isq_header,
+    write_isq,
+)
+
 
 def corresponding_files_to_file(
     dir_1_name: str,
@@ -424,6 +435,99 @@ def convert_isq(
         sitk.WriteImage(im, out_file_name)
 
 
+def _write_meta_image_header(
+    out_file,
+    size: Sequence[int],
+    spacing: Sequence[float],
+    origin: Sequence[float],
+    element_type: str,
+    data_file_name: str,
+) -> None:
+    """Write a MetaImage header whose data part is appended afterwards."""
+    param = __MHD_DEFAULTS.copy()
+    param["DimSize"] = " ".join(str(int(d)) for d in size)
+    param["ElementSpacing"] = " ".join(str(float(s)) for s in spacing)
+    param["Offset"] = " ".join(str(float(o)) for o in origin)
+    param["ElementType"] = element_type
+    param.pop("HeaderSize")
+    # ElementDataFile has to be the last entry of a MetaImage header
+    param["ElementDataFile"] = data_file_name
+    for key, value in param.items():
+        out_file.write(f"{key} = {value}\n".encode("utf8"))
+
+
+def convert_isq_streaming(
+    isq_file_name: str,
+    out_file_name: str,
+    slab_size: int = 64,
+    grey_range: tuple[int, int] = None,
+    convert_to_uint8: bool = True,
+) -> None:
+    """
+    Convert ISQ file to a MetaImage file slab by slab.
+
+    With convert_to_uint8, grey values are rescaled linearly from the grey
+    value range of the data to 0..255 and truncated like
+    sitk.RescaleIntensity of the int16 image, so the output matches
+    convert_isq with convert_to_uint8 set. Otherwise the int16 grey values
+    are copied. Peak memory stays near one slab because the output is
+    written while the input is read.
+
+    Args:
+        isq_file_name (str): Name of ISQ file to be converted.
+        out_file_name (str): Output file name, either .mhd (with a .raw
+            data file next to it) or .mha.
+        slab_size (int): Number of slices converted at once.
+        grey_range (tuple[int, int]): Grey value range mapped to 0..255.
+            Default is None in which case the range of the data is used,
+            which takes an extra pass over the file.
+        convert_to_uint8 (bool): Rescale and convert image to uint8.
+    """
+    suffix = os.path.splitext(out_file_name)[1].lower()
+    if suffix not in (".mhd", ".mha"):
+        raise ValueError("Streaming conversion writes .mhd or .mha files only")
+    header = read_isq_header(isq_file_name)
+    in_array = isq_to_array(isq_file_name)
+    if convert_to_uint8:
+        if grey_range is None:
+            grey_min, grey_max = np.iinfo(np.int16).max, np.iinfo(np.int16).min
+            for z in range(0, in_array.shape[0], slab_size):
+                slab = in_array[z : z + slab_size]
+                grey_min = min(grey_min, int(slab.min()))
+                grey_max = max(grey_max, int(slab.max()))
+            grey_range = (grey_min, grey_max)
+        grey_min, grey_max = grey_range
+        # same scale and shift as the RescaleIntensityImageFilter, a constant image becomes 0
+        scale = 255.0 / (grey_max - grey_min) if grey_max > grey_min else 0.0
+        shift = -grey_min * scale
+
+    if suffix == ".mhd":
+        raw_file_name = os.path.splitext(out_file_name)[0] + ".raw"
+        data_file_name = os.path.basename(raw_file_name)
+    else:
+        raw_file_name = out_file_name
+        data_file_name = "LOCAL"
+    with open(out_file_name, "wb") as out_file:
+        _write_meta_image_header(
+            out_file,
+            header["size"],
+            header["spacing"],
+            header["origin"],
+            "MET_UCHAR" if convert_to_uint8 else "MET_SHORT",
+            data_file_name,
+        )
+    with open(raw_file_name, "ab" if suffix == ".mha" else "wb") as raw_file:
+        for z in range(0, in_array.shape[0], slab_size):
+            if not convert_to_uint8:
+                raw_file.write(in_array[z : z + slab_size].astype("<i2").tobytes())
+                continue
+            slab = in_array[z : z + slab_size].astype(np.float64)
+            slab *= scale
+            slab += shift
+            np.clip(slab, 0, 255, out=slab)
+            raw_file.write(slab.astype(np.uint8).tobytes())
+
+
 def convert_isq_main():
     """
     Convert ISQ file to other image file formats.
@@ -433,6 +537,7 @@ def convert_isq_main():
         out_file_name (str): Output file name. The format is
             deduced from the file suffix.
         convert_to_uint8 (bool): Rescale and convert image to uint8
+        streaming (bool): Convert slab by slab to a .mhd/.mha file
     """
     parser = argparse.ArgumentParser(
         description="Convert ISQ file to other image formats.",
@@ -453,10 +558,656 @@ def convert_isq_main():
         help="Rescale and convert ISQ image to 8 bit unsigned int pixel type",
         action="store_true",
     )
+    parser.add_argument(
+        "--streaming",
+        help=(
+            "Convert slab by slab with low memory usage, with --convert_to_uint8"
+            + " as well. Output must be .mhd or .mha."
+        ),
+        action="store_true",
+    )
+
+    args = parser.parse_args()
+    if args.streaming:
+        convert_isq_streaming(
+            args.isq_file_name,
+            args.out_file_name,
+            convert_to_uint8=args.convert_to_uint8,
+        )
+    else:
+        convert_isq(
+            args.isq_file_name,
+            args.out_file_name,
+            args.convert_to_uint8,
+        )
+
+
+def crop_isq(
+    isq_file_name: str,
+    out_file_name: str,
+    index: Sequence[int],
+    size: Sequence[int],
+) -> None:
+    """
+    Read a region of interest from an ISQ file and write it to disk.
+
+    Args:
+        isq_file_name (str): Name of ISQ file to be cropped.
+        out_file_name (str): Output file name. The format is
+            deduced from the file suffix.
+        index (Sequence[int]): First voxel of the region (x, y, z).
+        size (Sequence[int]): Size of the region in voxels (x, y, z).
+    """
+    im = isq_crop(isq_file_name, index, size)
+    sitk.WriteImage(im, out_file_name)
+
+
+def crop_isq_main():
+    """
+    Read a region of interest from an ISQ file.
+
+    Args:
+        isq_file_name (str): Name of ISQ file to be cropped.
+        out_file_name (str): Output file name. The format is
+            deduced from the file suffix.
+        index (int x 3): First voxel of the region (x, y, z).
+        size (int x 3): Size of the region in voxels (x, y, z).
+    """
+    parser = argparse.ArgumentParser(
+        description="Read a region of interest from an ISQ file.",
+        epilog="Only the grey values inside the region are read.",
+    )
+    parser.add_argument(
+        "isq_file_name",
+        type=str,
+        help="Name of input ISQ file",
+    )
+    parser.add_argument(
+        "out_file_name",
+        type=str,
+        help="Name of output file. The format is determined by the suffix.",
+    )
+    parser.add_argument(
+        "--index",
+        type=int,
+        nargs=3,
+        required=True,
+        help="First voxel of the region (x y z)",
+    )
+    parser.add_argument(
+        "--size",
+        type=int,
+        nargs=3,
+        required=True,
+        help="Size of the region in voxels (x y z)",
+    )
 
     args = parser.parse_args()
-    convert_isq(
+    crop_isq(
         args.isq_file_name,
         args.out_file_name,
+        args.index,
+        args.size,
+    )
+
+
+def preview_isq_main():
+    """
+    Write a strided low resolution preview of an ISQ file.
+
+    Args:
+        isq_file_name (str): Name of ISQ file to be previewed.
+        out_file_name (str): Output file name. The format is
+            deduced from the file suffix.
+        step (int): Sampling step along every axis.
+        convert_to_uint8 (bool): Rescale and convert image to uint8
+    """
+    parser = argparse.ArgumentParser(
+        description="Write a low resolution preview of an ISQ file.",
+        epilog="Reads every step-th slice, row and voxel only.",
+    )
+    parser.add_argument(
+        "isq_file_name",
+        type=str,
+        help="Name of input ISQ file",
+    )
+    parser.add_argument(
+        "out_file_name",
+        type=str,
+        help="Name of output file. The format is determined by the suffix.",
+    )
+    parser.add_argument(
+        "--step",
+        type=int,
+        default=4,
+        help="Sampling step along every axis, default is 4",
+    )
+    parser.add_argument(
+        "--convert_to_uint8",
+        help="Rescale and convert preview to 8 bit unsigned int pixel type",
+        action="store_true",
+    )
+
+    args = parser.parse_args()
+    im = isq_preview(args.isq_file_name, args.step)
+    if args.convert_to_uint8:
+        im = sitk.RescaleIntensity(im, 0, 255)
+        im = sitk.Cast(im, sitk.sitkUInt8)
+    sitk.WriteImage(im, args.out_file_name)
+
+
+def image_to_isq_main():
+    """
+    Write an image file, e.g. a filtered or downsampled scan, as ISQ file.
+
+    Args:
+        in_file_name (str): Name of input image file.
+        isq_file_name (str): Name of output ISQ file.
+        mu_scaling (int): Scaling of grey values to linear attenuation.
+        slab_size (int): Number of slices written at once.
+    """
+    parser = argparse.ArgumentParser(
+        description="Write an image file as Scanco ISQ file.",
+        epilog="Grey values are clipped to the int16 range.",
+    )
+    parser.add_argument(
+        "in_file_name",
+        type=str,
+        help="Name of input image file",
+    )
+    parser.add_argument(
+        "isq_file_name",
+        type=str,
+        help="Name of output ISQ file",
+    )
+    parser.add_argument(
+        "--mu_scaling",
+        type=int,
+        default=4096,
+        help="Scaling of grey values to linear attenuation, default is 4096",
+    )
+    parser.add_argument(
+        "--slab_size",
+        type=int,
+        default=64,
+        help="Number of slices written at once, default is 64",
+    )
+
+    args = parser.parse_args()
+    im = sitk.ReadImage(args.in_file_name)
+    write_isq(args.isq_file_name, im, mu_scaling=args.mu_scaling, slab_size=args.slab_size)
+
+
+def _normalized_correlation(a: np.ndarray, b: np.ndarray) -> float:
+    """Normalized cross-correlation of two equally shaped arrays."""
+    a = a.astype(np.float64) - a.mean()
+    b = b.astype(np.float64) - b.mean()
+    norm = np.sqrt((a * a).sum() * (b * b).sum())
+    return float((a * b).sum() / norm) if norm > 0 else 0.0
+
+
+def estimate_isq_overlap(
+    lower_isq_file_name: str,
+    upper_isq_file_name: str,
+    max_overlap: int = 200,
+    probe_slices: int = 3,
+    min_correlation: float = 0.9,
+) -> int:
+    """
+    Estimate the number of slices two stacked ISQ blocks have in common.
+
+    For every candidate overlap k the first probe_slices slices of the
+    upper block are correlated with the slices at the same position in
+    the last k slices of the lower block. Only these slices are read.
+
+    Args:
+        lower_isq_file_name (str): Name of the lower ISQ block.
+        upper_isq_file_name (str): Name of the upper ISQ block.
+        max_overlap (int): Largest overlap in slices to be tested.
+        probe_slices (int): Number of slices correlated per candidate.
+        min_correlation (float): Minimum mean correlation to accept an
+            overlap. If no candidate reaches it, 0 is returned.
+
+    Returns:
+        int: Estimated overlap in slices.
+    """
+    lower = isq_to_array(lower_isq_file_name)
+    upper = isq_to_array(upper_isq_file_name)
+    if lower.shape[1:] != upper.shape[1:]:
+        raise ValueError(
+            f"Blocks {lower_isq_file_name} and {upper_isq_file_name} "
+            "differ in x and y size"
+        )
+    # the upper block has to add at least one slice
+    max_overlap = min(max_overlap, lower.shape[0], upper.shape[0] - 1)
+    best_overlap, best_correlation = 0, min_correlation
+    for overlap in range(1, max_overlap + 1):
+        probes = min(probe_slices, overlap)
+        start = lower.shape[0] - overlap
+        correlation = np.mean(
+            [
+                _normalized_correlation(lower[start + i], upper[i])
+                for i in range(probes)
+            ]
+        )
+        if correlation > best_correlation:
+            best_overlap, best_correlation = overlap, correlation
+    return best_overlap
+
+
+def stitch_isq(
+    isq_file_names: Sequence[str],
+    out_file_name: str,
+    overlaps: Sequence[int] = None,
+    max_overlap: int = 200,
+    slab_size: int = 64,
+) -> list[int]:
+    """
+    Stitch ISQ blocks of one scan, given from bottom to top, into one file.
+
+    Overlapping slices are taken from the lower block. The output is
+    written slab by slab, so peak memory stays near one slab.
+
+    Args:
+        isq_file_names (Sequence[str]): Names of the ISQ blocks in z order.
+        out_file_name (str): Output file name, either .isq, .mhd (with a
+            .raw data file next to it) or .mha.
+        overlaps (Sequence[int]): Overlap in slices between consecutive
+            blocks, each smaller than the number of slices of the upper
+            block. Default is None in which case it is estimated.
+        max_overlap (int): Largest overlap tested during estimation.
+        slab_size (int): Number of slices written at once.
+
+    Returns:
+        list[int]: Overlap between consecutive blocks in slices.
+    """
+    suffix = os.path.splitext(out_file_name)[1].lower()
+    if suffix not in (".isq", ".mhd", ".mha"):
+        raise ValueError("Stitching writes .isq, .mhd or .mha files only")
+    headers = [read_isq_header(f) for f in isq_file_names]
+    for file_name, header in zip(isq_file_names[1:], headers[1:]):
+        if header["size"][:2] != headers[0]["size"][:2] or not np.allclose(
+            header["spacing"], headers[0]["spacing"]
+        ):
+            raise ValueError(
+                f"Block {file_name} differs in x and y size or spacing"
+            )
+    if overlaps is None:
+        overlaps = [
+            estimate_isq_overlap(lower, upper, max_overlap)
+            for lower, upper in zip(isq_file_names[:-1], isq_file_names[1:])
+        ]
+    overlaps = list(overlaps)
+    if len(overlaps) != len(isq_file_names) - 1:
+        raise ValueError(
+            f"Expected {len(isq_file_names) - 1} overlaps for {len(isq_file_names)} blocks,"
+            f" got {len(overlaps)}"
+        )
+    for file_name, header, overlap in zip(isq_file_names[1:], headers[1:], overlaps):
+        if not 0 <= overlap < header["size"][2]:
+            raise ValueError(
+                f"Overlap {overlap} of block {file_name} must be in 0..{header['size'][2] - 1}"
+            )
+    skip = [0] + overlaps
+
+    def slabs():
+        for file_name, first in zip(isq_file_names, skip):
+            in_array = isq_to_array(file_name)
+            for z in range(first, in_array.shape[0], slab_size):
+                yield in_array[z : min(z + slab_size, in_array.shape[0])]
+
+    spacing = headers[0]["spacing"]
+    if suffix == ".isq":
+        write_isq(out_file_name, slabs(), spacing=spacing, slab_size=slab_size)
+        return overlaps
+
+    size_z = sum(h["size"][2] - first for h, first in zip(headers, skip))
+    if suffix == ".mhd":
+        raw_file_name = os.path.splitext(out_file_name)[0] + ".raw"
+        data_file_name = os.path.basename(raw_file_name)
+    else:
+        raw_file_name = out_file_name
+        data_file_name = "LOCAL"
+    with open(out_file_name, "wb") as out_file:
+        _write_meta_image_header(
+            out_file,
+            (*headers[0]["size"][:2], size_z),
+            spacing,
+            headers[0]["origin"],
+            "MET_SHORT",
+            data_file_name,
+        )
+    with open(raw_file_name, "ab" if suffix == ".mha" else "wb") as raw_file:
+        for slab in slabs():
+            raw_file.write(np.ascontiguousarray(slab, dtype="<i2").tobytes())
+    return overlaps
+
+
+def stitch_isq_main():
+    """
+    Stitch ISQ blocks of one scan into one file.
+
+    Args:
+        isq_file_names (list[str]): Names of the ISQ blocks from bottom to top.
+        out_file_name (str): Output file name (.isq, .mhd or .mha).
+        overlaps (list[int]): Overlaps in slices, estimated if not given.
+        max_overlap (int): Largest overlap tested during estimation.
+    """
+    parser = argparse.ArgumentParser(
+        description="Stitch stacked ISQ blocks of one scan into one file.",
+        epilog="Overlapping slices are estimated by correlation unless given.",
+    )
+    parser.add_argument(
+        "isq_file_names",
+        type=str,
+        nargs="+",
+        help="Names of the ISQ blocks from bottom to top",
+    )
+    parser.add_argument(
+        "out_file_name",
+        type=str,
+        help="Name of output file, .isq, .mhd or .mha",
+    )
+    parser.add_argument(
+        "--overlaps",
+        type=int,
+        nargs="+",
+        default=None,
+        help="Overlap in slices between consecutive blocks",
+    )
+    parser.add_argument(
+        "--max_overlap",
+        type=int,
+        default=200,
+        help="Largest overlap tested during estimation, default is 200",
+    )
+
+    args = parser.parse_args()
+    overlaps = stitch_isq(
+        args.isq_file_names, args.out_file_name, args.overlaps, args.max_overlap
+    )
+    print("Overlaps in slices:", overlaps)
+
+
+def _is_valid_output(out_file_name: str, isq_file_name: str) -> bool:
+    """Check that an output file is readable and matches the ISQ size."""
+    if not os.path.isfile(out_file_name):
+        return False
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(out_file_name)
+    try:
+        reader.ReadImageInformation()
+    except RuntimeError:
+        return False
+    if reader.GetSize() != read_isq_header(isq_file_name)["size"]:
+        return False
+    if out_file_name.lower().endswith(".mhd"):
+        # the header is written first, a truncated data file means
+        # the conversion was interrupted
+        bytes_per_voxel = sitk.GetArrayViewFromImage(
+            sitk.Image([1, 1, 1], reader.GetPixelID())
+        ).itemsize
+        raw_file_name = os.path.splitext(out_file_name)[0] + ".raw"
+        expected = int(np.prod(reader.GetSize())) * bytes_per_voxel
+        if (
+            not os.path.isfile(raw_file_name)
+            or os.path.getsize(raw_file_name) != expected
+        ):
+            return False
+    return True
+
+
+def _convert_isq_file(
+    isq_file_name: str, out_file_name: str, convert_to_uint8: bool
+) -> tuple[str, float, float]:
+    """Convert one ISQ file, return its name, duration and size in MB."""
+    start = time.time()
+    out_dir_name, out_base_name = os.path.split(out_file_name)
+    if out_base_name.lower().endswith(".mhd"):
+        convert_isq(isq_file_name, out_file_name, convert_to_uint8)
+    else:
+        # write to a temporary name first so that an interrupted
+        # conversion never leaves a complete looking output file
+        partial_file_name = os.path.join(out_dir_name, ".partial_" + out_base_name)
+        convert_isq(isq_file_name, partial_file_name, convert_to_uint8)
+        os.replace(partial_file_name, out_file_name)
+    size_mb = os.path.getsize(isq_file_name) / 1024**2
+    return isq_file_name, time.time() - start, size_mb
+
+
+def convert_isq_directory(
+    in_dir_name: str,
+    out_dir_name: str,
+    suffix: str = ".nii",
+    convert_to_uint8: bool = False,
+    processes: int = 2,
+) -> None:
+    """
+    Convert all ISQ files of a directory in parallel.
+
+    Outputs that already exist and can be read with the size of the
+    corresponding ISQ file are skipped, so an interrupted run resumes
+    where it stopped. The throughput of every file is printed.
+
+    Args:
+        in_dir_name (str): Directory containing the ISQ files.
+        out_dir_name (str): Directory the converted files are written to.
+        suffix (str): Output suffix, e.g. ".nii", ".nii.gz", ".nrrd",
+            ".mhd". The format is deduced from the suffix.
+        convert_to_uint8 (bool): Rescale and convert images to uint8
+        processes (int): Number of worker processes. Every worker holds
+            a whole volume, two with convert_to_uint8, so the default of 2
+            keeps the memory usage low for large scans. Increase it for
+            small files or machines with plenty of memory.
+    """
+    os.makedirs(out_dir_name, exist_ok=True)
+    jobs = []
+    for entry in sorted(Path(in_dir_name).iterdir()):
+        if entry.is_file() and entry.suffix.lower() == ".isq":
+            out_file_name = os.path.join(out_dir_name, entry.stem + suffix)
+            if _is_valid_output(out_file_name, str(entry)):
+                print(f"{entry.name}: skipped, {out_file_name} exists")
+            else:
+                jobs.append((str(entry), out_file_name))
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [
+            executor.submit(
+                _convert_isq_file, isq_file_name, out_file_name, convert_to_uint8
+            )
+            for isq_file_name, out_file_name in jobs
+        ]
+        for future in as_completed(futures):
+            isq_file_name, duration, size_mb = future.result()
+            print(
+                f"{os.path.basename(isq_file_name)}: {size_mb:.1f} MB in"
+                f" {duration:.1f} s, {size_mb / max(duration, 1e-6):.1f} MB/s"
+            )
+
+
+def convert_isq_directory_main():
+    """
+    Convert all ISQ files of a directory in parallel.
+
+    Args:
+        in_dir_name (str): Directory containing the ISQ files.
+        out_dir_name (str): Directory the converted files are written to.
+        suffix (str): Output suffix, the format is deduced from it.
+        convert_to_uint8 (bool): Rescale and convert images to uint8
+        processes (int): Number of worker processes.
+    """
+    parser = argparse.ArgumentParser(
+        description="Convert all ISQ files of a directory in parallel.",
+        epilog="Existing valid outputs are skipped, so interrupted runs resume.",
+    )
+    parser.add_argument(
+        "in_dir_name",
+        type=str,
+        help="Directory containing the ISQ files",
+    )
+    parser.add_argument(
+        "out_dir_name",
+        type=str,
+        help="Directory the converted files are written to",
+    )
+    parser.add_argument(
+        "--suffix",
+        type=str,
+        default=".nii",
+        choices=[".nii", ".nii.gz", ".nrrd", ".mhd"],
+        help="Output file suffix, default is .nii",
+    )
+    parser.add_argument(
+        "--convert_to_uint8",
+        help="Rescale and convert ISQ images to 8 bit unsigned int pixel type",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=2,
+        help=(
+            "Number of worker processes, default is 2. Every worker holds a"
+            + " whole volume (two with --convert_to_uint8) in memory."
+        ),
+    )
+
+    args = parser.parse_args()
+    convert_isq_directory(
+        args.in_dir_name,
+        args.out_dir_name,
+        args.suffix,
         args.convert_to_uint8,
+        args.processes,
     )
+
+
+def _isq_catalog_entry(isq_file_name: str) -> dict:
+    """Collect the header information of one ISQ file for the catalog."""
+    param, _, grey_range = _read_isq_param(isq_file_name)
+    stat = os.stat(isq_file_name)
+    size = [int(d) for d in param["DimSize"].split()]
+    return {
+        "size": size,
+        "spacing_mm": [float(s) for s in param["ElementSpacing"].split()],
+        "grey_range": [int(grey_range[0]), int(grey_range[1])],
+        "mu_scaling": int(param["ISQ_mu_scaling"]),
+        "energy_V": int(param["ISQ_energy_V"]),
+        "intensity_muA": int(param["ISQ_intensity_muA"]),
+        "voxels": int(np.prod(size)),
+        "file_size": stat.st_size,
+        "mtime": stat.st_mtime,
+    }
+
+
+def build_isq_catalog(
+    root_dir_name: str, catalog_file_name: str = None
+) -> dict[str, dict]:
+    """
+    Build or update a catalog of all ISQ files below a directory.
+
+    Only the ISQ headers are read. Entries of files whose size and
+    modification time did not change since the last run are reused,
+    entries of removed files are dropped.
+
+    Args:
+        root_dir_name (str): Directory that is searched recursively.
+        catalog_file_name (str): Name of the JSON index file. Default is
+            None in which case ".isq_catalog.json" in root_dir_name is used.
+
+    Returns:
+        dict[str, dict]: Catalog entries keyed by the path relative to
+        root_dir_name.
+    """
+    if catalog_file_name is None:
+        catalog_file_name = os.path.join(root_dir_name, ".isq_catalog.json")
+    old_catalog = {}
+    if os.path.isfile(catalog_file_name):
+        with open(catalog_file_name, "r", encoding="utf8") as catalog_file:
+            old_catalog = json.load(catalog_file)
+
+    catalog = {}
+    for dir_name, _, file_names in os.walk(root_dir_name):
+        for file_name in sorted(file_names):
+            if os.path.splitext(file_name)[1].lower() != ".isq":
+                continue
+            full_name = os.path.join(dir_name, file_name)
+            rel_name = os.path.relpath(full_name, root_dir_name)
+            stat = os.stat(full_name)
+            entry = old_catalog.get(rel_name)
+            if (
+                entry is None
+                or entry["file_size"] != stat.st_size
+                or entry["mtime"] != stat.st_mtime
+            ):
+                entry = _isq_catalog_entry(full_name)
+            catalog[rel_name] = entry
+
+    with open(catalog_file_name, "w", encoding="utf8") as catalog_file:
+        json.dump(catalog, catalog_file, indent=1, sort_keys=True)
+    return catalog
+
+
+def filter_isq_catalog(
+    catalog: dict[str, dict],
+    min_voxels: int = 0,
+    max_voxels: int = None,
+) -> list[str]:
+    """
+    Select catalog entries by their number of voxels.
+
+    Args:
+        catalog (dict[str, dict]): Catalog as returned by build_isq_catalog.
+        min_voxels (int): Smallest number of voxels, e.g. 1500**3.
+        max_voxels (int): Largest number of voxels. Default is None
+            (no upper limit).
+
+    Returns:
+        list[str]: Sorted relative file names of the matching entries.
+    """
+    return sorted(
+        name
+        for name, entry in catalog.items()
+        if entry["voxels"] >= min_voxels
+        and (max_voxels is None or entry["voxels"] <= max_voxels)
+    )
+
+
+def isq_catalog_main():
+    """
+    Build or update the ISQ catalog of a directory and list its entries.
+
+    Args:
+        root_dir_name (str): Directory that is searched recursively.
+        catalog_file_name (str): Name of the JSON index file.
+        min_voxels (int): List only scans with at least this many voxels.
+    """
+    parser = argparse.ArgumentParser(
+        description="Build or update the ISQ catalog of a directory.",
+        epilog="Reads ISQ headers only, unchanged files are not read again.",
+    )
+    parser.add_argument(
+        "root_dir_name",
+        type=str,
+        help="Directory that is searched recursively for ISQ files",
+    )
+    parser.add_argument(
+        "--catalog_file_name",
+        type=str,
+        default=None,
+        help="Name of the JSON index file, default is .isq_catalog.json",
+    )
+    parser.add_argument(
+        "--min_voxels",
+        type=int,
+        default=0,
+        help="List only scans with at least this many voxels",
+    )
+
+    args = parser.parse_args()
+    catalog = build_isq_catalog(args.root_dir_name, args.catalog_file_name)
+    for name in filter_isq_catalog(catalog, args.min_voxels):
+        entry = catalog[name]
+        size_str = "x".join(str(d) for d in entry["size"])
+        memory_gb = entry["voxels"] * 2 / 1024**3
+        print(f"{name} {size_str} {memory_gb:.2f} GB")